@@ -10,13 +10,15 @@ import time
 import unittest
 import urllib
 
+import constants
 from chromite.lib import cros_logging as logging
-from chromite.lib import dev_server_wrapper
 from crostestutils.au_test_harness import cros_test_proxy
 from crostestutils.au_test_harness import gce_au_worker
+from crostestutils.au_test_harness import proxy_filters
 from crostestutils.au_test_harness import real_au_worker
 from crostestutils.au_test_harness import update_exception
 from crostestutils.au_test_harness import vm_au_worker
+from crostestutils.lib import port_allocator
 
 
 class AUTest(unittest.TestCase):
@@ -60,25 +62,43 @@ class AUTest(unittest.TestCase):
 
     self.fail('We managed to update when failure was expected')
 
-  def AttemptUpdateWithFilter(self, update_filter, proxy_port=8081):
-    """Update through a proxy, with a specified filter, and expect success."""
+  def AttemptUpdateWithFilter(self, update_filter):
+    """Update through a proxy, with a specified filter, and expect success.
+
+    Args:
+      update_filter: A cros_test_proxy.Filter, e.g. one of proxy_filters or a
+        cros_test_proxy.FilterChain of them to emulate a constrained network.
+    """
     target_image_path = self.worker.PrepareBase(self.target_image_path)
 
-    # We assume that devserver starts at the default port (8080), and start
-    # our proxy at a different one. We then tell our update tools to
-    # have the client connect to our proxy_port instead of the 8080.
-    proxy = cros_test_proxy.CrosTestProxy(
-        port_in=proxy_port,
-        address_out='127.0.0.1',
-        port_out=dev_server_wrapper.DEFAULT_PORT,
-        filter=update_filter
-    )
-    proxy.serve_forever_in_thread()
-    try:
-      self.worker.PerformUpdate(target_image_path, target_image_path,
-                                proxy_port=proxy_port)
-    finally:
-      proxy.shutdown()
+    # Start our proxy at a leased port in front of the devserver. We then
+    # tell our update tools to have the client connect to our proxy port
+    # instead of the devserver's.
+    with port_allocator.LeasePort(constants.PROXY_PORT_RANGE) as proxy_lease:
+      proxy = cros_test_proxy.CrosTestProxy(
+          port_in=proxy_lease.port,
+          address_out='127.0.0.1',
+          port_out=self.worker.devserver_port,
+          filter=update_filter
+      )
+      proxy.serve_forever_in_thread()
+      start = time.time()
+      try:
+        self.worker.PerformUpdate(target_image_path, target_image_path,
+                                  proxy_port=proxy_lease.port)
+      finally:
+        proxy.shutdown()
+        # Keep the transfer metrics of failed updates too, next to the logs of
+        # the update, without hiding why it failed.
+        metrics_file = os.path.join(self.worker.GetPhaseResultsPath(),
+                                    'proxy_metrics.json')
+        try:
+          proxy.DumpMetrics(metrics_file)
+        except (EnvironmentError, ValueError) as e:
+          logging.warning('Could not write proxy metrics to %s: %s',
+                          metrics_file, e)
+      logging.info('Update through the proxy took %.1f seconds.',
+                   time.time() - start)
 
   # --- UNITTEST SPECIFIC METHODS ---
 
@@ -102,7 +122,7 @@ class AUTest(unittest.TestCase):
     This test checks that we can update by updating the stateful partition
     rather than wiping it.
     """
-    self.worker.Initialize(9222)
+    self.worker.Initialize()
     # Just make sure some tests pass on original image.  Some old images
     # don't pass many tests.
     base_image_path = self.worker.PrepareBase(self.base_image_path)
@@ -121,7 +141,7 @@ class AUTest(unittest.TestCase):
     This test checks that we can update successfully after wiping the
     stateful partition.
     """
-    self.worker.Initialize(9223)
+    self.worker.Initialize()
     # Just make sure some tests pass on original image.  Some old images
     # don't pass many tests.
     base_image_path = self.worker.PrepareBase(self.base_image_path)
@@ -165,12 +185,12 @@ class AUTest(unittest.TestCase):
         self.data_size += len(data)
         return data
 
-    self.worker.Initialize(9224)
-    self.AttemptUpdateWithFilter(InterruptionFilter(), proxy_port=8082)
+    self.worker.Initialize()
+    self.AttemptUpdateWithFilter(InterruptionFilter())
 
   def testSimpleSignedUpdate(self):
     """Test that updates to itself with a signed payload."""
-    self.worker.Initialize(9226)
+    self.worker.Initialize()
     signed_target_image_path = self.worker.PrepareBase(self.target_image_path,
                                                        signed_base=True)
     if self.payload_signing_key:
@@ -186,7 +206,7 @@ class AUTest(unittest.TestCase):
     We explicitly don't use test prefix so that isn't run by default.  Can be
     run using test_prefix option.
     """
-    self.worker.Initialize(9227)
+    self.worker.Initialize()
     target_image_path = self.worker.PrepareBase(self.target_image_path)
     self.worker.PerformUpdate(target_image_path, target_image_path)
     self.assertTrue(self.worker.VerifyImage(self))
@@ -197,20 +217,20 @@ class AUTest(unittest.TestCase):
     We explicitly don't use test prefix so that isn't run by default.  Can be
     run using test_prefix option.
     """
-    self.worker.Initialize(9228)
+    self.worker.Initialize()
     self.worker.PrepareBase(self.target_image_path)
     self.assertTrue(self.worker.VerifyImage(self))
 
   # --- DISABLED TESTS ---
 
   def NoTestDelayedUpdate(self):
-    """Tests what happens if some data is delayed during update delivery."""
+    """Tests updating over a slow, lossy network that stalls a few times."""
 
-    class DelayedFilter(cros_test_proxy.Filter):
-      """Causes intermittent delays in data transmission.
+    class StallFilter(cros_test_proxy.Filter):
+      """Causes intermittent stalls in data transmission.
 
-      It does this by inserting 3 20 second delays when transmitting
-      data after 2M has been sent.
+      It does this by holding the first 3 packets sent after 2M of each
+      connection for 20 seconds.
       """
 
       def setup(self):
@@ -218,30 +238,35 @@ class AUTest(unittest.TestCase):
         self.data_size = 0
         self.delay_count = 0
 
-      # The first three packets after we reach 2M transferred
-      # are delayed by 20 seconds.
-      def OutBound(self, data):
+      # Overriden method. Delays data without blocking other connections.
+      def OutBoundDelay(self, size):
+        delay = 0
         if self.delay_count < 3:
           if self.data_size > (2 * 1024 * 1024):
             self.delay_count += 1
-            time.sleep(20)
+            delay = 20
 
-        self.data_size += len(data)
-        return data
+        self.data_size += size
+        return delay
 
-    self.worker.Initialize(9225)
-    self.AttemptUpdateWithFilter(DelayedFilter(), proxy_port=8083)
+    self.worker.Initialize()
+    self.AttemptUpdateWithFilter(cros_test_proxy.FilterChain([
+        proxy_filters.BandwidthFilter(8 * 1000 * 1000),
+        proxy_filters.LatencyFilter(0.05, jitter=0.01),
+        proxy_filters.LossFilter(0.001),
+        StallFilter(),
+    ]))
 
   def NotestPlatformToolchainOptions(self):
     """Tests the hardened toolchain options."""
-    self.worker.Initialize(9229)
+    self.worker.Initialize()
     self.worker.PrepareBase(self.base_image_path)
     self.assertTrue(self.worker.VerifyImage('platform_ToolchainOptions'))
 
   # TODO(sosa): Get test to work with verbose.
   def NotestPartialUpdate(self):
     """Tests what happens if we attempt to update with a truncated payload."""
-    self.worker.Initialize(9230)
+    self.worker.Initialize()
     # Preload with the version we are trying to test.
     self.worker.PrepareBase(self.target_image_path)
 
@@ -260,7 +285,7 @@ class AUTest(unittest.TestCase):
   # TODO(sosa): Get test to work with verbose.
   def NotestCorruptedUpdate(self):
     """Tests what happens if we attempt to update with a corrupted payload."""
-    self.worker.Initialize(9231)
+    self.worker.Initialize()
     # Preload with the version we are trying to test.
     self.worker.PrepareBase(self.target_image_path)
 
@@ -9,20 +9,28 @@ and validating updates on a target.  This should be subclassed to handle
 various types of target.  Types of targets include VM's, real devices, etc.
 """
 
+import collections
 import inspect
 import os
+import time
 
-from chromite.lib import cros_build_lib
+import constants
 from chromite.lib import cros_logging as logging
 from chromite.lib import dev_server_wrapper
 from chromite.lib import path_util
+from crostestutils.au_test_harness import test_that_results
 from crostestutils.au_test_harness import update_exception
+from crostestutils.au_test_harness import update_output
+from crostestutils.lib import port_allocator
 
 
 class AUWorker(object):
   """Interface for a worker that updates and verifies images."""
-  # Mapping between cached payloads to directory locations.
+  # Mapping between cached payloads to directory locations, usually a
+  # payload_manifest.PayloadManifest.
   update_cache = None
+  # Port of the devserver serving the payloads of |update_cache|.
+  devserver_port = dev_server_wrapper.DEFAULT_PORT
 
   # --- INTERFACE ---
 
@@ -40,9 +48,24 @@ class AUWorker(object):
     else:
       self.verify_suite = 'suite:%s' % (options.verify_suite_name or 'smoke')
     self.ssh_private_key = options.ssh_private_key
+    self._port_lease = None
+    # Seconds spent in each phase of the test, by label, and the label and
+    # start time of the current phase.
+    self.phase_seconds = collections.OrderedDict()
+    self._phase = None
+    # Results directory of the current phase, if it has one.
+    self._phase_results_dir = None
 
   def CleanUp(self):
-    """Called at the end of every test."""
+    """Called at the end of every test.
+
+    Subclasses overriding this method must call it once they are done with
+    the resources leased by Initialize.
+    """
+    self._StartPhase(None)
+    if self._port_lease:
+      self._port_lease.Release()
+      self._port_lease = None
 
   def GetUpdateMessage(self, update_target, update_base, from_vm, proxy):
     """Returns the update message that should be printed out for this update."""
@@ -109,7 +132,8 @@ class AUWorker(object):
         the empty string the code will use self.verify_suite.
 
     Returns:
-      Returns the percent that passed.
+      A test_that_results.VerificationResult, which is true if the image was
+      verified.
     """
 
   # --- INTERFACE TO AU_TEST ---
@@ -146,6 +170,11 @@ class AUWorker(object):
     """Sets the global update cache for getting paths to devserver payloads."""
     cls.update_cache = update_cache
 
+  @classmethod
+  def SetDevServerPort(cls, port):
+    """Sets the global port of the devserver serving the update cache."""
+    cls.devserver_port = port
+
   # --- METHODS FOR SUB CLASS USE ---
 
   def PrepareRealBase(self, image_path, signed_base):
@@ -195,7 +224,7 @@ class AUWorker(object):
     cache_path = self.update_cache.get(update_id)
     if cache_path:
       update_url = dev_server_wrapper.DevServerWrapper.GetDevServerURL(
-          port=proxy_port, sub_dir=cache_path)
+          port=proxy_port or self.devserver_port, sub_dir=cache_path)
       cmd.append('--update_url=%s' % update_url)
     else:
       raise update_exception.UpdateException(
@@ -204,65 +233,95 @@ class AUWorker(object):
   def RunUpdateCmd(self, cmd, log_directory=None):
     """Runs the given update cmd given verbose options.
 
-    Raises an update_exception.UpdateException if the update fails.
+    The output is streamed to update.log in |log_directory|, or to stdout if
+    verbose, and only its tail is kept to report a failure. The progress of
+    the update is reported as it goes.
+
+    Raises an update_exception.UpdateException, whose output is the tail of
+    the output, if the update fails.
 
     Args:
       cmd:  The shell cmd to run.
       log_directory:  Where to store the logs for this cmd.
     """
-    kwds = dict(print_cmd=False, combine_stdout_stderr=True, error_code_ok=True)
-    if not self.verbose:
-      kwds['redirect_stdout'] = kwds['redirect_stderr'] = True
+    log_file = None
     if log_directory:
-      kwds['log_stdout_to_file'] = os.path.join(log_directory, 'update.log')
-    result = cros_build_lib.RunCommand(cmd, **kwds)
-    if result.returncode != 0:
-      logging.warning(result.output)
-      raise update_exception.UpdateException(result.returncode, 'Update failed')
-
-  def AssertEnoughTestsPassed(self, unittest, output, percent_required_to_pass):
+      log_file = os.path.join(log_directory, 'update.log')
+    returncode, output = update_output.RunUpdateCommand(
+        cmd, log_file=log_file, echo=self.verbose,
+        progress_callback=lambda progress: self.TestInfo(
+            'Update progress: %d%%' % progress))
+    if returncode != 0:
+      tail = output.GetTail()
+      logging.warning(tail)
+      raise update_exception.UpdateException(returncode,
+                                             'Update failed:\n%s' % tail)
+
+  def AssertEnoughTestsPassed(self, unittest, result, percent_required_to_pass):
     """Helper function that asserts a sufficient number of tests passed.
 
     Args:
       unittest: the unittest object running this test.
-      output: stdout from a test run.
+      result: test_that_results.VerificationResult of a test run.
       percent_required_to_pass: percentage required to pass.  This should be
         fall between 0-100.
     Returns:
-      percent that passed.
+      |result|, passed if enough tests passed.
     """
-    percent_passed = self.ParseGeneratedTestOutput(output)
     self.TestInfo('Percent passed: %d vs. Percent required: %d' % (
-        percent_passed, percent_required_to_pass))
-    if percent_passed < percent_required_to_pass:
-      print output
+        result.percent_passed, percent_required_to_pass))
+    result.passed = result.percent_passed >= percent_required_to_pass
+    if not result.passed:
+      print result.Summary()
       unittest.fail('%d percent of tests are required to pass' %
                     percent_required_to_pass)
 
-    return percent_passed
+    return result
 
   def TestInfo(self, message):
     logging.info('%s: %s', self.test_name, message)
 
-  def Initialize(self, port):
+  def Initialize(self, port=None):
     """Initializes test specific variables for each test.
 
-    Each test needs to specify a unique ssh port.
+    Each test needs a unique ssh port, which is leased until CleanUp unless
+    given. The VM pid file is named after it.
 
     Args:
-      port:  Unique port for ssh access.
+      port:  Unique port for ssh access. If None, a free port is leased.
     """
     # Initialize port vars.
+    if port is None:
+      self._port_lease = port_allocator.LeasePort(constants.SSH_PORT_RANGE)
+      port = self._port_lease.port
     self._ssh_port = port
     self._kvm_pid_file = '/tmp/kvm.%d' % port
 
-    # Initialize test results directory.
-    self.test_name = inspect.stack()[1][3]
+    # Initialize test results directory. Tests are named after the test method
+    # calling Initialize, possibly through subclass overrides.
+    self.test_name = next(frame[3] for frame in inspect.stack()[1:]
+                          if frame[3] != 'Initialize')
     self.all_results_directory = os.path.join(self.all_results_root,
                                               self.test_name)
     self.fail_results_directory = os.path.join(self.fail_results_root,
                                                self.test_name)
     self.results_count = 0
+    # Preparing the base image is the first phase of every test.
+    self._StartPhase('prepare')
+
+  def _StartPhase(self, label):
+    """Ends the current phase and starts phase |label|, unless None.
+
+    A phase lasts until the next one starts, so the phases of a test add up to
+    its duration. Repeated phases add up under the same label.
+    """
+    now = time.time()
+    self._phase_results_dir = None
+    if self._phase:
+      current, start = self._phase
+      self.phase_seconds[current] = (self.phase_seconds.get(current, 0) +
+                                     now - start)
+    self._phase = (label, now) if label else None
 
   def GetNextResultsPath(self, label):
     """Returns a tuple results directories to use for this label.
@@ -281,6 +340,7 @@ class AUWorker(object):
       Returns a path for the results directory to use for this label.
     """
     self.results_count += 1
+    self._StartPhase(label)
     results_dir = os.path.join(self.all_results_directory, '%s_%s' % (
         self.results_count, label))
     fail_dir = os.path.join(self.fail_results_directory, '%s_%s' % (
@@ -288,23 +348,47 @@ class AUWorker(object):
     if not os.path.exists(results_dir):
       os.makedirs(results_dir)
 
+    self._phase_results_dir = results_dir
     return results_dir, fail_dir
 
-  def ParseGeneratedTestOutput(self, output):
-    """Returns the percentage of tests that passed based on output.
+  def GetPhaseResultsPath(self):
+    """Returns the results directory of the current phase.
 
-    Args:
-      output: Output string for generate_test_report.py.
-    Returns:
-      The percentage of tests that passed.
+    Phases without one, e.g. updates of real devices, which only log to
+    stdout, use the results directory of the test.
     """
-    percent_passed = 0
-    lines = output.split('\n')
+    if self._phase_results_dir:
+      return self._phase_results_dir
+    if not os.path.exists(self.all_results_directory):
+      os.makedirs(self.all_results_directory)
+    return self.all_results_directory
+
+  def RunTestCommand(self, cmd, log_file, enter_chroot=False):
+    """Runs the test_that |cmd|, parsing its output as it is printed.
 
-    for line in lines:
-      if line.startswith('Total PASS:'):
-        # FORMAT: ^TOTAL PASS: num_passed/num_total (percent%)$
-        percent_passed = line.split()[3].strip('()%')
-        break
+    The output is logged to |log_file| and parsed a line at a time, so the
+    result of each test is reported as soon as it finishes and verbose
+    outputs are never held in memory.
 
-    return int(percent_passed)
+    Args:
+      cmd: The test_that command to run, from CROSUTILS_DIR.
+      log_file: File to log the output to. test_that recreates its results
+        directory, so it must be outside of it.
+      enter_chroot: Whether to run |cmd| inside the chroot.
+    Returns:
+      A tuple of the return code of |cmd| and its
+      test_that_results.VerificationResult.
+    """
+    parser = test_that_results.TestThatParser()
+
+    def _ParseLine(line):
+      test = parser.ParseLine(line)
+      if test:
+        self.TestInfo(str(test))
+
+    returncode, _ = update_output.RunUpdateCommand(
+        cmd, log_file=log_file, cwd=constants.CROSUTILS_DIR,
+        enter_chroot=enter_chroot, line_callback=_ParseLine)
+    result = parser.GetResult()
+    result.log_file = log_file
+    return returncode, result
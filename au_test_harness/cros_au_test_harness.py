@@ -13,11 +13,14 @@
 """
 
 import functools
+import multiprocessing
 import optparse
 import os
-import pickle
+import Queue
+import signal
 import sys
 import tempfile
+import time
 import unittest
 
 import constants
@@ -33,10 +36,23 @@ from chromite.lib import sudo
 from chromite.lib import timeout_util
 from crostestutils.au_test_harness import au_test
 from crostestutils.au_test_harness import au_worker
+from crostestutils.au_test_harness import failure_archiver
+from crostestutils.au_test_harness import real_au_worker
+from crostestutils.au_test_harness import shared_devserver
+from crostestutils.au_test_harness import test_history
+from crostestutils.au_test_harness import test_sharding
+from crostestutils.lib import admission_control
+from crostestutils.lib import payload_manifest
+from crostestutils.lib import port_allocator
 from crostestutils.lib import test_helper
 
-# File location for update cache in given folder.
-CACHE_FILE = 'update.cache'
+
+# Seconds between checks of fail-fast test processes that exited unexpectedly.
+_FAIL_FAST_POLL_SECONDS = 5
+
+
+class TestCancelled(Exception):
+  """Raised in a test when --fail_fast cancels it."""
 
 
 class _LessBacktracingTestResult(unittest._TextTestResult):
@@ -76,17 +92,16 @@ class _LessBacktracingTestRunner(unittest.TextTestRunner):
 
 
 def _ReadUpdateCache(dut_type, target_image):
-  """Reads update cache from generate_test_payloads call."""
+  """Opens the payload manifest from generate_test_payloads call."""
   # TODO(wonderfly): Figure out how to use update cache for GCE images.
   if dut_type == 'gce':
     return None
-  path_to_dump = os.path.dirname(target_image)
-  cache_file = os.path.join(path_to_dump, CACHE_FILE)
+  manifest_file = os.path.join(os.path.dirname(target_image),
+                               payload_manifest.MANIFEST_FILE)
 
-  if os.path.exists(cache_file):
-    logging.info('Loading update cache from ' + cache_file)
-    with open(cache_file) as file_handle:
-      return pickle.load(file_handle)
+  if os.path.exists(manifest_file):
+    logging.info('Loading payload manifest from ' + manifest_file)
+    return payload_manifest.PayloadManifest(manifest_file)
 
   return None
 
@@ -99,20 +114,182 @@ def _PrepareTestSuite(options):
   return test_loader.loadTestsFromTestCase(au_test.AUTest)
 
 
-def _RunTestsInParallel(options):
-  """Runs the tests given by the options in parallel."""
-  test_suite = _PrepareTestSuite(options)
-  steps = []
-  for test in test_suite:
-    test_name = test.id()
-    test_case = unittest.TestLoader().loadTestsFromName(test_name)
-    steps.append(functools.partial(_LessBacktracingTestRunner().run, test_case))
+def _GetTestHistory(options):
+  """Returns the test_history.TestHistory of the suite given by the options."""
+  return test_history.TestHistory(options.test_history_file,
+                                  '%s/%s' % (options.board, options.type))
+
+
+def _GetShardTests(options):
+  """Returns the ids of the tests of this shard and the digest of the split."""
+  test_ids = [test.id() for test in _PrepareTestSuite(options)]
+  # The split must not depend on the history of this host, which differs
+  # between the hosts of the shards.
+  history = None
+  if options.shard_history_file:
+    history = test_history.TestHistory(options.shard_history_file,
+                                       '%s/%s' % (options.board, options.type))
+  shards = test_sharding.SplitTests(test_ids, options.total_shards, history)
+  return shards[options.shard_index], test_sharding.GetSplitDigest(shards)
+
+
+def _RunTest(test_id):
+  """Runs a single test and returns a dict with its status and durations."""
+  test_case = unittest.TestLoader().loadTestsFromName(test_id)
+  start_time = time.time()
+  status = test_sharding.PASS
+  try:
+    _LessBacktracingTestRunner().run(test_case)
+  except (parallel.BackgroundFailure, timeout_util.TimeoutError) as ex:
+    logging.error('%s failed: %s', test_id, ex)
+    status = test_sharding.FAIL
+
+  phases = {}
+  for test in test_case:
+    if getattr(test, 'worker', None):
+      phases.update(test.worker.phase_seconds)
+  return dict(status=status, seconds=time.time() - start_time, phases=phases)
+
+
+def _RunCancellableTest(test_id, results_queue):
+  """Runs a test in a fail-fast process and puts its result in the queue.
+
+  SIGTERM cancels the test by raising TestCancelled in it, so that its
+  tearDown still runs and the worker's CleanUp kills its VM.
+  """
+  cancelled = []
+  def _Cancel(signum, _frame):
+    # Do not interrupt the cleanup of the test as well.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    cancelled.append(signum)
+    raise TestCancelled('Cancelled by --fail_fast.')
+
+  signal.signal(signal.SIGTERM, _Cancel)
+  result = _RunTest(test_id)
+  if cancelled:
+    result['status'] = test_sharding.CANCELLED
+  results_queue.put((test_id, result))
+
+
+def _RunTestsFailFast(test_ids, jobs):
+  """Runs tests in up to |jobs| processes until the first one fails.
+
+  Once a test fails, the tests still running are cancelled and the others
+  are not started.
+
+  Returns:
+    A list of the results of |test_ids|, in order.
+  """
+  results_queue = multiprocessing.Queue()
+  pending = list(reversed(test_ids))
+  running = {}
+  results = {}
+  cancelled = False
+
+  def _Record(test_id, result):
+    running.pop(test_id).join()
+    results[test_id] = result
+    logging.info('%s: %s in %d seconds (%d of %d tests done).', test_id,
+                 result['status'], result['seconds'], len(results),
+                 len(test_ids))
 
-  logging.info('Running tests in test suite in parallel.')
   try:
-    parallel.RunParallelSteps(steps, max_parallel=options.jobs)
-  except parallel.BackgroundFailure as ex:
-    cros_build_lib.Die(ex)
+    while pending or running:
+      while pending and len(running) < jobs:
+        test_id = pending.pop()
+        running[test_id] = multiprocessing.Process(
+            target=_RunCancellableTest, args=(test_id, results_queue))
+        running[test_id].start()
+
+      try:
+        _Record(*results_queue.get(timeout=_FAIL_FAST_POLL_SECONDS))
+      except Queue.Empty:
+        # Results are flushed before their process exits, so processes found
+        # dead after a last check of the queue exited without a result.
+        dead = [test_id for test_id, proc in running.iteritems()
+                if not proc.is_alive()]
+        while True:
+          try:
+            _Record(*results_queue.get_nowait())
+          except Queue.Empty:
+            break
+        for test_id in dead:
+          if test_id in running:
+            _Record(test_id, dict(
+                status=test_sharding.CANCELLED if cancelled else
+                test_sharding.FAIL, seconds=0, phases={}))
+
+      if not cancelled and any(result['status'] != test_sharding.PASS
+                               for result in results.itervalues()):
+        cancelled = True
+        logging.error('A test failed; cancelling %d running tests and skipping '
+                      '%d others.', len(running), len(pending))
+        for test_id in reversed(pending):
+          results[test_id] = dict(status=test_sharding.CANCELLED, seconds=0,
+                                  phases={})
+        pending = []
+        for proc in running.itervalues():
+          os.kill(proc.pid, signal.SIGTERM)
+  finally:
+    # Let tests cancelled by an error of the harness itself clean up too.
+    for proc in running.itervalues():
+      if proc.is_alive():
+        proc.terminate()
+      proc.join()
+
+  return [results[test_id] for test_id in test_ids]
+
+
+def _RunTests(options, in_parallel):
+  """Runs the tests of this shard and writes a summary of their results.
+
+  Args:
+    options: Parsed options.
+    in_parallel: Whether to run up to --jobs tests in parallel.
+
+  Returns:
+    Whether all tests passed. With --fail_fast, the run stops at the first
+    failure and the summary has the results of the tests run so far.
+  """
+  test_ids, split_digest = _GetShardTests(options)
+  history = _GetTestHistory(options)
+  # Long tests started last would be the tail of the run.
+  test_ids = history.SortLongestFirst(test_ids,
+                                      test_sharding.DEFAULT_TEST_SECONDS)
+  predicted_seconds = test_history.PredictSeconds(
+      [history.EstimateSeconds(test_id, test_sharding.DEFAULT_TEST_SECONDS)
+       for test_id in test_ids],
+      options.jobs if in_parallel else 1)
+  unknown = [test_id for test_id in test_ids
+             if history.EstimateSeconds(test_id) is None]
+  logging.info('Running %d tests of shard %d of %d%s, predicted to take %d '
+               'minutes%s.', len(test_ids), options.shard_index,
+               options.total_shards, ' in parallel' if in_parallel else '',
+               predicted_seconds / 60,
+               ' (%d tests without history)' % len(unknown) if unknown else '')
+  start_time = time.time()
+  if options.fail_fast:
+    results = _RunTestsFailFast(test_ids, options.jobs if in_parallel else 1)
+  elif in_parallel:
+    steps = [functools.partial(_RunTest, test_id) for test_id in test_ids]
+    results = parallel.RunParallelSteps(steps, max_parallel=options.jobs,
+                                        return_values=True)
+  else:
+    results = [_RunTest(test_id) for test_id in test_ids]
+
+  logging.info('Tests took %d minutes, predicted %d.',
+               (time.time() - start_time) / 60, predicted_seconds / 60)
+
+  results = dict(zip(test_ids, results))
+  # Tests that fail often do so early, so only passes are representative.
+  for test_id, result in results.iteritems():
+    if result['status'] == test_sharding.PASS:
+      history.Record(test_id, result['seconds'], phases=result['phases'])
+
+  test_sharding.WriteSummary(options.test_results_root, options.shard_index,
+                             options.total_shards, split_digest, results)
+  return all(result['status'] == test_sharding.PASS
+             for result in results.itervalues())
 
 
 def CheckOptions(parser, options, leftover_args):
@@ -153,6 +330,26 @@ def CheckOptions(parser, options, leftover_args):
   if options.ssh_private_key and not os.path.isfile(options.ssh_private_key):
     parser.error('Testing requires a valid path to the ssh private key.')
 
+  if options.type == 'real' and options.remote:
+    # Tests beyond the number of devices would only wait for a device.
+    options.jobs = min(options.jobs,
+                       len(real_au_worker.GetRemotes(options)))
+
+  if options.total_shards < 1:
+    parser.error('There must be at least one shard.')
+
+  if not 0 <= options.shard_index < options.total_shards:
+    parser.error('Shard index must be between 0 and --total_shards - 1.')
+
+  if options.shard_history_file:
+    if not os.path.isfile(options.shard_history_file):
+      parser.error('Shard history file %s does not exist.' %
+                   options.shard_history_file)
+    if (os.path.realpath(options.shard_history_file) ==
+        os.path.realpath(options.test_history_file)):
+      parser.error('The shard history file must not be updated by runs; '
+                   'pass a copy of the test history file.')
+
   if options.test_results_root:
     if not 'chroot/tmp' in options.test_results_root:
       parser.error('Must specify a test results root inside tmp in a chroot.')
@@ -185,7 +382,9 @@ def main():
   parser.add_option('-q', '--quick_test', default=False, action='store_true',
                     help='Use a basic test to verify image.')
   parser.add_option('-m', '--remote',
-                    help='Remote address for real test.')
+                    help='Remote address for real test, or comma-separated '
+                    'addresses of a pool of identical devices to run tests '
+                    'on in parallel, one test per device.')
   parser.add_option('-t', '--target_image',
                     help='path to the target image.')
   parser.add_option('--test_results_root', default=None,
@@ -208,6 +407,42 @@ def main():
                     action='store_true',
                     help='Run multiple test stages in parallel (applies only '
                          'to vm tests). Default: False')
+  parser.add_option('--vm_snapshots', default=False, action='store_true',
+                    help='Boot every base VM image once, snapshot it once ssh '
+                    'is ready, and start the VM of every test from the '
+                    'snapshot instead of booting it. VMs started from '
+                    'snapshots have no graphics.')
+  parser.add_option('--total_shards', default=1, type=int,
+                    help='Number of harness processes, usually on different '
+                    'hosts, the tests are split over. Default: %default.')
+  parser.add_option('--shard_index', default=0, type=int,
+                    help='Index of the shard of tests this process runs, '
+                    'from 0 to --total_shards - 1. Default: %default.')
+  parser.add_option('--test_history_file',
+                    default=constants.AU_TEST_HISTORY_FILE,
+                    help='Durations of tests recorded by runs on this host, '
+                    'used to run the longest tests first. Default: %default.')
+  parser.add_option('--shard_history_file',
+                    help='Durations of tests used to balance shards, e.g. a '
+                    'copy of a test history file. It is only read, and all '
+                    'shards of a run must be given the same file. Without '
+                    'it, tests are split round-robin.')
+  parser.add_option('--shared_devserver', default=False, action='store_true',
+                    help='Use the devserver shared by all harness runs on '
+                    'this checkout, starting it if needed, instead of '
+                    'starting one for this run. Either way the devserver '
+                    'port is leased from %s. Its logs are in %s.' %
+                    (constants.DEVSERVER_PORT_RANGE,
+                     constants.SHARED_DEVSERVER_DIR))
+  parser.add_option('--devserver_idle_timeout',
+                    default=constants.SHARED_DEVSERVER_IDLE_TIMEOUT, type=int,
+                    help='Seconds without any run using it after which a '
+                    'shared devserver started by this run is stopped. '
+                    'Default: %default.')
+  parser.add_option('--fail_fast', default=False, action='store_true',
+                    help='Stop at the first failed test: cancel the tests '
+                    'running, which still kill their VMs, skip the others and '
+                    'report the results so far.')
   parser.add_option('--ssh_private_key', default=None,
                     help='Path to the private key to use to ssh into the image '
                     'as the root user.')
@@ -228,30 +463,43 @@ def main():
   if not os.path.exists(download_folder):
     os.makedirs(download_folder)
 
+  # Only the first VM of the run may start on a busy host.
+  admission_control.StartRun()
   with sudo.SudoKeepAlive():
     au_worker.AUWorker.SetUpdateCache(update_cache)
     my_server = None
+    port_lease = None
     try:
-      # Only start a devserver if we'll need it.
-      if update_cache:
+      # Only start a devserver if we'll need it. Its port is leased, so that
+      # it does not conflict with the devservers of other checkouts.
+      if update_cache and options.shared_devserver:
+        my_server = shared_devserver.SharedDevServer(
+            idle_timeout=options.devserver_idle_timeout)
+        my_server.Start()
+        au_worker.AUWorker.SetDevServerPort(my_server.port)
+      elif update_cache:
+        port_lease = port_allocator.LeasePort(constants.DEVSERVER_PORT_RANGE)
         my_server = dev_server_wrapper.DevServerWrapper(
-            port=dev_server_wrapper.DEFAULT_PORT,
-            log_dir=options.test_results_root)
+            port=port_lease.port, log_dir=options.test_results_root)
         my_server.Start()
-
-      if options.type == 'vm' or options.type == 'gce' and options.parallel:
-        _RunTestsInParallel(options)
-      else:
-        # TODO(sosa) - Take in a machine pool for a real test.
-        # Can't run in parallel with only one remote device.
-        test_suite = _PrepareTestSuite(options)
-        test_result = unittest.TextTestRunner().run(test_suite)
-        if not test_result.wasSuccessful():
-          cros_build_lib.Die('Test harness failed.')
+        au_worker.AUWorker.SetDevServerPort(port_lease.port)
+
+      # Real devices run one test at a time, so they only run in parallel
+      # with a pool of devices.
+      in_parallel = (options.type == 'vm' or
+                     options.type == 'gce' and options.parallel or
+                     options.type == 'real' and options.jobs > 1)
+      passed = _RunTests(options, in_parallel)
+      # The results are complete once failed tests are archived.
+      failure_archiver.WaitForArchivers(options.test_results_root)
+      if not passed:
+        cros_build_lib.Die('Test harness failed. See logs for details.')
 
     finally:
       if my_server:
         my_server.Stop()
+      if port_lease:
+        port_lease.Release()
 
 
 if __name__ == '__main__':
@@ -6,20 +6,26 @@
 
 """Tests module containing unittests for cros_au_test_harness.py.
 
-Instead of calling to functions/methods in cros_au_test_harness, tests defined
-here use its binary version, to mimic the behavior of ctest.
+Option checks call its binary version, to mimic the behavior of ctest. The
+fail-fast runner is called directly, running fake tests.
 """
 
 from __future__ import print_function
 
 import os
 import sys
+import time
 import unittest
 
 import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
 sys.path.append(constants.SOURCE_ROOT)
 
 from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.au_test_harness import cros_au_test_harness
+from crostestutils.au_test_harness import test_sharding
 
 
 class CrosAuTestHarnessTest(unittest.TestCase):
@@ -51,5 +57,77 @@ class CrosAuTestHarnessTest(unittest.TestCase):
     self.assertNotIn(self.INVALID_TYPE_ERROR, cm.exception.result.error)
 
 
+def _RunFakeTest(test_id, started_dir):
+  """Runs the fake test |test_id| in place of cros_au_test_harness._RunTest.
+
+  The test records that it started in |started_dir|, then does what its name
+  says: 'pass' and 'fail' return their status, 'slow' runs until cancelled,
+  'exit' exits without a result, and 'exit-on-cancel' does so once cancelled.
+  The id of the test is returned as its only phase.
+  """
+  name = test_id.split('.')[0]
+  osutils.Touch(os.path.join(started_dir, test_id))
+  status = test_sharding.PASS
+  try:
+    if name == 'fail':
+      # Let the tests started along with it start too.
+      time.sleep(0.2)
+      status = test_sharding.FAIL
+    elif name == 'exit':
+      os._exit(1)
+    elif name in ('slow', 'exit-on-cancel'):
+      time.sleep(60)
+    elif name == 'pass':
+      time.sleep(float(test_id.partition('.')[2] or 0))
+  except cros_au_test_harness.TestCancelled:
+    # Like unittest, which records the error of the cancelled test.
+    if name == 'exit-on-cancel':
+      os._exit(1)
+  return dict(status=status, seconds=0, phases={test_id: 0})
+
+
+class RunTestsFailFastTest(cros_test_lib.TempDirTestCase):
+  """Tests running tests until the first failure."""
+
+  def setUp(self):
+    self._Patch(cros_au_test_harness, '_RunTest',
+                lambda test_id: _RunFakeTest(test_id, self.tempdir))
+    self._Patch(cros_au_test_harness, '_FAIL_FAST_POLL_SECONDS', 0.1)
+
+  def _Patch(self, obj, name, value):
+    """Replaces |obj|.|name| with |value| for the duration of the test."""
+    self.addCleanup(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+  def _Run(self, test_ids, jobs):
+    """Returns the statuses of |test_ids| run in up to |jobs| processes."""
+    results = cros_au_test_harness._RunTestsFailFast(test_ids, jobs)
+    return [result['status'] for result in results]
+
+  def testFirstFailureCancels(self):
+    """Tests that a failure cancels running tests and skips pending ones."""
+    self.assertEqual(
+        [test_sharding.CANCELLED, test_sharding.FAIL,
+         test_sharding.CANCELLED],
+        self._Run(['slow', 'fail', 'pass'], 2))
+    self.assertEqual(['fail', 'slow'], sorted(os.listdir(self.tempdir)))
+
+  def testExitWithoutResult(self):
+    """Tests tests exiting without a result, before and after cancelling."""
+    self.assertEqual([test_sharding.FAIL, test_sharding.CANCELLED],
+                     self._Run(['exit', 'slow'], 2))
+    self.assertEqual([test_sharding.FAIL, test_sharding.CANCELLED],
+                     self._Run(['fail', 'exit-on-cancel'], 2))
+
+  def testResultsInOrder(self):
+    """Tests that results are returned in the order of the test ids."""
+    test_ids = ['pass.0.5', 'pass.0.2', 'pass.0', 'pass.0.1']
+    results = cros_au_test_harness._RunTestsFailFast(test_ids, 3)
+    self.assertEqual(test_ids, [result['phases'].keys()[0]
+                                for result in results])
+    self.assertEqual([test_sharding.PASS] * 4,
+                     [result['status'] for result in results])
+
+
 if __name__ == '__main__':
   unittest.main()
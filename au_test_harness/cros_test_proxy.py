@@ -2,13 +2,49 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Module containing classes pertaining to inserting a proxy in a test."""
-
+"""Module containing classes pertaining to inserting a proxy in a test.
+
+The proxy runs all of its connections in a single event loop thread, using
+epoll where available and select elsewhere. Data is moved in chunks of up to
+buffer_size bytes. A direction whose filter method is not overridden is a pure
+passthrough: its data is received into a preallocated buffer and sent from it
+without creating Python strings or calling the filter.
+"""
+
+import collections
+import errno
+import json
 import os
 import select
 import socket
-import SocketServer
 import threading
+import time
+
+# Default size of the chunks proxied at once, and of the socket buffers.
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+# Default number of bytes held in each direction of a connection by filters
+# delaying data. Must exceed bandwidth x latency of the emulated network.
+DEFAULT_MAX_QUEUED_BYTES = 4 * 1024 * 1024
+
+_READ = select.POLLIN
+_WRITE = select.POLLOUT
+
+# Errors of non-blocking socket calls that only mean "try again later".
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+# Errors of a non-blocking connect that is still in progress.
+_CONNECTING_ERRNOS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR)
+
+# Seconds covered by each throughput sample of ConnectionMetrics.
+SAMPLE_SECONDS = 1.0
+
+# Reasons for closing a connection recorded in ConnectionMetrics.
+CLOSE_CLIENT_EOF = 'client_eof'
+CLOSE_SERVER_EOF = 'server_eof'
+CLOSE_FILTER = 'filter'
+CLOSE_ERROR = 'error'
+CLOSE_CONNECT_FAILED = 'connect_failed'
+CLOSE_SHUTDOWN = 'shutdown'
 
 
 class Filter(object):
@@ -37,84 +73,484 @@ class Filter(object):
     """
     return data
 
+  def GetChunkSize(self):
+    """Returns the largest packet to proxy at once, or None for no limit.
 
-class CrosTestProxy(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-  """A transparent proxy for simulating network errors"""
+       Called once per connection. Filters delaying data use smaller
+       packets to delay it more evenly.
+    """
+    return None
 
-  class _Handler(SocketServer.BaseRequestHandler):
-    """Proxy connection handler that passes data though a filter"""
-
-    def setup(self):
-      """Setup is called once for each connection proxied."""
-      self.server.filter.setup()
-
-    def handle(self):
-      """Handles each incoming connection.
-
-         Opens a new connection to the port we are proxing to, then
-         passes each packet along in both directions after passing
-         them through the filter object passed in.
-      """
-      # Open outgoing socket
-      s_in = self.request
-      s_out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      s_out.connect((self.server.address_out, self.server.port_out))
-
-      while True:
-        rlist, wlist, xlist = select.select([s_in, s_out], [], [])
-
-        if s_in in rlist:
-          data = s_in.recv(1024)
-          data = self.server.filter.InBound(data)
-          if not data: break
-          try:
-            # If there is any error sending data, close both connections.
-            s_out.sendall(data)
-          except socket.error:
-            break
-
-        if s_out in rlist:
-          data = s_out.recv(1024)
-          data = self.server.filter.OutBound(data)
-          if not data: break
-          try:
-            # If there is any error sending data, close both connections.
-            s_in.sendall(data)
-          except socket.error:
-            break
+  def InBoundDelay(self, size):
+    """Returns how many seconds to hold a packet of incoming data.
+
+       Called once per packet after InBound, with the size of the
+       packet it returned. Later packets are held until this one is
+       sent. Delaying data does not block the other connections.
+    """
+    return 0
+
+  def OutBoundDelay(self, size):
+    """Returns how many seconds to hold a packet of outgoing data.
+
+       See InBoundDelay.
+    """
+    return 0
+
+
+class FilterChain(Filter):
+  """Passes data through several filters in turn.
+
+     Packets are closed by any filter closing them, and held for the
+     sum of the delays of all filters.
+  """
+
+  def __init__(self, filters):
+    self.filters = list(filters)
+
+  def setup(self):
+    for f in self.filters:
+      f.setup()
+
+  def InBound(self, data):
+    for f in self.filters:
+      data = f.InBound(data)
+      if not data:
+        return None
+    return data
+
+  def OutBound(self, data):
+    for f in self.filters:
+      data = f.OutBound(data)
+      if not data:
+        return None
+    return data
+
+  def GetChunkSize(self):
+    sizes = [f.GetChunkSize() for f in self.filters if f.GetChunkSize()]
+    return min(sizes) if sizes else None
+
+  def InBoundDelay(self, size):
+    return sum(f.InBoundDelay(size) for f in self.filters)
+
+  def OutBoundDelay(self, size):
+    return sum(f.OutBoundDelay(size) for f in self.filters)
+
+
+def _IsOverridden(obj, name):
+  """Returns whether the Filter method |name| is overridden by |obj|."""
+  if isinstance(obj, FilterChain):
+    return any(_IsOverridden(f, name) for f in obj.filters)
+  method = getattr(type(obj), name)
+  base_method = getattr(Filter, name)
+  return method.__func__ is not base_method.__func__
+
+
+def _GetMethod(obj, name):
+  """Returns the Filter method |name| of |obj|, or None if not overridden."""
+  return getattr(obj, name) if _IsOverridden(obj, name) else None
+
+
+class _EpollPoller(object):
+  """Readiness notification for file descriptors using epoll."""
+
+  def __init__(self):
+    self._epoll = select.epoll()
+
+  def Register(self, fd, events):
+    self._epoll.register(fd, events)
+
+  def Modify(self, fd, events):
+    self._epoll.modify(fd, events)
+
+  def Unregister(self, fd):
+    self._epoll.unregister(fd)
+
+  def Poll(self, timeout=None):
+    """Returns a list of (fd, events) of the ready file descriptors."""
+    try:
+      ready = self._epoll.poll(-1 if timeout is None else timeout)
+    except IOError as e:
+      if e.errno == errno.EINTR:
+        return []
+      raise
+    # Errors and hang ups are reported as readable; reading reports them.
+    return [(fd, events | _READ if events & (select.EPOLLERR | select.EPOLLHUP)
+             else events) for fd, events in ready]
+
+  def Close(self):
+    self._epoll.close()
 
-      s_in.close()
-      s_out.close()
+
+class _SelectPoller(object):
+  """Readiness notification for file descriptors using select."""
+
+  def __init__(self):
+    self._fds = {}
+
+  def Register(self, fd, events):
+    self._fds[fd] = events
+
+  Modify = Register
+
+  def Unregister(self, fd):
+    del self._fds[fd]
+
+  def Poll(self, timeout=None):
+    """Returns a list of (fd, events) of the ready file descriptors."""
+    rlist = [fd for fd, events in self._fds.iteritems() if events & _READ]
+    wlist = [fd for fd, events in self._fds.iteritems() if events & _WRITE]
+    try:
+      rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+    ready = dict((fd, _READ) for fd in rlist)
+    for fd in wlist:
+      ready[fd] = ready.get(fd, 0) | _WRITE
+    return ready.items()
+
+  def Close(self):
+    self._fds.clear()
+
+
+class ConnectionMetrics(object):
+  """Transfer metrics of a connection through the proxy.
+
+  Outgoing data is counted when the proxy sends it to the client, so the
+  metrics include the delays added by the filter.
+
+  Attributes:
+    start: Time the connection was accepted, in seconds since the epoch.
+    end: Time the connection was closed, or None while it is open.
+    bytes_in: Bytes sent to the server.
+    bytes_out: Bytes sent to the client.
+    first_byte: Time the first byte was sent to the client, or None.
+    samples: Bytes sent to the client during each SAMPLE_SECONDS since start.
+    close_reason: One of the CLOSE_* constants, or None while open.
+    error: Message of the socket error that closed the connection, if any.
+  """
+
+  def __init__(self, start):
+    self.start = start
+    self.end = None
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.first_byte = None
+    self.samples = []
+    self.close_reason = None
+    self.error = None
+
+  def RecordSent(self, outbound, size, now):
+    """Records that |size| bytes were sent in one direction at |now|."""
+    if not outbound:
+      self.bytes_in += size
+      return
+
+    if self.first_byte is None:
+      self.first_byte = now
+    self.bytes_out += size
+    index = int((now - self.start) / SAMPLE_SECONDS)
+    if index >= len(self.samples):
+      self.samples.extend([0] * (index + 1 - len(self.samples)))
+    self.samples[index] += size
+
+  def SetCloseReason(self, reason, error=None):
+    """Records why the connection is closed, unless already recorded.
+
+    A connection starts closing when one side reaches EOF or the filter
+    closes it, which is the reason kept, and is closed once queued data
+    is sent.
+    """
+    if self.close_reason is None:
+      self.close_reason = reason
+      self.error = error
+
+  def ToDict(self):
+    """Returns the metrics as a dict that can be dumped as JSON."""
+    end = self.end or time.time()
+    result = dict(start=self.start, end=self.end,
+                  seconds=end - self.start,
+                  bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                  first_byte_seconds=None, bits_per_second_out=None,
+                  sample_seconds=SAMPLE_SECONDS,
+                  bytes_out_per_sample=list(self.samples),
+                  close_reason=self.close_reason, error=self.error)
+    if self.first_byte is not None:
+      result['first_byte_seconds'] = self.first_byte - self.start
+      if end > self.first_byte:
+        result['bits_per_second_out'] = (self.bytes_out * 8.0 /
+                                         (end - self.first_byte))
+    return result
+
+
+def _CreatePoller():
+  """Returns the best poller available on this platform."""
+  if hasattr(select, 'epoll'):
+    return _EpollPoller()
+  return _SelectPoller()
+
+
+class _Pipe(object):
+  """Moves data in one direction of a proxied connection.
+
+  Chunks read from the source are queued until their release time, as set by
+  the filter's delay method, and sent to the destination in order. Without a
+  delay method the source is only read once the previous chunk has been fully
+  sent.
+  """
+
+  def __init__(self, src, dst, data_method, delay_method, chunk_size,
+               max_queued_bytes, metrics, outbound):
+    """Initializes the pipe.
+
+    Args:
+      src: Socket to read data from.
+      dst: Socket to write data to.
+      data_method: Filter method to pass each chunk through, or None to pass
+        data through unchanged.
+      delay_method: Filter method returning how long to hold each chunk, or
+        None to send chunks right away.
+      chunk_size: Maximum number of bytes to read at once.
+      max_queued_bytes: Maximum number of bytes to hold when delaying chunks.
+      metrics: ConnectionMetrics to record the data sent in.
+      outbound: Whether the pipe moves data from the server to the client.
+    """
+    self.src = src
+    self.dst = dst
+    self._metrics = metrics
+    self._outbound = outbound
+    self._eof_reason = CLOSE_SERVER_EOF if outbound else CLOSE_CLIENT_EOF
+    self._data_method = data_method
+    self._delay_method = delay_method
+    self._chunk_size = chunk_size
+    self._max_queued_bytes = max_queued_bytes if delay_method else 1
+    self._buffer = None
+    if data_method is None and delay_method is None:
+      self._buffer = memoryview(bytearray(chunk_size))
+    # List of [release time, memoryview of the data] of queued chunks.
+    self._queue = collections.deque()
+    self._queued_bytes = 0
+
+  def IsEmpty(self):
+    """Returns whether all data read has been sent."""
+    return not self._queue
+
+  def CanRead(self):
+    """Returns whether there is room to queue another chunk."""
+    return self._queued_bytes < self._max_queued_bytes
+
+  def IsDue(self, now):
+    """Returns whether a queued chunk may be sent at |now|."""
+    return bool(self._queue) and self._queue[0][0] <= now
+
+  def GetReleaseTime(self):
+    """Returns when the next queued chunk may be sent, or None."""
+    return self._queue[0][0] if self._queue else None
+
+  def Read(self, now):
+    """Reads the next chunk from the source and queues it.
+
+    Returns:
+      None, or the CLOSE_* reason to close the connection for if the source is
+      at EOF or the filter closed the connection.
+    """
+    if self._buffer is not None:
+      size = self.src.recv_into(self._buffer, self._chunk_size)
+      if not size:
+        return self._eof_reason
+      self._Queue(now, self._buffer[:size])
+      return None
+
+    data = self.src.recv(self._chunk_size)
+    if not data:
+      return self._eof_reason
+    if self._data_method:
+      data = self._data_method(data)
+      if not data:
+        return CLOSE_FILTER
+    delay = self._delay_method(len(data)) if self._delay_method else 0
+    self._Queue(now + delay, memoryview(data))
+    return None
+
+  def _Queue(self, release_time, data):
+    self._queue.append([release_time, data])
+    self._queued_bytes += len(data)
+
+  def Write(self, now):
+    """Sends as much of the due chunks as the destination accepts."""
+    while self.IsDue(now):
+      data = self._queue[0][1]
+      try:
+        sent = self.dst.send(data)
+      except socket.error as e:
+        if e.args[0] in _RETRY_ERRNOS:
+          return
+        raise
+      self._queued_bytes -= sent
+      self._metrics.RecordSent(self._outbound, sent, now)
+      if sent < len(data):
+        self._queue[0][1] = data[sent:]
+        return
+      self._queue.popleft()
+
+
+class _Connection(object):
+  """A client connection and the connection opened for it by the proxy.
+
+  Nothing is read until the connection to the server is established. Once
+  either side reaches EOF or the filter asks to close the connection, no more
+  data is read; the connection is closed once queued data is sent.
+  """
+
+  def __init__(self, s_in, s_out, filter, chunk_size, max_queued_bytes,
+               metrics, connecting=False):
+    self.s_in = s_in
+    self.s_out = s_out
+    self.metrics = metrics
+    self.inbound = _Pipe(s_in, s_out, _GetMethod(filter, 'InBound'),
+                         _GetMethod(filter, 'InBoundDelay'), chunk_size,
+                         max_queued_bytes, metrics, False)
+    self.outbound = _Pipe(s_out, s_in, _GetMethod(filter, 'OutBound'),
+                          _GetMethod(filter, 'OutBoundDelay'), chunk_size,
+                          max_queued_bytes, metrics, True)
+    self.closing = False
+    # Whether the connection to the server is still being established.
+    self.connecting = connecting
+    # Maps file descriptors to the events they are registered for.
+    self.events = {}
+
+  def GetEvents(self, sock, now):
+    """Returns the events to wait for on |sock|."""
+    if self.connecting:
+      # The server socket becomes writable once connected or failed.
+      return _WRITE if sock is self.s_out else 0
+    events = 0
+    for pipe in (self.inbound, self.outbound):
+      if pipe.dst is sock and pipe.IsDue(now):
+        events |= _WRITE
+      if pipe.src is sock and pipe.CanRead() and not self.closing:
+        events |= _READ
+    return events
+
+  def GetReleaseTime(self, now):
+    """Returns when the next held chunk may be sent, or None."""
+    times = [pipe.GetReleaseTime() for pipe in (self.inbound, self.outbound)
+             if not pipe.IsEmpty() and not pipe.IsDue(now)]
+    return min(times) if times else None
+
+  def HandleEvents(self, sock, events, now):
+    """Reads and writes |sock| as reported ready by the poller.
+
+    Args:
+      sock: The socket that is ready.
+      events: The events |sock| is ready for.
+      now: The current time.
+
+    Returns:
+      False once the connection should be closed.
+    """
+    if self.connecting:
+      if sock is self.s_in:
+        # The client socket waits for no events until connected, so it is
+        # only reported for a hang up or an error, which epoll keeps reporting
+        # until the socket is closed.
+        error = self.s_in.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+          self.metrics.SetCloseReason(CLOSE_ERROR, os.strerror(error))
+        else:
+          self.metrics.SetCloseReason(CLOSE_CLIENT_EOF)
+        return False
+      error = self.s_out.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        self.metrics.SetCloseReason(CLOSE_CONNECT_FAILED, os.strerror(error))
+        return False
+      self.connecting = False
+      return True
+
+    try:
+      for pipe in (self.inbound, self.outbound):
+        if events & _WRITE and pipe.dst is sock:
+          pipe.Write(now)
+        if (events & _READ and pipe.src is sock and pipe.CanRead() and
+            not self.closing):
+          close_reason = pipe.Read(now)
+          if close_reason:
+            self.metrics.SetCloseReason(close_reason)
+            self.closing = True
+          else:
+            # The destination is usually ready; skip waiting for the poller.
+            pipe.Write(now)
+    except socket.error as e:
+      if e.args[0] not in _RETRY_ERRNOS:
+        # If there is any error moving data, close both connections.
+        self.metrics.SetCloseReason(CLOSE_ERROR, str(e))
+        return False
+
+    return not (self.closing and self.inbound.IsEmpty() and
+                self.outbound.IsEmpty())
+
+  def Close(self, reason):
+    """Closes both sockets, recording |reason| unless one is recorded."""
+    self.metrics.SetCloseReason(reason)
+    self.metrics.end = time.time()
+    self.s_in.close()
+    self.s_out.close()
+
+
+class CrosTestProxy(object):
+  """A transparent proxy for simulating network errors"""
 
   def __init__(self,
                filter,
                port_in=8081,
-               address_out='127.0.0.1', port_out=8080):
+               address_out='127.0.0.1', port_out=8080,
+               buffer_size=DEFAULT_BUFFER_SIZE,
+               max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES):
     """Configures the proxy object.
 
     Args:
       filter: An instance of a subclass of Filter.
-      port_in: Port on which to listen for incoming connections.
+      port_in: Port on which to listen for incoming connections. If 0, a free
+        port is picked and stored in self.port_in.
       address_out: Address to which outgoing connections will go.
       address_port: Port to which outgoing connections will go.
+      buffer_size: Maximum number of bytes proxied at once in each direction
+        of a connection.
+      max_queued_bytes: Maximum number of bytes held in each direction of a
+        connection while the filter delays them.
     """
-    self.port_in = port_in
     self.address_out = address_out
     self.port_out = port_out
     self.filter = filter
+    self.buffer_size = buffer_size
+    self.max_queued_bytes = max_queued_bytes
 
-    # Used to coordinate startup/shutdown in a new thread.
-    self.__is_started = threading.Event()
-    self.__is_shut_down = threading.Event()
-    self.__serving = False
-
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
-      SocketServer.TCPServer.__init__(self,
-                                      ('', port_in),
-                                      self._Handler)
+      self._socket.bind(('', port_in))
     except socket.error:
       os.system('sudo netstat -l --tcp -n -p')
+      self._socket.close()
       raise
+    self._socket.listen(socket.SOMAXCONN)
+    self._socket.setblocking(False)
+    self.port_in = self._socket.getsockname()[1]
+
+    # Maps file descriptors of proxied sockets to their _Connection.
+    self._connections = {}
+    # ConnectionMetrics of all connections, in the order they were accepted.
+    self._metrics = []
+    self._poller = None
+    # Written to by shutdown to wake up the event loop.
+    self._wakeup_r, self._wakeup_w = os.pipe()
+
+    # Used to coordinate startup/shutdown in a new thread.
+    self.__is_started = threading.Event()
+    self.__is_shut_down = threading.Event()
+    self.__serving = False
 
   def serve_forever_in_thread(self):
     """Helper method to start the server in a new background thread."""
@@ -127,44 +563,140 @@ class CrosTestProxy(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
     return server_thread
 
-  # ==========================
+  def _Accept(self):
+    """Accepts a new connection and opens the matching outgoing one."""
+    try:
+      s_in, _ = self._socket.accept()
+    except socket.error as e:
+      if e.args[0] in _RETRY_ERRNOS:
+        return
+      raise
 
-  # Override of the version of this method from SocketServer.
-  # It's duplicated, other than adding __is_started event.
-  # Bug chromium-os:16574
-  def serve_forever(self, poll_interval=0.5):
-    """Handle one request at a time until shutdown.
+    metrics = ConnectionMetrics(time.time())
+    self._metrics.append(metrics)
+    # Connect without blocking, so that a slow or unreachable server does not
+    # stall the other connections; the event loop waits for it.
+    s_out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s_out.setblocking(False)
+    error = s_out.connect_ex((self.address_out, self.port_out))
+    if error and error not in _CONNECTING_ERRNOS:
+      metrics.SetCloseReason(CLOSE_CONNECT_FAILED, os.strerror(error))
+      metrics.end = time.time()
+      s_in.close()
+      s_out.close()
+      return
+
+    self.filter.setup()
+    for sock in (s_in, s_out):
+      sock.setblocking(False)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      # Only grow the kernel buffers; tiny TCP windows stall transfers.
+      for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, option) < self.buffer_size:
+          sock.setsockopt(socket.SOL_SOCKET, option, self.buffer_size)
+
+    chunk_size = min(self.buffer_size,
+                     self.filter.GetChunkSize() or self.buffer_size)
+    connection = _Connection(s_in, s_out, self.filter, chunk_size,
+                             self.max_queued_bytes, metrics,
+                             connecting=bool(error))
+    now = time.time()
+    for sock in (s_in, s_out):
+      self._connections[sock.fileno()] = connection
+      connection.events[sock.fileno()] = connection.GetEvents(sock, now)
+      self._poller.Register(sock.fileno(), connection.events[sock.fileno()])
+
+  def _UpdateEvents(self, connection, now):
+    """Updates the events polled for on the sockets of |connection|."""
+    for sock in (connection.s_in, connection.s_out):
+      events = connection.GetEvents(sock, now)
+      if events != connection.events[sock.fileno()]:
+        connection.events[sock.fileno()] = events
+        self._poller.Modify(sock.fileno(), events)
+
+  def _GetPollTimeout(self, now):
+    """Returns how long to poll before the next held chunk may be sent."""
+    times = [connection.GetReleaseTime(now)
+             for connection in set(self._connections.values())]
+    times = [t for t in times if t is not None]
+    return max(0, min(times) - now) if times else None
+
+  def _CloseConnection(self, connection, reason):
+    """Stops polling the sockets of |connection| and closes them."""
+    for sock in (connection.s_in, connection.s_out):
+      self._poller.Unregister(sock.fileno())
+      del self._connections[sock.fileno()]
+    connection.Close(reason)
+
+  def serve_forever(self):
+    """Proxies connections until shutdown."""
+    self._poller = _CreatePoller()
+    self._poller.Register(self._socket.fileno(), _READ)
+    self._poller.Register(self._wakeup_r, _READ)
 
-    Polls for shutdown every poll_interval seconds. Ignores
-    self.timeout. If you need to do periodic tasks, do them in
-    another thread.
-    """
     self.__serving = True
     self.__is_shut_down.clear()
     self.__is_started.set()
 
-    while self.__serving:
-      # XXX: Consider using another file descriptor or
-      # connecting to the socket to wake this up instead of
-      # polling. Polling reduces our responsiveness to a
-      # shutdown request and wastes cpu at all other times.
-      r, w, e = select.select([self], [], [], poll_interval)
-      if r:
-        self._handle_request_noblock()
-
-    self.__is_started.clear()
-    self.__is_shut_down.set()
-
-  # Duplicate override of the version of this method from SocketServer so
-  # that we can access the same __ variables as serve_forever.
-  # Bug chromium-os:16574
+    try:
+      while self.__serving:
+        # Wait for the destinations of chunks whose release time has come,
+        # and until the next held chunk may be sent.
+        now = time.time()
+        for connection in set(self._connections.values()):
+          self._UpdateEvents(connection, now)
+        for fd, events in self._poller.Poll(self._GetPollTimeout(now)):
+          if fd == self._socket.fileno():
+            self._Accept()
+            continue
+          if fd == self._wakeup_r:
+            os.read(self._wakeup_r, 4096)
+            continue
+          connection = self._connections.get(fd)
+          if connection is None:
+            # A connection closed earlier in this batch.
+            continue
+          sock = (connection.s_in if fd == connection.s_in.fileno() else
+                  connection.s_out)
+          now = time.time()
+          if not connection.HandleEvents(sock, events, now):
+            self._CloseConnection(connection, CLOSE_ERROR)
+            continue
+          self._UpdateEvents(connection, now)
+    finally:
+      for connection in set(self._connections.values()):
+        self._CloseConnection(connection, CLOSE_SHUTDOWN)
+      self._poller.Close()
+      self._socket.close()
+      self.__is_started.clear()
+      self.__is_shut_down.set()
+
   def shutdown(self):
-    """Stops the serve_forever loop.
+    """Stops the serve_forever loop and closes all connections.
 
     Blocks until the loop has finished. This must be called while
     serve_forever() is running in another thread, or it will
     deadlock.
     """
     self.__serving = False
+    os.write(self._wakeup_w, 'x')
     self.__is_shut_down.wait()
+    # Only closed once the loop is done with it, so the write above never
+    # goes to a closed or reused file descriptor.
+    os.close(self._wakeup_r)
+    os.close(self._wakeup_w)
+
+  def GetMetrics(self):
+    """Returns the metrics of all connections accepted so far.
+
+    Returns:
+      A list of dicts, one per connection in the order they were accepted,
+      as returned by ConnectionMetrics.ToDict.
+    """
+    return [metrics.ToDict() for metrics in list(self._metrics)]
 
+  def DumpMetrics(self, path):
+    """Writes the metrics of all connections to |path| as JSON."""
+    with open(path, 'w') as f:
+      json.dump(dict(connections=self.GetMetrics()), f, indent=2,
+                sort_keys=True)
@@ -0,0 +1,250 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for cros_test_proxy."""
+
+from __future__ import print_function
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.au_test_harness import cros_test_proxy
+
+
+class _EchoServer(object):
+  """A server echoing back everything received on each connection."""
+
+  def __init__(self):
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.bind(('127.0.0.1', 0))
+    self._socket.listen(5)
+    self.port = self._socket.getsockname()[1]
+    thread = threading.Thread(target=self._Serve)
+    thread.setDaemon(True)
+    thread.start()
+
+  def _Serve(self):
+    while True:
+      conn, _ = self._socket.accept()
+      thread = threading.Thread(target=self._Echo, args=(conn,))
+      thread.setDaemon(True)
+      thread.start()
+
+  def _Echo(self, conn):
+    for data in iter(lambda: conn.recv(65536), ''):
+      conn.sendall(data)
+    conn.close()
+
+
+class _UpperCaseFilter(cros_test_proxy.Filter):
+  """Upper-cases data sent back to the client."""
+
+  def __init__(self):
+    self.connections = 0
+
+  def setup(self):
+    self.connections += 1
+
+  def OutBound(self, data):
+    return data.upper()
+
+
+class _CloseFilter(cros_test_proxy.Filter):
+  """Closes connections as soon as the client sends anything."""
+
+  def InBound(self, data):
+    return None
+
+
+class CrosTestProxyTest(cros_test_lib.TempDirTestCase):
+  """Tests proxying connections through CrosTestProxy."""
+
+  def setUp(self):
+    self.echo_server = _EchoServer()
+
+  def _StartProxy(self, proxy_filter, **kwargs):
+    proxy = cros_test_proxy.CrosTestProxy(
+        proxy_filter, port_in=0, port_out=self.echo_server.port, **kwargs)
+    proxy.serve_forever_in_thread()
+    self.addCleanup(proxy.shutdown)
+    return proxy
+
+  def _Exchange(self, proxy, data):
+    """Sends |data| through |proxy| and returns what comes back."""
+    client = socket.create_connection(('127.0.0.1', proxy.port_in))
+    sender = threading.Thread(target=client.sendall, args=(data,))
+    sender.start()
+    received = []
+    size = 0
+    while size < len(data):
+      chunk = client.recv(65536)
+      if not chunk:
+        break
+      received.append(chunk)
+      size += len(chunk)
+    sender.join()
+    client.close()
+    return ''.join(received)
+
+  def testPassthrough(self):
+    """Tests that data larger than the buffers goes through unchanged."""
+    proxy = self._StartProxy(cros_test_proxy.Filter(), buffer_size=4096)
+    data = ''.join(chr(i % 251) for i in xrange(1024 * 1024))
+    self.assertEqual(data, self._Exchange(proxy, data))
+
+  def testFilter(self):
+    """Tests that overridden filter methods see the data of each connection."""
+    proxy_filter = _UpperCaseFilter()
+    proxy = self._StartProxy(proxy_filter)
+    self.assertEqual('HELLO', self._Exchange(proxy, 'hello'))
+    self.assertEqual('WORLD', self._Exchange(proxy, 'world'))
+    self.assertEqual(2, proxy_filter.connections)
+
+  def testFilterCloses(self):
+    """Tests that a filter returning None closes the connection."""
+    proxy = self._StartProxy(_CloseFilter())
+    self.assertEqual('', self._Exchange(proxy, 'hello'))
+    self._WaitForClose(proxy)
+    [metrics] = proxy.GetMetrics()
+    self.assertEqual(cros_test_proxy.CLOSE_FILTER, metrics['close_reason'])
+    self.assertEqual(0, metrics['bytes_in'])
+
+  def _WaitForClose(self, proxy):
+    """Waits until the proxy has closed all connections."""
+    for _ in xrange(100):
+      if all(m['end'] for m in proxy.GetMetrics()):
+        return
+      time.sleep(0.01)
+    self.fail('Connections were not closed.')
+
+  def testMetrics(self):
+    """Tests that the transfer of each connection is measured."""
+    proxy = self._StartProxy(cros_test_proxy.Filter())
+    data = 'x' * 100000
+    self.assertEqual(data, self._Exchange(proxy, data))
+    self.assertEqual('hello', self._Exchange(proxy, 'hello'))
+    self._WaitForClose(proxy)
+
+    first, second = proxy.GetMetrics()
+    self.assertEqual(100000, first['bytes_in'])
+    self.assertEqual(100000, first['bytes_out'])
+    self.assertEqual(100000, sum(first['bytes_out_per_sample']))
+    self.assertEqual(cros_test_proxy.CLOSE_CLIENT_EOF, first['close_reason'])
+    self.assertLessEqual(first['first_byte_seconds'], first['seconds'])
+    self.assertEqual(5, second['bytes_out'])
+
+  def testMetricsConnectFailed(self):
+    """Tests that failures to connect to the server are recorded."""
+    proxy = cros_test_proxy.CrosTestProxy(cros_test_proxy.Filter(),
+                                          port_in=0, port_out=1)
+    proxy.serve_forever_in_thread()
+    self.addCleanup(proxy.shutdown)
+    client = socket.create_connection(('127.0.0.1', proxy.port_in))
+    self.assertEqual('', client.recv(1))
+    client.close()
+
+    [metrics] = proxy.GetMetrics()
+    self.assertEqual(cros_test_proxy.CLOSE_CONNECT_FAILED,
+                     metrics['close_reason'])
+
+  def testShutdownDuringTransfer(self):
+    """Tests that connections transferring data are closed on shutdown."""
+    proxy = cros_test_proxy.CrosTestProxy(
+        cros_test_proxy.Filter(), port_in=0, port_out=self.echo_server.port)
+    proxy.serve_forever_in_thread()
+    client = socket.create_connection(('127.0.0.1', proxy.port_in))
+    self.addCleanup(client.close)
+
+    def _Send():
+      try:
+        while True:
+          client.sendall('x' * 65536)
+      except socket.error:
+        pass
+    sender = threading.Thread(target=_Send)
+    sender.setDaemon(True)
+    sender.start()
+    # Wait for the transfer to be under way.
+    self.assertTrue(client.recv(65536))
+
+    proxy.shutdown()
+    [metrics] = proxy.GetMetrics()
+    self.assertEqual(cros_test_proxy.CLOSE_SHUTDOWN, metrics['close_reason'])
+    self.assertGreater(metrics['bytes_in'], 0)
+
+  def _StartProxyToSlowServer(self):
+    """Returns a started proxy to a server whose connects stay in progress."""
+    # A server that never accepts: once its backlog is full, connecting to it
+    # stays in progress.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(0)
+    self.addCleanup(server.close)
+    backlog = socket.create_connection(server.getsockname())
+    self.addCleanup(backlog.close)
+
+    proxy = cros_test_proxy.CrosTestProxy(
+        cros_test_proxy.Filter(), port_in=0, port_out=server.getsockname()[1])
+    proxy.serve_forever_in_thread()
+    self.addCleanup(proxy.shutdown)
+    return proxy
+
+  def testSlowServer(self):
+    """Tests that a server slow to accept does not stall other connections."""
+    proxy = self._StartProxyToSlowServer()
+    clients = [socket.create_connection(('127.0.0.1', proxy.port_in))
+               for _ in xrange(2)]
+    for client in clients:
+      self.addCleanup(client.close)
+
+    for _ in xrange(100):
+      if len(proxy.GetMetrics()) == 2:
+        break
+      time.sleep(0.01)
+    self.assertEqual(2, len(proxy.GetMetrics()))
+    self.assertFalse(any(m['end'] for m in proxy.GetMetrics()))
+
+  def testClientResetWhileConnecting(self):
+    """Tests that a client resetting before the server accepts is closed."""
+    proxy = self._StartProxyToSlowServer()
+    client = socket.create_connection(('127.0.0.1', proxy.port_in))
+    for _ in xrange(100):
+      if proxy.GetMetrics():
+        break
+      time.sleep(0.01)
+    # Close with a reset, which epoll reports as a hang up and an error.
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                      struct.pack('ii', 1, 0))
+    client.close()
+
+    self._WaitForClose(proxy)
+    [metrics] = proxy.GetMetrics()
+    self.assertEqual(cros_test_proxy.CLOSE_ERROR, metrics['close_reason'])
+
+  def testDumpMetrics(self):
+    """Tests that metrics are dumped as JSON."""
+    proxy = self._StartProxy(cros_test_proxy.Filter())
+    self._Exchange(proxy, 'hello')
+    self._WaitForClose(proxy)
+    path = os.path.join(self.tempdir, 'metrics.json')
+    proxy.DumpMetrics(path)
+    with open(path) as f:
+      self.assertEqual(proxy.GetMetrics(), json.load(f)['connections'])
+
+
+if __name__ == '__main__':
+  unittest.main()
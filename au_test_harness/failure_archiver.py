@@ -0,0 +1,224 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a background archiver of the VM state of failed tests.
+
+The disk and memory images of a failed VM are several GB. Instead of copying
+them into the fail directory while the test waits, the test hands them to an
+archiver process (this module run as a script), which:
+  - stores the disk as a qcow2 image of the clusters that differ from the
+    base VM image it was created from, or as a sparse copy without qemu-img,
+  - compresses the disk and memory images with zstd, pigz or gzip, whichever
+    is found first, using all cores,
+  - and then removes the oldest archived images of the whole test results root
+    until their disk usage is within a budget.
+
+Archived images keep the names of the images they come from, plus the suffixes
+of the formats applied, e.g. <disk>.qcow2.zst. A qcow2 disk reads its unchanged
+clusters from the base image recorded in FAILURE_ARTIFACTS_FILE, so it needs
+that image to be restored.
+
+Archivers hold a shared lock on the test results root from the moment they
+are started, so the harness can wait for all of them with WaitForArchivers.
+"""
+
+from __future__ import print_function
+
+import fcntl
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from crostestutils.lib import disk_util
+from crostestutils.lib import json_store
+from crostestutils.lib import test_helper
+
+# Archived images of all failed tests under a test results root, oldest
+# first, with the base image of qcow2 disks.
+FAILURE_ARTIFACTS_FILE = 'failure_artifacts.json'
+_ARCHIVERS_LOCK = 'failure_archivers.lock'
+_ARCHIVER_LOG = 'archiver.log'
+
+# Compressors tried in order, with their suffix and command compressing a file
+# into <file><suffix> and removing it.
+_COMPRESSORS = (
+    ('zstd', '.zst', ['zstd', '-q', '-f', '-T0', '-3', '--rm']),
+    ('pigz', '.gz', ['pigz', '-q', '-f', '-1']),
+    ('gzip', '.gz', ['gzip', '-q', '-f', '-1']),
+)
+
+
+def _Compress(path):
+  """Compresses |path| in place; returns the path of the compressed file."""
+  for binary, suffix, cmd in _COMPRESSORS:
+    if not osutils.Which(binary):
+      continue
+    result = cros_build_lib.RunCommand(cmd + [path], error_code_ok=True,
+                                       print_cmd=False, capture_output=True)
+    if result.returncode == 0:
+      return path + suffix
+    logging.warning('Could not compress %s with %s: %s', path, binary,
+                    result.error)
+    osutils.SafeUnlink(path + suffix)
+
+  logging.warning('Could not compress %s, keeping it as is.', path)
+  return path
+
+
+def _StoreDisk(disk, fail_directory, base=None):
+  """Moves |disk| into |fail_directory|, without the data of |base|.
+
+  Args:
+    disk: Path of the disk image, raw or qcow2, which is removed.
+    fail_directory: Directory to store the disk in.
+    base: Raw image |disk| was created from, or None.
+
+  Returns:
+    A tuple of the path of the stored disk and the base image it needs, if
+    any.
+  """
+  dest = os.path.join(fail_directory, os.path.basename(disk))
+  if base and os.path.exists(base) and osutils.Which('qemu-img'):
+    qcow2 = dest + '.qcow2'
+    result = cros_build_lib.RunCommand(
+        ['qemu-img', 'convert', '-O', 'qcow2',
+         '-o', 'backing_fmt=raw', '-B', os.path.abspath(base), disk, qcow2],
+        error_code_ok=True, print_cmd=False, capture_output=True)
+    if result.returncode == 0:
+      os.remove(disk)
+      return qcow2, os.path.abspath(base)
+    logging.warning('Could not store %s as a diff of %s: %s', disk, base,
+                    result.error)
+    osutils.SafeUnlink(qcow2)
+
+  disk_util.CloneFile(disk, dest)
+  os.remove(disk)
+  return dest, None
+
+
+def _EnforceBudget(results_root, budget_bytes):
+  """Removes the oldest archived images until within |budget_bytes|.
+
+  Must be called with the artifacts file locked.
+  """
+  artifacts_file = os.path.join(results_root, FAILURE_ARTIFACTS_FILE)
+  artifacts = json_store.ReadJson(artifacts_file, default=[])
+  usage = disk_util.GetDiskUsage(results_root)
+  while artifacts and usage > budget_bytes:
+    artifact = artifacts.pop(0)
+    if os.path.exists(artifact['path']):
+      logging.info('Removing %s to keep failure artifacts within %d bytes.',
+                   artifact['path'], budget_bytes)
+      usage -= disk_util.GetDiskUsage(artifact['path'])
+      os.remove(artifact['path'])
+  json_store.WriteJsonAtomic(artifacts_file, artifacts)
+
+
+def Archive(results_root, fail_directory, disk=None, base=None, memory=None,
+            budget_bytes=constants.FAILURE_ARTIFACTS_BUDGET_BYTES):
+  """Archives the disk and memory images of a failed test.
+
+  Args:
+    results_root: Test results root whose archived images share the budget.
+    fail_directory: Directory of the failed test phase.
+    disk: Disk image of the failed VM, which is moved out of the way.
+    base: Raw image |disk| was created from, or None.
+    memory: Memory image saved in |fail_directory|.
+    budget_bytes: Disk space |results_root| may use before the oldest archived
+      images are removed.
+  """
+  archived = []
+  if disk:
+    start = time.time()
+    path, needs_base = _StoreDisk(disk, fail_directory, base=base)
+    archived.append(dict(path=_Compress(path), base=needs_base))
+    logging.info('Archived %s as %s in %ds.', disk, archived[-1]['path'],
+                 time.time() - start)
+  if memory and os.path.exists(memory):
+    start = time.time()
+    archived.append(dict(path=_Compress(memory), base=None))
+    logging.info('Archived %s as %s in %ds.', memory, archived[-1]['path'],
+                 time.time() - start)
+
+  artifacts_file = os.path.join(results_root, FAILURE_ARTIFACTS_FILE)
+  with json_store.FileLock(artifacts_file):
+    artifacts = json_store.ReadJson(artifacts_file, default=[])
+    json_store.WriteJsonAtomic(artifacts_file, artifacts + archived)
+    _EnforceBudget(results_root, budget_bytes)
+
+
+def StartArchiver(results_root, fail_directory, disk=None, base=None,
+                  memory=None):
+  """Starts archiving the images of a failed test in the background.
+
+  The archiver takes over |disk| and |memory|, so they must not be used once
+  this returns. See Archive for the arguments.
+  """
+  osutils.SafeMakedirs(fail_directory)
+  cmd = [sys.executable, os.path.realpath(__file__),
+         '--results_root', results_root, '--fail_directory', fail_directory]
+  for flag, value in (('--disk', disk), ('--base', base),
+                      ('--memory', memory)):
+    if value:
+      cmd += [flag, value]
+
+  # The archiver holds the lock through its stdin, so it is held from the
+  # moment it is started until it exits.
+  with open(os.path.join(results_root, _ARCHIVERS_LOCK), 'a') as lock, \
+      open(os.path.join(fail_directory, _ARCHIVER_LOG), 'a') as log:
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    subprocess.Popen(cmd, stdin=lock, stdout=log, stderr=subprocess.STDOUT,
+                     close_fds=True)
+
+
+def WaitForArchivers(results_root):
+  """Waits until all archivers started for |results_root| are done."""
+  lock_path = os.path.join(results_root, _ARCHIVERS_LOCK)
+  if not os.path.exists(lock_path):
+    return
+
+  with open(lock_path, 'a') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      logging.info('Waiting for the artifacts of failed tests to be archived.')
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+  test_helper.SetupCommonLoggingFormat()
+  parser = optparse.OptionParser()
+  parser.add_option('--results_root', help='Root of the test results.')
+  parser.add_option('--fail_directory',
+                    help='Directory of the failed test phase.')
+  parser.add_option('--disk', help='Disk image to archive.')
+  parser.add_option('--base', help='Raw image the disk was created from.')
+  parser.add_option('--memory', help='Memory image to archive.')
+  parser.add_option('--budget_bytes', type=int,
+                    default=constants.FAILURE_ARTIFACTS_BUDGET_BYTES,
+                    help='Disk space the test results may use before the '
+                    'oldest archived images are removed. Default: %default.')
+  options, _ = parser.parse_args()
+
+  # Leave the CPUs to the tests still running.
+  os.nice(10)
+  Archive(options.results_root, options.fail_directory, disk=options.disk,
+          base=options.base, memory=options.memory,
+          budget_bytes=options.budget_bytes)
+
+
+if __name__ == '__main__':
+  main()
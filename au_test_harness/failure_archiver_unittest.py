@@ -0,0 +1,75 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for failure_archiver."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.au_test_harness import failure_archiver
+from crostestutils.lib import json_store
+
+
+class FailureArchiverTest(cros_test_lib.TempDirTestCase):
+  """Tests archiving the VM state of failed tests."""
+
+  def setUp(self):
+    self.fail_directory = os.path.join(self.tempdir, 'failed', '1_update')
+    osutils.SafeMakedirs(self.fail_directory)
+
+  def _WriteImage(self, name, size=1024 * 1024):
+    path = os.path.join(self.tempdir, name)
+    osutils.WriteFile(path, 'x' * size)
+    return path
+
+  def _ReadArtifacts(self):
+    return json_store.ReadJson(
+        os.path.join(self.tempdir, failure_archiver.FAILURE_ARTIFACTS_FILE))
+
+  def testArchive(self):
+    """Tests that images are compressed into the fail directory."""
+    disk = self._WriteImage('disk.bin')
+    memory = self._WriteImage(os.path.join('failed', '1_update', 'mem.bin'))
+    failure_archiver.Archive(self.tempdir, self.fail_directory, disk=disk,
+                             memory=memory)
+
+    self.assertNotExists(disk)
+    self.assertNotExists(memory)
+    artifacts = self._ReadArtifacts()
+    self.assertEqual(2, len(artifacts))
+    for artifact in artifacts:
+      self.assertEqual(self.fail_directory,
+                       os.path.dirname(artifact['path']))
+      self.assertLess(os.path.getsize(artifact['path']), 1024 * 1024)
+
+  def testBudget(self):
+    """Tests that the oldest images are removed to stay within the budget."""
+    for name in ('old.bin', 'new.bin'):
+      failure_archiver.Archive(self.tempdir, self.fail_directory,
+                               disk=self._WriteImage(name),
+                               budget_bytes=1024 * 1024)
+    self.assertEqual(2, len(self._ReadArtifacts()))
+
+    failure_archiver.Archive(self.tempdir, self.fail_directory,
+                             disk=self._WriteImage('last.bin'), budget_bytes=0)
+    self.assertEqual([], self._ReadArtifacts())
+
+  def testWaitForArchivers(self):
+    """Tests that waiting without any archiver returns."""
+    failure_archiver.WaitForArchivers(self.tempdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
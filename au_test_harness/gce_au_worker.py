@@ -72,7 +72,6 @@ import time
 from functools import partial
 from multiprocessing import Process
 
-from chromite.lib import cros_build_lib
 from chromite.lib import cros_logging as logging
 from chromite.lib import gce
 from chromite.lib import gs
@@ -81,6 +80,7 @@ from chromite.lib import path_util
 from chromite.lib import portage_util
 from crostestutils.au_test_harness import au_worker
 from crostestutils.au_test_harness import constants
+from crostestutils.au_test_harness import test_that_results
 from crostestutils.au_test_harness import update_exception
 
 
@@ -143,6 +143,7 @@ class GCEAUWorker(au_worker.AUWorker):
     self._WaitForBackgroundDeleteProcesses()
     self._DeleteExistingResources()
     logging.info('All resources are deleted.')
+    super(GCEAUWorker, self).CleanUp()
 
   def PrepareBase(self, image_path, signed_base=False):
     """Auto-update to base image to prepare for test."""
@@ -181,7 +182,8 @@ class GCEAUWorker(au_worker.AUWorker):
       test: (str) The specific test to run. Not used.
 
     Returns:
-      True if all tests pass, or False otherwise.
+      A test_that_results.VerificationResult of all tests, passed if all
+      tests passed.
     """
     log_directory_base, fail_directory_base = self.GetNextResultsPath(
         'autotest_tests')
@@ -194,20 +196,21 @@ class GCEAUWorker(au_worker.AUWorker):
                            log_directory_base, fail_directory_base))
     return_values = parallel.RunParallelSteps(steps, return_values=True)
 
-    passed = True
     test_reports = {}
-    for test, percent_passed, report in return_values:
-      passed &= (percent_passed == 100)
+    for test, _, report in return_values:
       test_reports[test] = report
+    result = test_that_results.VerificationResult.Merge(
+        [test_result for _, test_result, _ in return_values])
 
-    if not passed:
+    if not result.passed:
       self._HandleFail(log_directory_base, fail_directory_base)
       print ('\nSome test(s) failed. Test reports:')
       for test, report in test_reports.iteritems():
         print ('\nTest: %s\n%s' % (test, report or ''))
+      print('\n%s' % result.Summary())
       if unittest is not None:
         unittest.fail('Not all tests passed.')
-    return passed
+    return result
 
   # --- PRIVATE HELPER FUNCTIONS ---
 
@@ -228,7 +231,7 @@ class GCEAUWorker(au_worker.AUWorker):
     Returns:
       test: Same as |test|. This is useful when the caller wants to correlate
           results to the test name.
-      percent_passed: Pass rate.
+      result: test_that_results.VerificationResult of the test.
       test_report: Content of the test report generated by test_that.
     """
     log_directory, _ = self._GetResultsDirectoryForTest(
@@ -252,16 +255,13 @@ class GCEAUWorker(au_worker.AUWorker):
         cmd.append('--ssh_private_key=%s' %
                    path_util.ToChrootPath(self.ssh_private_key))
 
-      result = cros_build_lib.RunCommand(cmd, error_code_ok=True,
-                                         enter_chroot=True,
-                                         redirect_stdout=True,
-                                         cwd=constants.CROSUTILS_DIR)
-      percent_passed = self.ParseGeneratedTestOutput(result.output)
+      _, result = self.RunTestCommand(cmd, log_directory + '.log',
+                                      enter_chroot=True)
       test_report = self._GetTestReport(log_directory)
 
       # Returns the summarized test_report as it is more useful than the full
       # output, plus the entire log will always be linked in the failure report.
-      return test, percent_passed, test_report
+      return test, result, test_report
 
   def _GetTestReport(self, results_path):
     """Returns the content of test_report.log created by test_that.
@@ -26,6 +26,7 @@ from chromite.lib import path_util
 from chromite.lib import portage_util
 from crostestutils.au_test_harness.au_worker import AUWorker
 from crostestutils.au_test_harness.gce_au_worker import GCEAUWorker
+from crostestutils.au_test_harness.test_that_results import VerificationResult
 
 
 class Options(object):
@@ -208,14 +209,14 @@ class GceAuWorkerTest(cros_test_lib.MockTempDirTestCase):
       else:
         return '3.3.3.3'
 
-    def _OverrideRunCommand(cmd, *_args, **_kwargs):
-      """A mock of cros_build_lib.RunCommand that injects arguments."""
+    def _OverrideRunTestCommand(_self, cmd, *_args, **_kwargs):
+      """A mock of AUWorker.RunTestCommand that injects arguments."""
       # In this test setup, |test| and |remote| should be the third and fourth
       # last argument respectively.
       test = cmd[-3]
       remote = cmd[-4]
       actual_tests_run.append(dict(remote=remote, test=test))
-      return cros_build_lib.CommandResult()
+      return 0, VerificationResult(percent_passed=100)
 
     def _OverrideRunParallelSteps(steps, *_args, **_kwargs):
       """Run steps sequentially."""
@@ -231,11 +232,8 @@ class GceAuWorkerTest(cros_test_lib.MockTempDirTestCase):
     self.PatchObject(worker.gce_context, 'GetInstanceIP',
                      autospec=True,
                      side_effect=_OverrideGetInstanceIP)
-    self.PatchObject(cros_build_lib, 'RunCommand',
-                     autospec=True,
-                     side_effect=_OverrideRunCommand)
-    self.PatchObject(AUWorker, 'ParseGeneratedTestOutput', autospec=True,
-                     return_value=100)
+    self.PatchObject(AUWorker, 'RunTestCommand', autospec=True,
+                     side_effect=_OverrideRunTestCommand)
     self.PatchObject(parallel, 'RunParallelSteps', autospec=True,
                      side_effect=_OverrideRunParallelSteps)
 
@@ -303,7 +301,7 @@ class GceAuWorkerTest(cros_test_lib.MockTempDirTestCase):
 
     # Make _RunTest return 0% of pass rate.
     self.PatchObject(worker, '_RunTest', autospec=True,
-                     return_value=(0, None, None))
+                     return_value=('smoke', VerificationResult(), None))
 
     # Fake resource existance.
     remote_instance = 'fake-remote-instance'
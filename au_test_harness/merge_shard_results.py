@@ -0,0 +1,115 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Merges the results of the shards of a cros_au_test_harness run.
+
+Usage: merge_shard_results.py --output_dir <dir> <shard results dir>...
+
+Every shard results directory is the --test_results_root of one shard. The
+per-test results of all shards are merged into <dir>/all and <dir>/failed,
+other files of each shard are copied to <dir>/shard_<index>, and the merged
+summary is written to <dir>/summary.json and printed. Exits with an error if
+any test failed, or if the shards do not add up to the whole suite.
+"""
+
+from __future__ import print_function
+
+import optparse
+import os
+import shutil
+import sys
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from crostestutils.au_test_harness import test_sharding
+from crostestutils.lib import json_store
+from crostestutils.lib import test_helper
+
+# Directories of per-test results in a shard results directory.
+_TEST_RESULTS_DIRS = ('all', 'failed')
+
+
+def _MergeTree(src, dst):
+  """Copies the tree |src| into |dst|, which may already exist."""
+  for dirpath, _, filenames in os.walk(src):
+    dst_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+    osutils.SafeMakedirs(dst_dir)
+    for filename in filenames:
+      shutil.copy2(os.path.join(dirpath, filename), dst_dir)
+
+
+def MergeShardResults(shard_dirs, output_dir):
+  """Merges the results directories |shard_dirs| into |output_dir|.
+
+  Returns:
+    The merged test results, as returned by test_sharding.MergeSummaries.
+  """
+  summaries = []
+  for shard_dir in shard_dirs:
+    summary = json_store.ReadJson(
+        os.path.join(shard_dir, test_sharding.SUMMARY_FILE))
+    if summary is None:
+      raise test_sharding.ShardMergeError('%s has no %s.' % (
+          shard_dir, test_sharding.SUMMARY_FILE))
+    summaries.append(summary)
+  results = test_sharding.MergeSummaries(summaries)
+
+  for shard_dir, summary in zip(shard_dirs, summaries):
+    for name in os.listdir(shard_dir):
+      path = os.path.join(shard_dir, name)
+      if name in _TEST_RESULTS_DIRS:
+        _MergeTree(path, os.path.join(output_dir, name))
+      elif name != test_sharding.SUMMARY_FILE:
+        shard_output_dir = os.path.join(output_dir,
+                                        'shard_%d' % summary['shard_index'])
+        if os.path.isdir(path):
+          _MergeTree(path, os.path.join(shard_output_dir, name))
+        else:
+          osutils.SafeMakedirs(shard_output_dir)
+          shutil.copy2(path, shard_output_dir)
+
+  json_store.WriteJsonAtomic(
+      os.path.join(output_dir, test_sharding.SUMMARY_FILE),
+      dict(total_shards=len(summaries), tests=results))
+  return results
+
+
+def main():
+  test_helper.SetupCommonLoggingFormat()
+  parser = optparse.OptionParser(
+      usage='%prog --output_dir <dir> <shard results dir>...')
+  parser.add_option('--output_dir',
+                    help='Directory to merge the shard results into.')
+  options, shard_dirs = parser.parse_args()
+  if not options.output_dir:
+    parser.error('Must specify --output_dir.')
+  if not shard_dirs:
+    parser.error('Must specify the results directory of every shard.')
+
+  try:
+    results = MergeShardResults(shard_dirs, options.output_dir)
+  except test_sharding.ShardMergeError as e:
+    cros_build_lib.Die(str(e))
+
+  failed = 0
+  for test_id, result in sorted(results.iteritems()):
+    print('%-4s  %7.1fs  %s' % (result['status'], result['seconds'], test_id))
+    if result['status'] != test_sharding.PASS:
+      failed += 1
+
+  logging.info('%d of %d tests passed over %d shards.', len(results) - failed,
+               len(results), len(shard_dirs))
+  if failed:
+    cros_build_lib.Die('%d tests failed.' % failed)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,174 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing CrosTestProxy filters that emulate constrained networks.
+
+The filters delay data instead of sleeping, so a shaped connection never
+blocks the others. They shape both directions independently and can be
+combined with cros_test_proxy.FilterChain. For example, to emulate a 2 Mbit/s
+link with 50ms of latency and 1% loss:
+
+  cros_test_proxy.FilterChain([BandwidthFilter(2e6),
+                               LatencyFilter(0.05, jitter=0.01),
+                               LossFilter(0.01)])
+"""
+
+from __future__ import print_function
+
+import math
+import random
+import time
+
+from crostestutils.au_test_harness import cros_test_proxy
+
+# Size of the TCP segments lost by LossFilter.
+_SEGMENT_SIZE = 1460
+
+# Seconds of data at the shaped rate proxied at once by BandwidthFilter.
+_CHUNK_SECONDS = 0.005
+
+
+class _TokenBucket(object):
+  """Paces data at a rate, allowing bursts of up to |burst| bytes."""
+
+  def __init__(self, rate, burst):
+    """Initializes a full bucket.
+
+    Args:
+      rate: Rate in bytes per second.
+      burst: Size of the bucket in bytes.
+    """
+    self.rate = rate
+    self.burst = burst
+    self._tokens = burst
+    self._updated = None
+
+  def Take(self, size, now):
+    """Takes |size| bytes out of the bucket at |now|.
+
+    Returns:
+      Seconds to wait until |size| bytes are available. Data queued behind
+      earlier data keeps the bucket in debt, which paces it.
+    """
+    if self._updated is not None:
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+    self._tokens -= size
+    return max(0.0, -self._tokens / self.rate)
+
+
+class BandwidthFilter(cros_test_proxy.Filter):
+  """Limits the bandwidth of each direction with a token bucket.
+
+  The buckets are shared by all connections, like the link they emulate.
+  """
+
+  def __init__(self, bits_per_second, inbound_bits_per_second=None,
+               burst_bytes=None):
+    """Initializes the filter.
+
+    Args:
+      bits_per_second: Bandwidth of outgoing data, i.e. from the devserver.
+      inbound_bits_per_second: Bandwidth of incoming data. Defaults to
+        |bits_per_second|.
+      burst_bytes: Size of the token buckets. Defaults to one chunk.
+    """
+    rates = [bits_per_second / 8.0,
+             (inbound_bits_per_second or bits_per_second) / 8.0]
+    self._chunk_size = max(_SEGMENT_SIZE,
+                           int(min(rates) * _CHUNK_SECONDS))
+    burst = burst_bytes or self._chunk_size
+    self._outbound, self._inbound = [_TokenBucket(rate, burst)
+                                     for rate in rates]
+
+  def GetChunkSize(self):
+    return self._chunk_size
+
+  def InBoundDelay(self, size):
+    return self._inbound.Take(size, time.time())
+
+  def OutBoundDelay(self, size):
+    return self._outbound.Take(size, time.time())
+
+
+class LatencyFilter(cros_test_proxy.Filter):
+  """Delays data in each direction by a fixed latency plus random jitter."""
+
+  def __init__(self, seconds, jitter=0, seed=None):
+    """Initializes the filter.
+
+    Args:
+      seconds: One-way latency added to each direction.
+      jitter: Maximum deviation from |seconds|, drawn uniformly per packet.
+      seed: Seed of the jitter, to reproduce a run.
+    """
+    self.seconds = seconds
+    self.jitter = jitter
+    self._random = random.Random(seed)
+
+  def _GetDelay(self):
+    if not self.jitter:
+      return self.seconds
+    return max(0.0, self.seconds + self._random.uniform(-self.jitter,
+                                                        self.jitter))
+
+  def InBoundDelay(self, size):
+    return self._GetDelay()
+
+  def OutBoundDelay(self, size):
+    return self._GetDelay()
+
+
+class LossFilter(cros_test_proxy.Filter):
+  """Emulates the loss of TCP segments in each direction.
+
+  The proxy carries a byte stream, so segments cannot actually be dropped.
+  Instead, the data behind every lost segment waits for its retransmission,
+  which is what the receiving application sees.
+  """
+
+  def __init__(self, loss_rate, retransmit_seconds=0.2, seed=None):
+    """Initializes the filter.
+
+    Args:
+      loss_rate: Probability that a segment is lost, between 0 and 1.
+      retransmit_seconds: Time taken to retransmit a lost segment. Linux
+        does not retransmit sooner than 200ms.
+      seed: Seed of the losses, to reproduce a run.
+    """
+    self.loss_rate = loss_rate
+    self.retransmit_seconds = retransmit_seconds
+    self._random = random.Random(seed)
+    self._segments_to_loss = {}
+
+  def _GetSegmentsToLoss(self):
+    """Returns the number of segments received before the next loss."""
+    if self.loss_rate <= 0:
+      return float('inf')
+    if self.loss_rate >= 1:
+      return 0
+    # Geometric distribution of the segments between two losses.
+    return int(math.log(1.0 - self._random.random()) /
+               math.log(1.0 - self.loss_rate))
+
+  def _GetDelay(self, direction, size):
+    """Returns the retransmission delay of |size| bytes going |direction|."""
+    segments = int(math.ceil(float(size) / _SEGMENT_SIZE))
+    remaining = self._segments_to_loss.get(direction)
+    if remaining is None:
+      remaining = self._GetSegmentsToLoss()
+    lost = 0
+    while remaining < segments:
+      lost += 1
+      segments -= remaining + 1
+      remaining = self._GetSegmentsToLoss()
+    self._segments_to_loss[direction] = remaining - segments
+    return lost * self.retransmit_seconds
+
+  def InBoundDelay(self, size):
+    return self._GetDelay('in', size)
+
+  def OutBoundDelay(self, size):
+    return self._GetDelay('out', size)
@@ -0,0 +1,126 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for proxy_filters."""
+
+from __future__ import print_function
+
+import socket
+import sys
+import threading
+import time
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from crostestutils.au_test_harness import cros_test_proxy
+from crostestutils.au_test_harness import proxy_filters
+
+
+class _DownloadServer(object):
+  """A server sending |size| bytes to each client, like a devserver."""
+
+  def __init__(self, size):
+    self.size = size
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.bind(('127.0.0.1', 0))
+    self._socket.listen(5)
+    self.port = self._socket.getsockname()[1]
+    thread = threading.Thread(target=self._Serve)
+    thread.setDaemon(True)
+    thread.start()
+
+  def _Serve(self):
+    while True:
+      conn, _ = self._socket.accept()
+      conn.recv(1)
+      conn.sendall('x' * self.size)
+      conn.close()
+
+
+class TokenBucketTest(unittest.TestCase):
+  """Tests the token bucket pacing BandwidthFilter."""
+
+  def testPacing(self):
+    """Tests that data beyond the burst is paced at the rate."""
+    bucket = proxy_filters._TokenBucket(1000.0, 1000)
+    self.assertEqual(0, bucket.Take(1000, 0.0))
+    self.assertAlmostEqual(1.0, bucket.Take(1000, 0.0))
+    self.assertAlmostEqual(1.0, bucket.Take(500, 0.5))
+
+  def testRefill(self):
+    """Tests that the bucket refills, but only up to the burst."""
+    bucket = proxy_filters._TokenBucket(1000.0, 1000)
+    bucket.Take(1000, 0.0)
+    self.assertEqual(0, bucket.Take(1000, 10.0))
+    self.assertAlmostEqual(0.5, bucket.Take(500, 10.0))
+
+
+class LossFilterTest(unittest.TestCase):
+  """Tests the emulation of lost segments."""
+
+  def testNoLoss(self):
+    """Tests that nothing is delayed without losses."""
+    loss_filter = proxy_filters.LossFilter(0)
+    self.assertEqual(0, loss_filter.OutBoundDelay(1024 * 1024))
+
+  def testAllLost(self):
+    """Tests that every segment waits for a retransmission."""
+    loss_filter = proxy_filters.LossFilter(1, retransmit_seconds=0.2)
+    self.assertAlmostEqual(0.4, loss_filter.OutBoundDelay(2920))
+
+  def testLossRate(self):
+    """Tests that the rate of lost segments matches the loss rate."""
+    loss_filter = proxy_filters.LossFilter(0.01, retransmit_seconds=1,
+                                           seed=0)
+    lost = sum(loss_filter.OutBoundDelay(1460 * 100) for _ in xrange(10000))
+    self.assertAlmostEqual(1.0, lost / 10000.0, delta=0.05)
+
+
+class ShapedProxyTest(unittest.TestCase):
+  """Tests downloads through a proxy shaped by the filters."""
+
+  def _Download(self, proxy_filter, size):
+    """Returns the seconds taken to download |size| bytes through a proxy."""
+    server = _DownloadServer(size)
+    proxy = cros_test_proxy.CrosTestProxy(proxy_filter, port_in=0,
+                                          port_out=server.port)
+    proxy.serve_forever_in_thread()
+    self.addCleanup(proxy.shutdown)
+
+    client = socket.create_connection(('127.0.0.1', proxy.port_in))
+    start = time.time()
+    client.sendall('x')
+    received = 0
+    for data in iter(lambda: client.recv(65536), ''):
+      received += len(data)
+    client.close()
+    self.assertEqual(size, received)
+    return time.time() - start
+
+  def testBandwidth(self):
+    """Tests that the download runs at the limited bandwidth."""
+    seconds = self._Download(proxy_filters.BandwidthFilter(4e6), 1000000)
+    self.assertAlmostEqual(2.0, seconds, delta=0.1)
+
+  def testLatency(self):
+    """Tests that latency is added to both directions."""
+    seconds = self._Download(proxy_filters.LatencyFilter(0.1), 100)
+    self.assertAlmostEqual(0.2, seconds, delta=0.05)
+
+  def testChain(self):
+    """Tests that latency does not reduce the limited bandwidth."""
+    proxy_filter = cros_test_proxy.FilterChain([
+        proxy_filters.BandwidthFilter(4e6),
+        proxy_filters.LatencyFilter(0.1, jitter=0.01)])
+    seconds = self._Download(proxy_filter, 1000000)
+    self.assertAlmostEqual(2.2, seconds, delta=0.1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,17 +8,41 @@ import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import path_util
 from crostestutils.au_test_harness import au_worker
+from crostestutils.lib import resource_lease
 
 
 class RealAUWorker(au_worker.AUWorker):
-  """Test harness for updating real images."""
+  """Test harness for updating real images.
+
+  Every test leases a device from the pool given by --remote in Initialize,
+  and returns it in CleanUp, so tests can run in parallel on different
+  devices of the pool.
+  """
 
   def __init__(self, options, test_results_root):
     """Processes non-vm-specific options."""
     super(RealAUWorker, self).__init__(options, test_results_root)
-    self.remote = options.remote
-    if not self.remote:
+    if not options.remote:
       cros_build_lib.Die('We require a remote address for tests.')
+    self.remotes = GetRemotes(options)
+    self.remote = None
+    self._device_lease = None
+
+  def Initialize(self, port=None):
+    """Leases a device for this test, waiting for one if all are leased."""
+    super(RealAUWorker, self).Initialize(port)
+    self._device_lease = resource_lease.LeaseResource(
+        self.remotes, constants.DEVICE_LOCK_DIR,
+        timeout=constants.MAX_TIMEOUT_SECONDS)
+    self.remote = self._device_lease.name
+    self.TestInfo('Leased device %s.' % self.remote)
+
+  def CleanUp(self):
+    """Returns the device of this test to the pool."""
+    if self._device_lease:
+      self._device_lease.Release()
+      self._device_lease = None
+    super(RealAUWorker, self).CleanUp()
 
   def PrepareBase(self, image_path, signed_base=False):
     """Auto-update to base image to prepare for test."""
@@ -61,10 +85,13 @@ class RealAUWorker(au_worker.AUWorker):
       cmd.append('--ssh_private_key=%s' %
                  path_util.ToChrootPath(self.ssh_private_key))
 
-    result = cros_build_lib.RunCommand(cmd, error_code_ok=True,
-                                       enter_chroot=True, redirect_stdout=True,
-                                       cwd=constants.CROSUTILS_DIR)
-
-    return self.AssertEnoughTestsPassed(unittest, result.output,
+    _, result = self.RunTestCommand(cmd, test_directory + '.log',
+                                    enter_chroot=True)
+    return self.AssertEnoughTestsPassed(unittest, result,
                                         percent_required_to_pass)
 
+
+def GetRemotes(options):
+  """Returns the list of device addresses given by --remote."""
+  return [remote.strip() for remote in options.remote.split(',')
+          if remote.strip()]
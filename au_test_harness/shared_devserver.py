@@ -0,0 +1,233 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a devserver shared by all harness runs on a checkout.
+
+Starting a devserver and warming up its cache takes a while for every run. A
+shared devserver is started on demand by a keeper process (this module run as
+a script) that outlives the run starting it, is used by any number of runs,
+and is stopped by its keeper once no run has used it for an idle timeout.
+
+The devserver serves the payloads of its checkout's chroot, so each checkout
+has its own. Its keeper leases its port from port_allocator for as long as it
+runs, so the devservers of all checkouts on a host, shared or not, never
+conflict; runs read the port from the state file.
+
+Runs using the devserver hold a shared flock on the users lock file, which the
+kernel releases however they exit. The keeper considers the devserver idle
+while it can lock that file exclusively. Starting the keeper, attaching to the
+devserver and stopping it are serialized by the flock of the state file, so a
+run never attaches to a devserver that is being stopped.
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_logging as logging
+from chromite.lib import dev_server_wrapper
+from chromite.lib import osutils
+from chromite.lib import sudo
+from crostestutils.lib import json_store
+from crostestutils.lib import port_allocator
+from crostestutils.lib import test_helper
+
+_STATE_FILE = 'state.json'
+_USERS_LOCK = 'users.lock'
+_KEEPER_LOG = 'keeper.log'
+
+# Seconds between checks of the keeper for users of the devserver.
+_POLL_SECONDS = 5
+# Seconds to wait for a new keeper to start the devserver.
+_START_TIMEOUT = 300
+
+
+class SharedDevServerError(Exception):
+  """Raised when the shared devserver could not be started."""
+
+
+def _IsProcessAlive(pid):
+  """Returns whether a process with |pid| exists."""
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+class SharedDevServer(object):
+  """A run's use of the devserver shared by all runs on this checkout.
+
+  Has the Start and Stop methods of dev_server_wrapper.DevServerWrapper, but
+  Start attaches to the running devserver if there is one, and Stop only
+  detaches from it.
+
+  Attributes:
+    port: Port of the devserver, once attached to it.
+  """
+
+  def __init__(self, idle_timeout=constants.SHARED_DEVSERVER_IDLE_TIMEOUT,
+               state_dir=constants.SHARED_DEVSERVER_DIR):
+    """Initializes the object, without attaching to the devserver.
+
+    Args:
+      idle_timeout: Seconds without users after which a devserver started by
+        this run is stopped.
+      state_dir: Directory of the state, locks and logs of the devserver,
+        inside the chroot's /tmp.
+    """
+    self.port = None
+    self.idle_timeout = idle_timeout
+    self.state_dir = state_dir
+    self._state_file = os.path.join(state_dir, _STATE_FILE)
+    self._users_lock = None
+
+  def _ReadKeeper(self):
+    """Returns the pid of the running keeper and its port, or (None, None)."""
+    state = json_store.ReadJson(self._state_file, default={})
+    pid = state.get('pid')
+    if pid and state.get('port') and _IsProcessAlive(pid):
+      return pid, state['port']
+    return None, None
+
+  def _StartKeeper(self):
+    """Starts a keeper and waits until its devserver is ready.
+
+    Must be called with the state file locked.
+
+    Returns:
+      The port of the devserver.
+    """
+    osutils.SafeUnlink(self._state_file)
+    cmd = [sys.executable, os.path.realpath(__file__),
+           '--state_dir', self.state_dir,
+           '--idle_timeout', str(self.idle_timeout)]
+    logging.info('Starting a shared devserver.')
+    with open(os.devnull) as devnull, \
+        open(os.path.join(self.state_dir, _KEEPER_LOG), 'a') as log:
+      # The keeper runs in its own session so that it outlives this run.
+      keeper = subprocess.Popen(cmd, stdin=devnull, stdout=log,
+                                stderr=subprocess.STDOUT, close_fds=True,
+                                preexec_fn=os.setsid)
+
+    deadline = time.time() + _START_TIMEOUT
+    while time.time() < deadline:
+      if keeper.poll() is not None:
+        break
+      pid, port = self._ReadKeeper()
+      if pid == keeper.pid:
+        return port
+      time.sleep(1)
+
+    raise SharedDevServerError(
+        'Shared devserver did not start; see %s.' %
+        os.path.join(self.state_dir, _KEEPER_LOG))
+
+  def Start(self):
+    """Attaches to the shared devserver, starting it if needed.
+
+    Raises:
+      SharedDevServerError if the devserver could not be started.
+    """
+    osutils.SafeMakedirs(self.state_dir)
+    with json_store.FileLock(self._state_file):
+      pid, self.port = self._ReadKeeper()
+      if pid:
+        logging.info('Using the shared devserver of keeper %d on port %d.',
+                     pid, self.port)
+      else:
+        self.port = self._StartKeeper()
+      self._users_lock = open(os.path.join(self.state_dir, _USERS_LOCK), 'a')
+      # Commands run by this process must not keep the devserver alive.
+      fcntl.fcntl(self._users_lock, fcntl.F_SETFD,
+                  fcntl.fcntl(self._users_lock, fcntl.F_GETFD) |
+                  fcntl.FD_CLOEXEC)
+      fcntl.flock(self._users_lock, fcntl.LOCK_SH)
+
+  def Stop(self):
+    """Detaches from the shared devserver, which keeps running until idle."""
+    if self._users_lock:
+      self._users_lock.close()
+      self._users_lock = None
+
+
+def _IsIdle(users_lock):
+  """Returns whether no run is attached to the devserver."""
+  try:
+    fcntl.flock(users_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError as e:
+    if e.errno in (errno.EAGAIN, errno.EACCES):
+      return False
+    raise
+  fcntl.flock(users_lock, fcntl.LOCK_UN)
+  return True
+
+
+def RunKeeper(state_dir, idle_timeout):
+  """Runs the shared devserver until it has had no users for |idle_timeout|."""
+  with port_allocator.LeasePort(constants.DEVSERVER_PORT_RANGE) as lease:
+    _RunDevServer(state_dir, lease.port, idle_timeout)
+
+
+def _RunDevServer(state_dir, port, idle_timeout):
+  """Runs the devserver on |port| until it is idle, for RunKeeper."""
+  state_file = os.path.join(state_dir, _STATE_FILE)
+  server = dev_server_wrapper.DevServerWrapper(port=port, log_dir=state_dir)
+  server.Start()
+  json_store.WriteJsonAtomic(state_file, dict(pid=os.getpid(), port=port,
+                                              started=time.time()))
+  logging.info('Shared devserver ready on port %d.', port)
+
+  idle_since = None
+  with open(os.path.join(state_dir, _USERS_LOCK), 'a') as users_lock:
+    while True:
+      time.sleep(_POLL_SECONDS)
+      # No run can attach while the state file is locked.
+      with json_store.FileLock(state_file):
+        if not server.is_alive():
+          logging.error('Shared devserver exited.')
+        elif not _IsIdle(users_lock):
+          idle_since = None
+          continue
+        else:
+          idle_since = idle_since or time.time()
+          if time.time() - idle_since < idle_timeout:
+            continue
+          logging.info('Stopping the shared devserver after %d idle seconds.',
+                       idle_timeout)
+
+        osutils.SafeUnlink(state_file)
+        server.Stop()
+        return
+
+
+def main():
+  test_helper.SetupCommonLoggingFormat()
+  parser = optparse.OptionParser()
+  parser.add_option('--state_dir', default=constants.SHARED_DEVSERVER_DIR,
+                    help='Directory of the state and logs of the devserver.')
+  parser.add_option('--idle_timeout',
+                    default=constants.SHARED_DEVSERVER_IDLE_TIMEOUT, type=int,
+                    help='Seconds without users after which to stop the '
+                    'devserver. Default: %default.')
+  options, _ = parser.parse_args()
+
+  with sudo.SudoKeepAlive():
+    RunKeeper(options.state_dir, options.idle_timeout)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for shared_devserver."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.au_test_harness import shared_devserver
+from crostestutils.lib import json_store
+
+
+class SharedDevServerTest(cros_test_lib.TempDirTestCase):
+  """Tests attaching to and detaching from a shared devserver."""
+
+  def setUp(self):
+    self.server = shared_devserver.SharedDevServer(state_dir=self.tempdir)
+    self.users_lock_path = os.path.join(self.tempdir,
+                                        shared_devserver._USERS_LOCK)
+
+  def _WriteState(self, pid, port=8181):
+    json_store.WriteJsonAtomic(
+        os.path.join(self.tempdir, shared_devserver._STATE_FILE),
+        dict(pid=pid, port=port))
+
+  def testAttachToRunningKeeper(self):
+    """Tests that a running keeper is used and sees its user until detached."""
+    self._WriteState(os.getpid())
+    self.server.Start()
+    self.assertEqual(8181, self.server.port)
+    with open(self.users_lock_path) as users_lock:
+      self.assertFalse(shared_devserver._IsIdle(users_lock))
+      self.server.Stop()
+      self.assertTrue(shared_devserver._IsIdle(users_lock))
+
+  def testIgnoresDeadKeeper(self):
+    """Tests that the state of a keeper that exited is ignored."""
+    pid = os.fork()
+    if not pid:
+      os._exit(0)
+    os.waitpid(pid, 0)
+    self._WriteState(pid)
+    self.assertEqual((None, None), self.server._ReadKeeper())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing the durations of AU tests recorded by previous runs.
+
+Durations depend on the board and on the type of device tested, so they are
+recorded per suite, e.g. 'x86-generic/vm', along with the durations of the
+phases of each test, e.g. its updates. Each duration is a moving average over
+runs, and concurrent runs update the history under a lock.
+
+The harness runs tests longest first, so that long tests do not start last
+and become the tail of a run, and predicts when a run finishes by scheduling
+the recorded durations on its jobs.
+"""
+
+from __future__ import print_function
+
+import heapq
+import time
+
+from crostestutils.lib import json_store
+
+# Weight of the newest sample in the moving averages.
+_SMOOTHING = 0.3
+
+
+class TestHistory(object):
+  """Durations of the tests of one suite."""
+
+  def __init__(self, path, suite):
+    """Loads the history of |suite| from the JSON file |path|."""
+    self.path = path
+    self.suite = suite
+    data = json_store.ReadJson(path, default={})
+    self._tests = data.get('suites', {}).get(suite, {})
+
+  def Record(self, test_id, seconds, phases=None):
+    """Records that test |test_id| took |seconds|.
+
+    Args:
+      test_id: Id of the test.
+      seconds: Duration of the test.
+      phases: Optional dict mapping the phases of the test to their duration.
+    """
+    def _Update(data):
+      tests = data.setdefault('suites', {}).setdefault(self.suite, {})
+      stats = tests.get(test_id)
+      if stats:
+        stats['seconds'] = _Average(stats['seconds'], seconds)
+        stats['samples'] += 1
+      else:
+        stats = dict(seconds=seconds, samples=1)
+      phase_stats = stats.setdefault('phases', {})
+      for phase, phase_seconds in (phases or {}).iteritems():
+        phase_stats[phase] = _Average(phase_stats.get(phase), phase_seconds)
+      stats['updated'] = time.time()
+      tests[test_id] = stats
+      return data
+
+    data = json_store.UpdateJson(self.path, _Update, default={})
+    self._tests = data['suites'][self.suite]
+
+  def EstimateSeconds(self, test_id, default=None):
+    """Returns the recorded duration of |test_id|, or |default| if unknown."""
+    stats = self._tests.get(test_id)
+    return stats['seconds'] if stats else default
+
+  def SortLongestFirst(self, test_ids, default):
+    """Returns |test_ids| by decreasing duration, |default| if unknown."""
+    # Sort by id first so that equal durations keep a stable order.
+    return sorted(sorted(test_ids),
+                  key=lambda test_id: self.EstimateSeconds(test_id, default),
+                  reverse=True)
+
+
+def _Average(average, sample):
+  """Returns the moving |average| updated with |sample|."""
+  if average is None:
+    return sample
+  return _SMOOTHING * sample + (1 - _SMOOTHING) * average
+
+
+def PredictSeconds(durations, jobs):
+  """Returns how long running |durations| in order on |jobs| jobs takes.
+
+  Each duration starts as soon as one of the jobs is free, in order, as
+  parallel.RunParallelSteps runs its steps.
+  """
+  finish_times = [0.0] * max(1, min(jobs, len(durations)))
+  for seconds in durations:
+    heapq.heapreplace(finish_times, finish_times[0] + seconds)
+  return max(finish_times)
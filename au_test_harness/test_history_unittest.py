@@ -0,0 +1,60 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for test_history."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.au_test_harness import test_history
+from crostestutils.lib import json_store
+
+
+class TestHistoryTest(cros_test_lib.TempDirTestCase):
+  """Tests recording and using the durations of tests."""
+
+  def setUp(self):
+    self.history = test_history.TestHistory(
+        os.path.join(self.tempdir, 'history.json'), 'board/vm')
+
+  def testPhases(self):
+    """Tests that the durations of phases are averaged over runs."""
+    self.history.Record('test', 100.0, phases=dict(prepare=10.0, update=90.0))
+    self.history.Record('test', 200.0, phases=dict(update=100.0))
+    data = json_store.ReadJson(self.history.path)
+    self.assertEqual(dict(prepare=10.0, update=93.0),
+                     data['suites']['board/vm']['test']['phases'])
+
+  def testSortLongestFirst(self):
+    """Tests that tests without history count as |default|."""
+    self.history.Record('long', 900.0)
+    self.history.Record('short', 100.0)
+    self.assertEqual(['long', 'a_unknown', 'b_unknown', 'short'],
+                     self.history.SortLongestFirst(
+                         ['short', 'b_unknown', 'long', 'a_unknown'], 600.0))
+
+
+class PredictSecondsTest(unittest.TestCase):
+  """Tests predicting the duration of a run."""
+
+  def testPredictSeconds(self):
+    """Tests that durations are scheduled in order on the free jobs."""
+    self.assertEqual(0, test_history.PredictSeconds([], 4))
+    self.assertEqual(60, test_history.PredictSeconds([10, 20, 30], 1))
+    self.assertEqual(30, test_history.PredictSeconds([30, 20, 10], 2))
+    self.assertEqual(40, test_history.PredictSeconds([10, 20, 30], 2))
+
+
+if __name__ == '__main__':
+  unittest.main()
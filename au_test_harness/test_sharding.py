@@ -0,0 +1,123 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing the split of AU tests into shards and their results.
+
+The tests of a suite can be split over several harness processes, usually on
+different hosts, with --total_shards and --shard_index. Every shard computes
+the same split of the suite from input identical on all shards: the sorted
+test ids, dealt round-robin, or, when given explicitly, a read-only
+test_history.TestHistory whose tests are assigned longest first to the shard
+with the least work so far. The history each host records is never used, as
+it only holds the durations of the tests that host ran. The digest of the
+split is recorded in each shard's summary so that merging results from
+inconsistent splits fails instead of missing tests.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+
+from crostestutils.lib import content_hash
+from crostestutils.lib import json_store
+
+# File name of the summary of a shard's results in its results directory.
+SUMMARY_FILE = 'summary.json'
+
+# Duration assumed for tests without history.
+DEFAULT_TEST_SECONDS = 600.0
+
+# Statuses of a test in a summary.
+PASS = 'pass'
+FAIL = 'fail'
+# Tests stopped or never started by --fail_fast after another test failed.
+CANCELLED = 'cancelled'
+
+
+class ShardMergeError(Exception):
+  """Raised when the summaries of shards cannot be merged consistently."""
+
+
+def SplitTests(test_ids, total_shards, history=None):
+  """Returns |test_ids| split into |total_shards| lists of balanced duration.
+
+  Args:
+    test_ids: Ids of the tests of the suite.
+    total_shards: Number of shards.
+    history: Optional test_history.TestHistory to estimate durations with,
+      identical on all shards. Without history, all tests are assumed to take
+      as long, so they are dealt round-robin by id.
+  """
+  def _Estimate(test_id):
+    if history:
+      return history.EstimateSeconds(test_id, DEFAULT_TEST_SECONDS)
+    return DEFAULT_TEST_SECONDS
+
+  shards = [[] for _ in range(total_shards)]
+  loads = [0.0] * total_shards
+  # Sort by id first so that equal durations are assigned in a stable order.
+  for test_id in sorted(sorted(test_ids), key=_Estimate, reverse=True):
+    shard = loads.index(min(loads))
+    shards[shard].append(test_id)
+    loads[shard] += _Estimate(test_id)
+  return shards
+
+
+def GetSplitDigest(shards):
+  """Returns a digest identifying a split returned by SplitTests."""
+  return content_hash.HashString(json.dumps(shards, sort_keys=True))
+
+
+def WriteSummary(results_dir, shard_index, total_shards, split_digest,
+                 results):
+  """Writes the summary of a shard's results to |results_dir|.
+
+  Args:
+    results_dir: The test results root of the shard.
+    shard_index: Index of the shard.
+    total_shards: Number of shards.
+    split_digest: GetSplitDigest of the split the shard ran its part of.
+    results: Dict mapping the id of every test run to a dict with its 'status'
+      (PASS, FAIL or CANCELLED) and the 'seconds' it took.
+  """
+  json_store.WriteJsonAtomic(
+      os.path.join(results_dir, SUMMARY_FILE),
+      dict(shard_index=shard_index, total_shards=total_shards,
+           split_digest=split_digest, tests=results))
+
+
+def MergeSummaries(summaries):
+  """Returns the test results of all shards of a run.
+
+  Args:
+    summaries: List of summaries written by WriteSummary, one per shard.
+
+  Returns:
+    A dict mapping the id of every test to its result, as in WriteSummary.
+
+  Raises:
+    ShardMergeError if shards are missing or repeated, or split the suite
+    differently.
+  """
+  if not summaries:
+    raise ShardMergeError('No shard summaries to merge.')
+
+  total_shards = summaries[0]['total_shards']
+  indices = sorted(summary['shard_index'] for summary in summaries)
+  if indices != range(total_shards):
+    raise ShardMergeError('Expected shards 0 to %d, got %s.' %
+                          (total_shards - 1, indices))
+
+  if len(set(summary['split_digest'] for summary in summaries)) != 1:
+    raise ShardMergeError('Shards split the suite differently; all shards '
+                          'must use the same shard history file.')
+
+  results = {}
+  for summary in summaries:
+    for test_id, result in summary['tests'].iteritems():
+      if test_id in results:
+        raise ShardMergeError('%s ran in more than one shard.' % test_id)
+      results[test_id] = result
+  return results
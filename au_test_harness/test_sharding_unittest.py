@@ -0,0 +1,93 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for test_sharding and merge_shard_results."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.au_test_harness import merge_shard_results
+from crostestutils.au_test_harness import test_history
+from crostestutils.au_test_harness import test_sharding
+
+
+class SplitTestsTest(cros_test_lib.TempDirTestCase):
+  """Tests splitting a suite into shards."""
+
+  def setUp(self):
+    self.history = test_history.TestHistory(
+        os.path.join(self.tempdir, 'history.json'), 'board/vm')
+
+  def testSplitWithoutHistory(self):
+    """Tests that tests without history are dealt round-robin by id."""
+    shards = test_sharding.SplitTests(['d', 'c', 'b', 'a'], 2)
+    self.assertEqual([['a', 'c'], ['b', 'd']], shards)
+
+  def testSplitBalancesHistory(self):
+    """Tests that recorded durations balance the shards."""
+    self.history.Record('long', 900.0)
+    self.history.Record('short1', 300.0)
+    self.history.Record('short2', 300.0)
+    self.history.Record('short3', 300.0)
+    reloaded = test_history.TestHistory(self.history.path, 'board/vm')
+    shards = test_sharding.SplitTests(
+        ['short1', 'short2', 'short3', 'long'], 2, reloaded)
+    self.assertEqual([['long'], ['short1', 'short2', 'short3']], shards)
+
+
+class MergeShardResultsTest(cros_test_lib.TempDirTestCase):
+  """Tests merging the results of shards."""
+
+  def _WriteShard(self, shard_index, results, split_digest='split'):
+    """Writes the results directory of a shard and returns its path."""
+    shard_dir = os.path.join(self.tempdir, 'shard%d' % shard_index)
+    for test_id in results:
+      osutils.WriteFile(os.path.join(shard_dir, 'all', test_id, 'log'),
+                        test_id, makedirs=True)
+    osutils.WriteFile(os.path.join(shard_dir, 'devserver.log'), 'log')
+    test_sharding.WriteSummary(shard_dir, shard_index, 2, split_digest,
+                               results)
+    return shard_dir
+
+  def testMerge(self):
+    """Tests that results of all shards are merged."""
+    output_dir = os.path.join(self.tempdir, 'merged')
+    shard_dirs = [
+        self._WriteShard(0, {'a': dict(status='pass', seconds=1.0)}),
+        self._WriteShard(1, {'b': dict(status='fail', seconds=2.0)}),
+    ]
+    results = merge_shard_results.MergeShardResults(shard_dirs, output_dir)
+    self.assertEqual(['a', 'b'], sorted(results))
+    self.assertExists(os.path.join(output_dir, 'all', 'a', 'log'))
+    self.assertExists(os.path.join(output_dir, 'all', 'b', 'log'))
+    self.assertExists(os.path.join(output_dir, 'shard_1', 'devserver.log'))
+    self.assertExists(os.path.join(output_dir, test_sharding.SUMMARY_FILE))
+
+  def testInconsistentShards(self):
+    """Tests that missing shards and different splits are errors."""
+    output_dir = os.path.join(self.tempdir, 'merged')
+    shard0 = self._WriteShard(0, {'a': dict(status='pass', seconds=1.0)})
+    self.assertRaises(test_sharding.ShardMergeError,
+                      merge_shard_results.MergeShardResults, [shard0],
+                      output_dir)
+    shard1 = self._WriteShard(1, {'b': dict(status='pass', seconds=1.0)},
+                              split_digest='other')
+    self.assertRaises(test_sharding.ShardMergeError,
+                      merge_shard_results.MergeShardResults, [shard0, shard1],
+                      output_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,236 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a streaming parser of the output of test_that.
+
+test_that logs the tab-separated autotest status lines of every test as it
+runs, e.g.
+
+  ... server_job:0153|   START  login_Login  login_Login  timestamp=1458582451
+  ... server_job:0153|   END FAIL  login_Login  login_Login  timestamp=...  Oops
+
+and ends with the report of generate_test_report:
+
+  /tmp/test_that_results_x/results-1-login_Login      [  FAILED  ]
+  /tmp/test_that_results_x/results-1-login_Login        FAIL: Oops
+  Total PASS: 0/1 (0%)
+
+The parser is fed one line at a time and only keeps the results of each test,
+so outputs of any size are parsed in memory proportional to the number of
+tests.
+"""
+
+from __future__ import print_function
+
+import collections
+import re
+
+# Statuses of tests, as reported by generate_test_report.
+PASS = 'PASS'
+FAIL = 'FAIL'
+ERROR = 'ERROR'
+ABORT = 'ABORT'
+WARN = 'WARN'
+TEST_NA = 'TEST_NA'
+
+# Statuses of autotest status lines and of the report, mapped to ours.
+_STATUSES = {
+    'GOOD': PASS,
+    'PASSED': PASS,
+    'FAIL': FAIL,
+    'FAILED': FAIL,
+    'ERROR': ERROR,
+    'ABORT': ABORT,
+    'WARN': WARN,
+    'TEST_NA': TEST_NA,
+}
+
+# Tests with these statuses count as passed.
+_PASSING_STATUSES = (PASS, WARN, TEST_NA)
+
+_STATUS_LINE_RE = re.compile(
+    r'\t(START|END (\w+))\t(\S+)\t(\S+)\t(.*)$')
+_REPORT_LINE_RE = re.compile(r'^(\S+)\s+\[\s+(\w+)\s+\]$')
+_REPORT_REASON_RE = re.compile(r'^(\S+)\s+(\w+): (.*)$')
+_TOTAL_RE = re.compile(r'^Total PASS: (\d+)/(\d+) \((\d+)%\)')
+_TIMESTAMP_RE = re.compile(r'(?:^|\t)timestamp=(\d+)')
+_RESULTS_DIR_RE = re.compile(r'^results-\d+-')
+
+# Printed by test scripts when a run has warnings for the buildbot.
+_WARNINGS_MARKER = '@@@STEP_WARNINGS@@@'
+
+
+class TestResult(object):
+  """Result of a single test.
+
+  Attributes:
+    name: Name of the test, e.g. login_LoginSuccess.
+    status: One of the statuses of this module, or None while running.
+    seconds: Duration of the test, or None if unknown.
+    reason: Why the test did not pass, or None.
+  """
+
+  def __init__(self, name, status=None, seconds=None, reason=None):
+    self.name = name
+    self.status = status
+    self.seconds = seconds
+    self.reason = reason
+
+  def Passed(self):
+    return self.status in _PASSING_STATUSES
+
+  def __str__(self):
+    text = '%-8s %s' % (self.status, self.name)
+    if self.seconds is not None:
+      text += ' (%ds)' % self.seconds
+    if self.reason:
+      text += ': %s' % self.reason
+    return text
+
+
+class VerificationResult(object):
+  """Results of verifying an image with test_that.
+
+  Is true if the verification passed, so that it can be used like the boolean
+  VerifyImage used to return.
+
+  Attributes:
+    tests: OrderedDict mapping test names to their TestResult.
+    percent_passed: Percentage of tests that passed.
+    warnings: Whether the output reported warnings.
+    passed: Whether the verification passed. By default, whether all tests
+      passed; workers may require less.
+    log_file: Path of the full output, if kept.
+  """
+
+  def __init__(self, tests=None, percent_passed=0, warnings=False,
+               log_file=None):
+    self.tests = tests or collections.OrderedDict()
+    self.percent_passed = percent_passed
+    self.warnings = warnings
+    self.passed = percent_passed == 100
+    self.log_file = log_file
+
+  def __nonzero__(self):
+    return self.passed
+
+  def GetFailedTests(self):
+    """Returns the TestResult of every test that did not pass."""
+    return [test for test in self.tests.itervalues() if not test.Passed()]
+
+  def Summary(self):
+    """Returns a text summary of the results of all tests."""
+    lines = [str(test) for test in self.tests.itervalues()]
+    lines.append('%d%% of %d tests passed.' % (self.percent_passed,
+                                               len(self.tests)))
+    if self.log_file:
+      lines.append('Full output: %s' % self.log_file)
+    return '\n'.join(lines)
+
+  @classmethod
+  def Merge(cls, results):
+    """Returns the results of several verifications as one.
+
+    The merged verification passed if all of |results| passed.
+    """
+    merged = cls()
+    for result in results:
+      merged.tests.update(result.tests)
+      merged.warnings |= result.warnings
+    if merged.tests:
+      merged.percent_passed = (100 * (len(merged.tests) -
+                                      len(merged.GetFailedTests())) //
+                               len(merged.tests))
+    merged.passed = bool(results) and all(results)
+    return merged
+
+
+class TestThatParser(object):
+  """Incremental parser of the output of test_that."""
+
+  def __init__(self):
+    self._tests = collections.OrderedDict()
+    self._start_times = {}
+    self._report_test = None
+    self._percent_passed = None
+    self._warnings = False
+
+  def _GetTest(self, name):
+    if name not in self._tests:
+      self._tests[name] = TestResult(name)
+    return self._tests[name]
+
+  def ParseLine(self, line):
+    """Parses the next line of output.
+
+    Returns:
+      The TestResult of a test if |line| reports that it finished, else None.
+    """
+    line = line.rstrip('\r\n')
+    if _WARNINGS_MARKER in line:
+      self._warnings = True
+
+    match = _STATUS_LINE_RE.search(line)
+    if match:
+      return self._ParseStatusLine(match)
+
+    match = _REPORT_LINE_RE.match(line)
+    if match:
+      path, status = match.groups()
+      self._report_test = (path, self._GetTest(_GetTestName(path)))
+      self._report_test[1].status = _STATUSES.get(status, status)
+      return None
+
+    match = _REPORT_REASON_RE.match(line)
+    if match and self._report_test and match.group(1) == self._report_test[0]:
+      self._report_test[1].reason = '%s: %s' % match.groups()[1:]
+      return None
+
+    match = _TOTAL_RE.match(line)
+    if match:
+      self._percent_passed = int(match.group(3))
+    return None
+
+  def _ParseStatusLine(self, match):
+    """Records an autotest status line, returning the test it finishes."""
+    subdir, name = match.group(3), match.group(4)
+    if subdir == '----':
+      # Steps of the job itself, e.g. reboots.
+      return None
+    timestamp = _TIMESTAMP_RE.search(match.group(5))
+    timestamp = int(timestamp.group(1)) if timestamp else None
+
+    if match.group(1) == 'START':
+      self._start_times[name] = timestamp
+      return None
+
+    test = self._GetTest(name)
+    status = match.group(2)
+    test.status = _STATUSES.get(status, status)
+    start = self._start_times.pop(name, None)
+    if start is not None and timestamp is not None:
+      test.seconds = timestamp - start
+    # The reason follows the key=value fields.
+    fields = [field for field in match.group(5).split('\t')
+              if field and '=' not in field.split(' ')[0]]
+    if fields and not test.Passed():
+      test.reason = fields[-1]
+    return test
+
+  def GetResult(self):
+    """Returns the VerificationResult of the output parsed so far."""
+    percent_passed = self._percent_passed
+    if percent_passed is None:
+      # The output ended before the report, e.g. on a timeout.
+      passed = [test for test in self._tests.itervalues() if test.Passed()]
+      percent_passed = (100 * len(passed) // len(self._tests) if self._tests
+                        else 0)
+    return VerificationResult(collections.OrderedDict(self._tests),
+                              percent_passed, self._warnings)
+
+
+def _GetTestName(path):
+  """Returns the name of the test whose results are in |path|."""
+  return _RESULTS_DIR_RE.sub('', path.rstrip('/').rpartition('/')[2])
+
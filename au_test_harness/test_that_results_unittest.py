@@ -0,0 +1,110 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for test_that_results."""
+
+from __future__ import print_function
+
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from crostestutils.au_test_harness import test_that_results
+
+_PREFIX = '03/21 10:47:31.000 INFO |        server_job:0153| '
+_RESULTS = '/tmp/test_that_results_x/results-%d-%s'
+
+_OUTPUT = '\n'.join([
+    _PREFIX + '\tSTART\t----\treboot\ttimestamp=1458582400\tlocaltime=x',
+    _PREFIX + '\tEND GOOD\t----\treboot\ttimestamp=1458582440\tlocaltime=x',
+    _PREFIX + ('\tSTART\tlogin_LoginSuccess\tlogin_LoginSuccess\t'
+               'timestamp=1458582451\tlocaltime=Mar 21 10:47:31'),
+    _PREFIX + ('\tEND GOOD\tlogin_LoginSuccess\tlogin_LoginSuccess\t'
+               'timestamp=1458582481\tlocaltime=Mar 21 10:48:01\t'
+               'completed successfully'),
+    _PREFIX + ('\tSTART\tdesktopui_ScreenLocker\tdesktopui_ScreenLocker\t'
+               'timestamp=1458582490\tlocaltime=Mar 21 10:48:10'),
+    _PREFIX + ('\tEND FAIL\tdesktopui_ScreenLocker\tdesktopui_ScreenLocker\t'
+               'timestamp=1458582502\tlocaltime=Mar 21 10:48:22\t'
+               'Screen did not lock'),
+    '',
+    (_RESULTS % (1, 'login_LoginSuccess')).ljust(70) + '[  PASSED  ]',
+    (_RESULTS % (2, 'desktopui_ScreenLocker')).ljust(70) + '[  FAILED  ]',
+    (_RESULTS % (2, 'desktopui_ScreenLocker')).ljust(72) +
+    'FAIL: Screen did not lock',
+    '',
+    'Total PASS: 1/2 (50%)',
+    '@@@STEP_WARNINGS@@@',
+    '',
+])
+
+
+class TestThatParserTest(unittest.TestCase):
+  """Tests parsing the output of test_that."""
+
+  def _Parse(self, output):
+    parser = test_that_results.TestThatParser()
+    finished = [parser.ParseLine(line) for line in output.splitlines(True)]
+    return [test.name for test in finished if test], parser.GetResult()
+
+  def testParse(self):
+    """Tests that each test is reported with its status, time and reason."""
+    finished, result = self._Parse(_OUTPUT)
+    self.assertEqual(['login_LoginSuccess', 'desktopui_ScreenLocker'],
+                     finished)
+    self.assertEqual(50, result.percent_passed)
+    self.assertTrue(result.warnings)
+    self.assertFalse(result)
+
+    login = result.tests['login_LoginSuccess']
+    self.assertEqual(test_that_results.PASS, login.status)
+    self.assertEqual(30, login.seconds)
+    self.assertIsNone(login.reason)
+
+    [locker] = result.GetFailedTests()
+    self.assertEqual('desktopui_ScreenLocker', locker.name)
+    self.assertEqual(test_that_results.FAIL, locker.status)
+    self.assertEqual(12, locker.seconds)
+    self.assertEqual('FAIL: Screen did not lock', locker.reason)
+
+  def testTruncatedOutput(self):
+    """Tests that tests are counted when the output ends before the report."""
+    _, result = self._Parse(_OUTPUT.partition('\n\n')[0])
+    self.assertEqual(50, result.percent_passed)
+    self.assertEqual('Screen did not lock',
+                     result.tests['desktopui_ScreenLocker'].reason)
+
+  def testNoOutput(self):
+    """Tests that no output does not pass."""
+    _, result = self._Parse('')
+    self.assertEqual(0, result.percent_passed)
+    self.assertFalse(result)
+
+
+class VerificationResultTest(unittest.TestCase):
+  """Tests VerificationResult."""
+
+  def testMerge(self):
+    """Tests that merged results pass only if all of them passed."""
+    passed = test_that_results.VerificationResult(percent_passed=100)
+    passed.tests['a'] = test_that_results.TestResult(
+        'a', test_that_results.PASS)
+    failed = test_that_results.VerificationResult()
+    failed.tests['b'] = test_that_results.TestResult(
+        'b', test_that_results.ERROR)
+    self.assertTrue(test_that_results.VerificationResult.Merge([passed]))
+
+    merged = test_that_results.VerificationResult.Merge([passed, failed])
+    self.assertFalse(merged)
+    self.assertEqual(50, merged.percent_passed)
+    self.assertFalse(test_that_results.VerificationResult.Merge([]))
+
+
+if __name__ == '__main__':
+  unittest.main()
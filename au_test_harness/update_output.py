@@ -0,0 +1,152 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a runner of update commands with bounded memory.
+
+Update commands such as cros_run_vm_update and image_to_live.sh can print a
+lot, especially with --verbose, and parallel workers each run one. Their
+output is streamed a line at a time to a log file or the terminal, and only
+its last lines are kept in memory to report failures.
+"""
+
+from __future__ import print_function
+
+import collections
+import re
+import subprocess
+import sys
+
+from chromite.lib import cros_build_lib
+
+# Number of lines of output kept to report a failure.
+DEFAULT_TAIL_LINES = 100
+
+# Progress reported by update_engine_client --status, between 0 and 1, or by
+# the update scripts, as a percentage.
+_FRACTION_PROGRESS_RE = re.compile(r'\bPROGRESS=([01](?:\.\d+)?)\b')
+_PERCENT_PROGRESS_RE = re.compile(r'(?i)(?:progress|download).*?'
+                                  r'\b(\d{1,3}(?:\.\d+)?)%')
+
+
+def ParseProgress(line):
+  """Returns the update progress reported by |line| in percent, or None."""
+  match = _FRACTION_PROGRESS_RE.search(line)
+  if match:
+    return float(match.group(1)) * 100
+  match = _PERCENT_PROGRESS_RE.search(line)
+  if match and float(match.group(1)) <= 100:
+    return float(match.group(1))
+  return None
+
+
+class UpdateOutput(object):
+  """Consumes the output of an update command a line at a time.
+
+  Attributes:
+    progress: Last update progress reported in percent, or None.
+    lines: Number of lines consumed.
+  """
+
+  def __init__(self, out=None, tail_lines=DEFAULT_TAIL_LINES,
+               progress_callback=None, progress_step=10, line_callback=None):
+    """Initializes the object.
+
+    Args:
+      out: File object each line is written to, or None to drop them.
+      tail_lines: Number of last lines to keep.
+      progress_callback: Function called with the progress in percent when it
+        crosses a multiple of |progress_step|.
+      progress_step: Percentage between two calls of |progress_callback|.
+      line_callback: Function called with each line, e.g. to parse it.
+    """
+    self.progress = None
+    self.lines = 0
+    self._out = out
+    self._tail = collections.deque(maxlen=tail_lines)
+    self._progress_callback = progress_callback
+    self._progress_step = progress_step
+    self._line_callback = line_callback
+
+  def ParseLine(self, line):
+    """Consumes the next line of output."""
+    self.lines += 1
+    self._tail.append(line)
+    if self._out:
+      self._out.write(line)
+      self._out.flush()
+    if self._line_callback:
+      self._line_callback(line)
+
+    progress = ParseProgress(line)
+    if progress is None:
+      return
+    previous = self.progress
+    self.progress = progress
+    if self._progress_callback and (
+        previous is None or
+        progress // self._progress_step > previous // self._progress_step):
+      self._progress_callback(progress)
+
+  def GetTail(self):
+    """Returns the last lines of output as a string."""
+    tail = ''.join(self._tail)
+    if self.lines > len(self._tail):
+      tail = '[... %d earlier lines omitted ...]\n%s' % (
+          self.lines - len(self._tail), tail)
+    return tail
+
+
+def GetChrootCommand(cmd, chroot_args=None):
+  """Returns |cmd| run in the chroot as cros_build_lib.RunCommand runs it.
+
+  Args:
+    cmd: The command to run.
+    chroot_args: Arguments for cros_sdk, as for cros_build_lib.RunCommand.
+  """
+  if cros_build_lib.IsInsideChroot():
+    return cmd
+  return ['cros_sdk'] + (chroot_args or []) + ['--'] + cmd
+
+
+def RunUpdateCommand(cmd, log_file=None, echo=False, cwd=None,
+                     enter_chroot=False, chroot_args=None, **kwargs):
+  """Runs |cmd|, streaming its combined stdout and stderr.
+
+  Args:
+    cmd: The command to run.
+    log_file: File to write the output to, or None.
+    echo: Whether to write the output to stdout when there is no |log_file|.
+    cwd: Directory to run |cmd| in, or None for the current one.
+    enter_chroot: Whether to run |cmd| inside the chroot.
+    chroot_args: Arguments for cros_sdk if |enter_chroot|.
+    kwargs: Arguments for UpdateOutput.
+
+  Returns:
+    A tuple of the return code of |cmd| and its UpdateOutput.
+  """
+  if enter_chroot:
+    cmd = GetChrootCommand(cmd, chroot_args=chroot_args)
+  log = open(log_file, 'w') if log_file else None
+  try:
+    output = UpdateOutput(out=log or (sys.stdout if echo else None),
+                          **kwargs)
+    # cros_build_lib.RunCommand only returns the output once the command
+    # exits, whereas updates are reported and parsed as they are printed, and
+    # verbose outputs must not be held in memory.
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True,
+                            cwd=cwd)
+    try:
+      for line in iter(proc.stdout.readline, ''):
+        output.ParseLine(line)
+      return proc.wait(), output
+    finally:
+      # Do not leave the command running if the harness is interrupted.
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+      proc.stdout.close()
+  finally:
+    if log:
+      log.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for update_output."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.au_test_harness import update_output
+
+
+class ParseProgressTest(unittest.TestCase):
+  """Tests parsing the progress of updates."""
+
+  def testParseProgress(self):
+    """Tests the formats of progress of update_engine and update scripts."""
+    self.assertAlmostEqual(52.0, update_output.ParseProgress(
+        'PROGRESS=0.520000'))
+    self.assertEqual(30.0, update_output.ParseProgress(
+        'INFO: Download progress: 30%'))
+    self.assertIsNone(update_output.ParseProgress('Disk is 30% full'))
+    self.assertIsNone(update_output.ParseProgress('Update complete'))
+
+
+class UpdateOutputTest(unittest.TestCase):
+  """Tests consuming the output of updates."""
+
+  def testTail(self):
+    """Tests that only the last lines are kept."""
+    output = update_output.UpdateOutput(tail_lines=2)
+    for i in xrange(5):
+      output.ParseLine('line %d\n' % i)
+    self.assertEqual('[... 3 earlier lines omitted ...]\nline 3\nline 4\n',
+                     output.GetTail())
+
+  def testProgressCallback(self):
+    """Tests that progress is reported at each step."""
+    reported = []
+    output = update_output.UpdateOutput(progress_callback=reported.append,
+                                        progress_step=25)
+    for progress in ('0.0', '0.1', '0.3', '0.35', '0.8', '1.0'):
+      output.ParseLine('PROGRESS=%s\n' % progress)
+    self.assertEqual([0.0, 30.0, 80.0, 100.0], reported)
+    self.assertEqual(100.0, output.progress)
+
+
+class RunUpdateCommandTest(cros_test_lib.TempDirTestCase):
+  """Tests running update commands."""
+
+  def testLogFile(self):
+    """Tests that all output is logged and its tail returned."""
+    log_file = os.path.join(self.tempdir, 'update.log')
+    returncode, output = update_output.RunUpdateCommand(
+        ['sh', '-c', 'seq 1000; echo failed >&2; exit 3'], log_file=log_file,
+        tail_lines=2)
+    self.assertEqual(3, returncode)
+    self.assertEqual(1001, len(osutils.ReadFile(log_file).splitlines()))
+    self.assertTrue(output.GetTail().endswith('\n1000\nfailed\n'))
+
+  def testLineCallback(self):
+    """Tests that every line is passed on as it is read, run from |cwd|."""
+    lines = []
+    returncode, _ = update_output.RunUpdateCommand(
+        ['sh', '-c', 'pwd; echo done'], cwd=self.tempdir,
+        line_callback=lines.append)
+    self.assertEqual(0, returncode)
+    self.assertEqual([os.path.realpath(self.tempdir) + '\n', 'done\n'], lines)
+
+  def testGetChrootCommand(self):
+    """Tests that commands enter the chroot only from outside of it."""
+    original = cros_build_lib.IsInsideChroot
+    self.addCleanup(setattr, cros_build_lib, 'IsInsideChroot', original)
+    cros_build_lib.IsInsideChroot = lambda: False
+    self.assertEqual(['cros_sdk', '--no-ns-pid', '--', 'true'],
+                     update_output.GetChrootCommand(
+                         ['true'], chroot_args=['--no-ns-pid']))
+    cros_build_lib.IsInsideChroot = lambda: True
+    self.assertEqual(['true'], update_output.GetChrootCommand(['true']))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,14 +6,22 @@
 
 import os
 import shutil
+import sys
 import tempfile
 
 import constants
 from chromite.cbuildbot import constants as buildbot_constants
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from chromite.lib import timeout_util
 from crostestutils.au_test_harness import au_worker
+from crostestutils.au_test_harness import failure_archiver
+from crostestutils.au_test_harness import test_that_results
 from crostestutils.au_test_harness import update_exception
+from crostestutils.au_test_harness import vm_snapshot
+from crostestutils.lib import admission_control
+from crostestutils.lib import disk_util
 
 
 class VMAUWorker(au_worker.AUWorker):
@@ -27,6 +35,17 @@ class VMAUWorker(au_worker.AUWorker):
     if not self.board:
       cros_build_lib.Die('Need board to convert base image to vm.')
     self.whitelist_chrome_crashes = options.whitelist_chrome_crashes
+    self.vm_snapshots = options.vm_snapshots
+    # Shared VM image the private disk of the VM was created from.
+    self._base_vm_image_path = None
+    # VMSnapshot the VM was restored from, if any.
+    self._snapshot = None
+    # Private directory holding the private disk of the VM.
+    self._private_disk_dir = None
+    self._admission = None
+    # Set by Initialize, which may fail before, e.g. when cancelled while
+    # waiting for admission.
+    self._kvm_pid_file = None
 
   def _KillExistingVM(self, pid_file, save_mem_path=None):
     """Kills an existing VM specified by the pid_file."""
@@ -40,21 +59,53 @@ class VMAUWorker(au_worker.AUWorker):
     cros_build_lib.RunCommand(cmd, print_cmd=False, error_code_ok=True,
                               cwd=constants.CROSUTILS_DIR)
 
+  def Initialize(self, port=None):
+    """Waits until the host can run another VM, then initializes the test."""
+    self._admission = admission_control.Admit(admission_control.VM_JOB)
+    try:
+      super(VMAUWorker, self).Initialize(port)
+    except BaseException:
+      # Release the admission right away rather than only in CleanUp.
+      self._admission.Release()
+      self._admission = None
+      raise
+
   def CleanUp(self):
-    """Stop the vm after a test."""
-    self._KillExistingVM(self._kvm_pid_file)
+    """Stop the vm after a test and remove its private disk."""
+    if self._kvm_pid_file:
+      self._KillExistingVM(self._kvm_pid_file)
+    if self._private_disk_dir:
+      osutils.RmDir(self._private_disk_dir, ignore_missing=True)
+      self._private_disk_dir = None
+    if self._snapshot:
+      self._snapshot.Release()
+      self._snapshot = None
+    super(VMAUWorker, self).CleanUp()
+    if self._admission:
+      self._admission.Release()
+      self._admission = None
 
   def PrepareBase(self, image_path, signed_base=False):
     """Creates an update-able VM based on base image."""
     original_image_path = self.PrepareVMBase(image_path, signed_base)
+    self._base_vm_image_path = self.vm_image_path
+    self._snapshot = None
     # This worker may be running in parallel with other VMAUWorkers, as
-    # well as the archive stage of cbuildbot. Make a private copy of
-    # the VM image, to avoid any conflict.
-    _, private_image_path = tempfile.mkstemp(
-        prefix="%s." % buildbot_constants.VM_DISK_PREFIX)
-    shutil.copy(self.vm_image_path, private_image_path)
-    self.TestInfo('Copied shared disk image %s to %s.' %
-                  (self.vm_image_path, private_image_path))
+    # well as the archive stage of cbuildbot. Make a private disk from
+    # the VM image, to avoid any conflict. Where the filesystem supports
+    # reflinks, the private disk shares the blocks of the VM image; elsewhere,
+    # e.g. on ext4, it is a sparse copy, which takes a while for every test.
+    # It is created in a private directory, as it must not exist beforehand,
+    # which CleanUp removes. VMs restored from a snapshot run on a private
+    # overlay backed by the snapshot's own copy of the VM image instead.
+    self._private_disk_dir = tempfile.mkdtemp(
+        prefix='%s.' % buildbot_constants.VM_DISK_PREFIX)
+    private_image_path = os.path.join(
+        self._private_disk_dir, '%s.bin' % buildbot_constants.VM_DISK_PREFIX)
+    if not self.vm_snapshots or not self._RestoreSnapshot(private_image_path):
+      method = disk_util.CloneFile(self.vm_image_path, private_image_path)
+      self.TestInfo('Created %s of shared disk image %s at %s.' %
+                    (method, self.vm_image_path, private_image_path))
     self.vm_image_path = private_image_path
     # Although we will run the VM with |private_image_path|, we return
     # |original_image_path|, because our return value is used to find the
@@ -62,27 +113,84 @@ class VMAUWorker(au_worker.AUWorker):
     # that share the original image.
     return original_image_path
 
+  def _RestoreSnapshot(self, private_image_path):
+    """Starts the VM from a snapshot of the shared disk image booted to ssh.
+
+    Args:
+      private_image_path: Path of the private disk to create for the VM.
+
+    Returns:
+      Whether the VM was started. If not, it is left to be booted by the first
+      update or test.
+    """
+    try:
+      snapshot = vm_snapshot.VMSnapshot(self.vm_image_path,
+                                        ssh_private_key=self.ssh_private_key)
+      snapshot.Restore(private_image_path, self._ssh_port, self._kvm_pid_file)
+    except (vm_snapshot.SnapshotError, cros_build_lib.RunCommandError,
+            timeout_util.TimeoutError, EnvironmentError) as e:
+      logging.warning('Could not start the VM from a snapshot, booting it '
+                      'instead: %s', e)
+      self._KillExistingVM(self._kvm_pid_file)
+      osutils.SafeUnlink(private_image_path)
+      return False
+
+    self._snapshot = snapshot
+    self.TestInfo('Started VM from snapshot %s with disk %s.' %
+                  (snapshot.path, private_image_path))
+    return True
+
+  def _BootStoppedVM(self):
+    """Boots the VM again if it was restored from a snapshot and stopped.
+
+    The disk of a restored VM is a qcow2 image, which start_kvm may not boot
+    when cros_run_vm_update or cros_run_vm_test find no running VM.
+
+    Raises:
+      update_exception.UpdateException if the VM could not be booted.
+    """
+    if not self._snapshot or vm_snapshot.IsRunning(self._kvm_pid_file):
+      return
+
+    self.TestInfo('VM started from a snapshot stopped, booting its disk.')
+    try:
+      self._snapshot.Boot(self.vm_image_path, self._ssh_port,
+                          self._kvm_pid_file)
+    except vm_snapshot.SnapshotError as e:
+      raise update_exception.UpdateException(
+          1, 'Could not boot the stopped VM: %s' % e)
+
   def _HandleFail(self, log_directory, fail_directory):
     parent_dir = os.path.dirname(fail_directory)
     if not os.path.isdir(parent_dir):
       os.makedirs(parent_dir)
 
-    # Copy logs. Must be done before moving image, as this creates
+    # Copy logs. Must be done before saving the memory image, as this creates
     # |fail_directory|.
     try:
       shutil.copytree(log_directory, fail_directory)
     except shutil.Error as e:
       logging.warning('Ignoring errors while copying logs: %s', e)
+    if os.path.exists(log_directory + '.log'):
+      shutil.copy(log_directory + '.log', fail_directory)
 
-    # Copy VM state. This includes the disk image, and the memory
-    # image.
-    try:
-      _, mem_image_path = tempfile.mkstemp(
-          dir=fail_directory, prefix="%s." % buildbot_constants.VM_MEM_PREFIX)
-      self._KillExistingVM(self._kvm_pid_file, save_mem_path=mem_image_path)
-      shutil.move(self.vm_image_path, fail_directory)
-    except shutil.Error as e:
-      logging.warning('Ignoring errors while copying VM files: %s', e)
+    # Save VM state, the disk image and the memory image, and archive it in
+    # the background. The disk is moved out of the private directory removed
+    # by CleanUp, and left to the archiver.
+    fd, mem_image_path = tempfile.mkstemp(
+        dir=fail_directory, prefix="%s." % buildbot_constants.VM_MEM_PREFIX)
+    os.close(fd)
+    self._KillExistingVM(self._kvm_pid_file, save_mem_path=mem_image_path)
+    disk_path = None
+    if os.path.exists(self.vm_image_path):
+      disk_path = self._private_disk_dir + '.failed'
+      os.rename(self.vm_image_path, disk_path)
+    failure_archiver.StartArchiver(self.test_results_root, fail_directory,
+                                   disk=disk_path,
+                                   base=self._base_vm_image_path,
+                                   memory=mem_image_path)
+    self.TestInfo('Archiving the VM state in %s in the background.' %
+                  fail_directory)
 
   def UpdateImage(self, image_path, src_image_path='', stateful_change='old',
                   proxy_port='', payload_signing_key=None):
@@ -104,6 +212,7 @@ class VMAUWorker(au_worker.AUWorker):
     self.TestInfo(self.GetUpdateMessage(image_path, src_image_path, True,
                                         proxy_port))
     try:
+      self._BootStoppedVM()
       self.RunUpdateCmd(cmd, log_directory)
     except update_exception.UpdateException:
       self._HandleFail(log_directory, fail_directory)
@@ -128,6 +237,7 @@ class VMAUWorker(au_worker.AUWorker):
     if proxy_port: cmd.append('--proxy_port=%s' % proxy_port)
     self.TestInfo(self.GetUpdateMessage(update_path, None, True, proxy_port))
     try:
+      self._BootStoppedVM()
       self.RunUpdateCmd(cmd, log_directory)
     except update_exception.UpdateException:
       self._HandleFail(log_directory, fail_directory)
@@ -154,7 +264,9 @@ class VMAUWorker(au_worker.AUWorker):
   def _VerifyImage(self, test=''):
     """Runs vm smoke suite or any single test to verify image.
 
-    Returns True upon success.  Prints test output and returns False otherwise.
+    Returns:
+      A test_that_results.VerificationResult, passed if the tests passed.
+      Prints the test output if they did not.
     """
     log_directory, fail_directory = self.GetNextResultsPath('autotest_tests')
     (_, _, log_directory_in_chroot) = log_directory.rpartition('chroot')
@@ -178,15 +290,24 @@ class VMAUWorker(au_worker.AUWorker):
     if self.ssh_private_key is not None:
       command.append('--ssh_private_key=%s' % self.ssh_private_key)
 
+    try:
+      self._BootStoppedVM()
+    except update_exception.UpdateException as e:
+      logging.error(e)
+      self._HandleFail(log_directory, fail_directory)
+      return test_that_results.VerificationResult()
+
     self.TestInfo('Running smoke suite to verify image.')
-    result = cros_build_lib.RunCommand(
-        command, print_cmd=False, combine_stdout_stderr=True,
-        cwd=constants.CROSUTILS_DIR, error_code_ok=True,
-        capture_output=True)
+    # cros_run_vm_test recreates |log_directory|, so log next to it.
+    log_file = log_directory + '.log'
+    returncode, result = self.RunTestCommand(command, log_file)
+    result.passed = returncode == 0
 
     # If the command failed or printed warnings, print the output.
-    if result.returncode != 0 or '@@@STEP_WARNINGS@@@' in result.output:
-      print result.output
+    if not result.passed or result.warnings:
+      with open(log_file) as f:
+        shutil.copyfileobj(f, sys.stdout)
+      print result.Summary()
       self._HandleFail(log_directory, fail_directory)
 
-    return result.returncode == 0
+    return result
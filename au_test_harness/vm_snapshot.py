@@ -0,0 +1,304 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing snapshots of VMs booted up to the point ssh is ready.
+
+Every AU test starts by booting a VM from the same base image and waiting for
+ssh, which takes a minute or two. A VMSnapshot boots the base image once,
+saves the memory and disk state of the VM once ssh is up, and then starts any
+number of VMs straight from that state.
+
+The snapshot is a qcow2 overlay holding the writes made while booting and the
+saved VM state. Its backing file is a private copy of the base image, as the
+base image itself may be replaced while VMs restored from the snapshot run.
+Every restored VM runs on its own copy of the overlay, so the snapshot and its
+backing file are never written to. Restored VMs pin the snapshot until they
+are done with it, so that it is not removed under them.
+
+Restored VMs are started with the pid file and ssh port the VM worker passes to
+cros_run_vm_update and cros_run_vm_test, whose start_kvm then uses the running
+VM instead of booting one. All VMs saved and restored here use the same qemu
+configuration, which does not depend on start_kvm's. In particular, the disks
+of restored VMs are qcow2 images, which start_kvm is not known to boot: a
+restored VM that stopped must be booted again with Boot before those scripts
+are run.
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import glob
+import os
+import subprocess
+import time
+
+import constants
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from chromite.lib import remote_access
+from chromite.lib import timeout_util
+from crostestutils.lib import content_hash
+from crostestutils.lib import disk_util
+from crostestutils.lib import json_store
+
+# Name of the VM state saved in snapshots.
+_SNAPSHOT_NAME = 'ssh_ready'
+
+# Bump to invalidate existing snapshots when the qemu configuration or the
+# layout of snapshots changes.
+_SNAPSHOT_VERSION = 2
+
+_QEMU_BINARIES = ('qemu-system-x86_64', 'kvm')
+_QEMU_PROMPT = '(qemu) '
+
+# Seconds to wait for ssh after a cold boot and after a restore.
+_BOOT_TIMEOUT = 300
+_RESTORE_TIMEOUT = 60
+# Seconds to wait for qemu to save the VM state.
+_SAVE_TIMEOUT = 300
+
+
+class SnapshotError(Exception):
+  """Raised when a snapshot cannot be created or restored."""
+
+
+def _GetQemuCommand(disk, ssh_port):
+  """Returns the qemu command line of a headless VM running on |disk|."""
+  for binary in _QEMU_BINARIES:
+    path = osutils.Which(binary)
+    if path:
+      break
+  else:
+    raise SnapshotError('Could not find any of %s.' % ', '.join(_QEMU_BINARIES))
+
+  return [path, '-enable-kvm', '-m', '2G', '-smp', '4', '-vga', 'cirrus',
+          '-display', 'none', '-net', 'nic,model=virtio',
+          '-net', 'user,hostfwd=tcp:127.0.0.1:%d-:22' % ssh_port,
+          '-drive', 'file=%s,index=0,media=disk,cache=unsafe,format=qcow2' %
+          disk]
+
+
+def IsRunning(pid_file):
+  """Returns whether the VM whose pid was written to |pid_file| is running."""
+  try:
+    pid = int(osutils.ReadFile(pid_file).strip())
+  except (IOError, ValueError):
+    return False
+  # qemu runs as root, so it cannot be signalled to check it.
+  return os.path.exists('/proc/%d' % pid)
+
+
+def _Pin(pin_path):
+  """Returns the file of |pin_path|, opened and locked shared.
+
+  Pin files are removed with the snapshot they pin, while locked exclusively;
+  a pin file that was removed while this waited for it is opened again.
+  """
+  while True:
+    pin = open(pin_path, 'a')
+    fcntl.flock(pin, fcntl.LOCK_SH)
+    try:
+      if os.fstat(pin.fileno()).st_ino == os.stat(pin_path).st_ino:
+        return pin
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    pin.close()
+
+
+def _RemoveUnpinned(stem):
+  """Removes the snapshot with path prefix |stem| unless it is pinned.
+
+  Returns:
+    Whether the snapshot was removed.
+  """
+  with open(stem + '.pin', 'a') as pin:
+    try:
+      fcntl.flock(pin, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+      if e.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      return False
+
+    for suffix in ('.qcow2', '.qcow2.tmp', '.qcow2.lock', '.bin', '.pin'):
+      osutils.SafeUnlink(stem + suffix)
+  return True
+
+
+class VMSnapshot(object):
+  """The state of a VM booted from a base image up to the point ssh is ready.
+
+  Snapshots are kept in constants.VM_SNAPSHOT_DIR and shared by all harness
+  runs on this host. A snapshot is keyed by the path of its base image and the
+  content key CreateVMImage stamped it with, so it is only used for the exact
+  base image it was booted from. It is replaced once the base image changes,
+  unless VMs still use it.
+  """
+
+  def __init__(self, base_image, ssh_private_key=None,
+               snapshot_dir=constants.VM_SNAPSHOT_DIR):
+    """Initializes the snapshot of |base_image|, without creating it.
+
+    Args:
+      base_image: Path to the raw VM image to boot. Images without a content
+        key stamp are hashed.
+      ssh_private_key: Key to ssh into the VM with. Defaults to the test key.
+      snapshot_dir: Directory to keep snapshots in.
+    """
+    self.base_image = os.path.realpath(base_image)
+    self.ssh_private_key = ssh_private_key
+    stamp = json_store.ReadJson(self.base_image + '.key') or {}
+    key = stamp.get('key') or content_hash.HashFile(
+        self.base_image, memo_dir=os.path.join(snapshot_dir, 'hashes'))
+    self._prefix = content_hash.HashString(self.base_image)
+    # Path of all files of the snapshot, without their suffix.
+    self._stem = os.path.join(snapshot_dir, '%s-%s' % (
+        self._prefix, content_hash.HashString(str(_SNAPSHOT_VERSION), key)))
+    self.path = self._stem + '.qcow2'
+    # Private copy of the base image backing the snapshot.
+    self.backing_image = self._stem + '.bin'
+    self._pin = None
+
+  def _WaitForSsh(self, ssh_port, timeout):
+    """Waits until ssh on |ssh_port| accepts commands.
+
+    Raises:
+      SnapshotError if ssh is not ready within |timeout| seconds.
+    """
+    connect_settings = remote_access.CompileSSHConnectSettings(
+        ConnectTimeout=5, ConnectionAttempts=1)
+    deadline = time.time() + timeout
+    with osutils.TempDir() as tempdir:
+      remote = remote_access.RemoteAccess(
+          remote_access.LOCALHOST, tempdir, port=ssh_port,
+          private_key=self.ssh_private_key)
+      while time.time() < deadline:
+        try:
+          remote.RemoteSh(['true'], connect_settings=connect_settings)
+          return
+        except (cros_build_lib.RunCommandError,
+                remote_access.SSHConnectionError):
+          time.sleep(1)
+
+    raise SnapshotError('ssh on port %d was not ready after %d seconds.' %
+                        (ssh_port, timeout))
+
+  def _ReadUntilPrompt(self, proc):
+    """Returns the output of the qemu monitor of |proc| up to its prompt."""
+    output = ''
+    while not output.endswith(_QEMU_PROMPT):
+      char = proc.stdout.read(1)
+      if not char:
+        raise SnapshotError('qemu exited:\n%s' % output)
+      output += char
+    return output
+
+  def _Create(self, ssh_port):
+    """Boots the base image and saves the VM state once ssh is ready."""
+    temp_path = self.path + '.tmp'
+    osutils.SafeUnlink(temp_path)
+    osutils.SafeUnlink(self.backing_image)
+    disk_util.CloneFile(self.base_image, self.backing_image)
+    if not disk_util.CreateOverlay(self.backing_image, temp_path):
+      raise SnapshotError('Could not create an overlay on %s.' %
+                          self.backing_image)
+
+    logging.info('Booting %s to snapshot it.', self.base_image)
+    cmd = _GetQemuCommand(temp_path, ssh_port) + ['-monitor', 'stdio']
+    proc = subprocess.Popen(['sudo', '--'] + cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            close_fds=True)
+    try:
+      self._ReadUntilPrompt(proc)
+      self._WaitForSsh(ssh_port, _BOOT_TIMEOUT)
+      with timeout_util.Timeout(_SAVE_TIMEOUT):
+        proc.stdin.write('savevm %s\n' % _SNAPSHOT_NAME)
+        proc.stdin.flush()
+        output = self._ReadUntilPrompt(proc)
+        proc.stdin.write('quit\n')
+        proc.stdin.flush()
+        proc.wait()
+    finally:
+      if proc.returncode is None:
+        cros_build_lib.SudoRunCommand(['pkill', '-KILL', '-P', str(proc.pid)],
+                                      error_code_ok=True, print_cmd=False)
+        proc.wait()
+
+    if 'Error' in output:
+      raise SnapshotError('qemu failed to save the VM state:\n%s' % output)
+
+    # Snapshots of previous versions of the base image are of no more use.
+    snapshot_dir = os.path.dirname(self.path)
+    old_stems = set(
+        os.path.join(snapshot_dir, os.path.basename(path).split('.', 1)[0])
+        for path in glob.glob(os.path.join(snapshot_dir, self._prefix + '-*')))
+    for old_stem in old_stems - set([self._stem]):
+      if not _RemoveUnpinned(old_stem):
+        logging.info('Keeping snapshot %s.qcow2, which is in use.', old_stem)
+    os.rename(temp_path, self.path)
+    logging.info('Saved the state of %s in %s.', self.base_image, self.path)
+
+  def Restore(self, disk, ssh_port, pid_file):
+    """Starts a VM from the snapshot, creating the snapshot if needed.
+
+    The snapshot is pinned until Release is called.
+
+    Args:
+      disk: Path of the private disk to create for the VM. Must not exist.
+      ssh_port: Port to forward to ssh in the VM.
+      pid_file: Path to write the pid of the VM to.
+
+    Raises:
+      SnapshotError if the VM could not be restored. A VM that is started but
+      not reachable over ssh keeps running, to be stopped through |pid_file|.
+    """
+    osutils.SafeMakedirs(os.path.dirname(self.path))
+    self._pin = _Pin(self._stem + '.pin')
+    try:
+      # Only one process creates the snapshot; the others wait for it.
+      with json_store.FileLock(self.path):
+        if not os.path.exists(self.path):
+          self._Create(ssh_port)
+        disk_util.CloneFile(self.path, disk)
+
+      self._StartVM(disk, ssh_port, pid_file, ['-loadvm', _SNAPSHOT_NAME])
+      self._WaitForSsh(ssh_port, _RESTORE_TIMEOUT)
+    except BaseException:
+      self.Release()
+      raise
+
+  def Release(self):
+    """Unpins the snapshot once no VM restored by Restore runs anymore."""
+    if self._pin:
+      self._pin.close()
+      self._pin = None
+
+  def Boot(self, disk, ssh_port, pid_file):
+    """Boots a VM on |disk|, a disk created by Restore whose VM stopped.
+
+    The VM keeps the changes made to |disk| since it was restored.
+
+    Args:
+      disk: Path of the disk of the VM.
+      ssh_port: Port to forward to ssh in the VM.
+      pid_file: Path to write the pid of the VM to.
+
+    Raises:
+      SnapshotError if the VM could not be booted.
+    """
+    logging.info('Booting %s, whose VM stopped.', disk)
+    self._StartVM(disk, ssh_port, pid_file, [])
+    self._WaitForSsh(ssh_port, _BOOT_TIMEOUT)
+
+  def _StartVM(self, disk, ssh_port, pid_file, args):
+    """Starts a VM on |disk| in the background with the qemu flags |args|."""
+    try:
+      cros_build_lib.SudoRunCommand(
+          _GetQemuCommand(disk, ssh_port) + args +
+          ['-daemonize', '-pidfile', pid_file],
+          print_cmd=False, redirect_stdout=True, combine_stdout_stderr=True)
+    except cros_build_lib.RunCommandError as e:
+      raise SnapshotError('qemu failed to start a VM on %s: %s' % (disk, e))
@@ -0,0 +1,174 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for vm_snapshot, with qemu mocked."""
+
+from __future__ import print_function
+
+import os
+import StringIO
+import subprocess
+import sys
+import time
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.au_test_harness import vm_snapshot
+
+
+class _FakeQemu(object):
+  """A qemu process whose monitor accepts any command."""
+
+  def __init__(self, *_args, **_kwargs):
+    self.stdin = StringIO.StringIO()
+    self.returncode = None
+    self.pid = 0
+
+  def wait(self):
+    self.returncode = 0
+    return self.returncode
+
+
+class _FakeSubprocess(object):
+  """The subprocess module as seen by vm_snapshot, running _FakeQemu."""
+  Popen = _FakeQemu
+  PIPE = subprocess.PIPE
+  STDOUT = subprocess.STDOUT
+
+
+class VMSnapshotTest(cros_test_lib.TempDirTestCase):
+  """Tests creating and restoring snapshots."""
+
+  def setUp(self):
+    self.base_image = os.path.join(self.tempdir, 'chromiumos_qemu_image.bin')
+    osutils.WriteFile(self.base_image, 'base')
+    self.snapshot_dir = os.path.join(self.tempdir, 'snapshots')
+    self.qemu_commands = []
+    self._Patch(osutils, 'Which', lambda binary: '/usr/bin/%s' % binary)
+    self._Patch(cros_build_lib, 'SudoRunCommand',
+                lambda cmd, **_kwargs: self.qemu_commands.append(cmd))
+    self._Patch(vm_snapshot, 'subprocess', _FakeSubprocess)
+    self.overlay_bases = []
+    self._Patch(vm_snapshot.disk_util, 'CreateOverlay',
+                lambda base, path: (self.overlay_bases.append(base) or
+                                    osutils.WriteFile(path, 'overlay') or True))
+    self._Patch(vm_snapshot.VMSnapshot, '_ReadUntilPrompt',
+                lambda _self, _proc: '(qemu) ')
+    self._Patch(vm_snapshot.VMSnapshot, '_WaitForSsh',
+                lambda _self, _port, _timeout: None)
+
+  def _Patch(self, obj, name, value):
+    """Replaces |obj|.|name| with |value| for the duration of the test."""
+    self.addCleanup(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+  def _Snapshot(self):
+    return vm_snapshot.VMSnapshot(self.base_image,
+                                  snapshot_dir=self.snapshot_dir)
+
+  def testGetQemuCommand(self):
+    """Tests that VMs run headless on a qcow2 disk with ssh forwarded."""
+    cmd = vm_snapshot._GetQemuCommand('/tmp/disk.qcow2', 9222)
+    self.assertEqual('/usr/bin/qemu-system-x86_64', cmd[0])
+    self.assertIn('user,hostfwd=tcp:127.0.0.1:9222-:22', cmd)
+    self.assertIn('file=/tmp/disk.qcow2,index=0,media=disk,cache=unsafe,'
+                  'format=qcow2', cmd)
+
+    osutils.Which = lambda _binary: None
+    self.assertRaises(vm_snapshot.SnapshotError, vm_snapshot._GetQemuCommand,
+                      '/tmp/disk.qcow2', 9222)
+
+  def _Stamp(self, key):
+    """Stamps the base image with content key |key|, as CreateVMImage does."""
+    osutils.WriteFile(self.base_image + '.key', '{"key": "%s"}' % key)
+
+  def testPath(self):
+    """Tests that snapshots are keyed by the base image and its content key."""
+    self._Stamp('v1')
+    snapshot = self._Snapshot()
+    self.assertEqual(self.snapshot_dir, os.path.dirname(snapshot.path))
+    self.assertEqual(snapshot.path, self._Snapshot().path)
+
+    # Touching the base image does not change its content.
+    os.utime(self.base_image, (time.time() + 60, time.time() + 60))
+    self.assertEqual(snapshot.path, self._Snapshot().path)
+
+    # A new version of the base image has a new snapshot with the same prefix.
+    self._Stamp('v2')
+    new_path = self._Snapshot().path
+    self.assertNotEqual(snapshot.path, new_path)
+    self.assertEqual(os.path.basename(snapshot.path).split('-')[0],
+                     os.path.basename(new_path).split('-')[0])
+
+    # Base images without a stamp are keyed by their content.
+    other_image = os.path.join(self.tempdir, 'other.bin')
+    osutils.WriteFile(other_image, 'base')
+    other = vm_snapshot.VMSnapshot(other_image, snapshot_dir=self.snapshot_dir)
+    self.assertNotEqual(os.path.basename(snapshot.path).split('-')[0],
+                        os.path.basename(other.path).split('-')[0])
+    osutils.WriteFile(other_image, 'new base')
+    self.assertNotEqual(other.path, vm_snapshot.VMSnapshot(
+        other_image, snapshot_dir=self.snapshot_dir).path)
+
+  def testRestore(self):
+    """Tests that snapshots are backed by a private copy of the base image."""
+    self._Stamp('v1')
+    old = self._Snapshot()
+    old_disk = os.path.join(self.tempdir, 'old.qcow2')
+    old.Restore(old_disk, 9222, os.path.join(self.tempdir, 'kvm.pid'))
+    self.assertEqual('overlay', osutils.ReadFile(old.path))
+    self.assertEqual('overlay', osutils.ReadFile(old_disk))
+    self.assertEqual('base', osutils.ReadFile(old.backing_image))
+    self.assertEqual([old.backing_image], self.overlay_bases)
+    self.assertEqual(1, len(self.qemu_commands))
+    self.assertIn('-loadvm', self.qemu_commands[0])
+
+    # A stopped VM is booted on its own disk, not restored.
+    old.Boot(old_disk, 9222, os.path.join(self.tempdir, 'kvm.pid'))
+    self.assertNotIn('-loadvm', self.qemu_commands[1])
+    self.assertIn('-daemonize', self.qemu_commands[1])
+
+    # Snapshots of older base images are kept while they are pinned.
+    self._Stamp('v2')
+    new = self._Snapshot()
+    new.Restore(os.path.join(self.tempdir, 'new.qcow2'), 9222,
+                os.path.join(self.tempdir, 'kvm.pid'))
+    self.assertExists(old.path)
+    self.assertExists(old.backing_image)
+    new.Release()
+
+    # Once unpinned, they are replaced, along with interrupted creations.
+    old.Release()
+    osutils.WriteFile(old.path + '.tmp', 'interrupted')
+    self._Stamp('v3')
+    newest = self._Snapshot()
+    newest.Restore(os.path.join(self.tempdir, 'newest.qcow2'), 9222,
+                   os.path.join(self.tempdir, 'kvm.pid'))
+    newest.Release()
+    self.assertNotExists(old.path)
+    self.assertNotExists(old.backing_image)
+    self.assertNotExists(old.path + '.tmp')
+    self.assertNotExists(new.path)
+    self.assertExists(newest.path)
+
+  def testIsRunning(self):
+    """Tests checking whether a VM is running from its pid file."""
+    pid_file = os.path.join(self.tempdir, 'kvm.pid')
+    self.assertFalse(vm_snapshot.IsRunning(pid_file))
+    osutils.WriteFile(pid_file, '%d\n' % os.getpid())
+    self.assertTrue(vm_snapshot.IsRunning(pid_file))
+    osutils.WriteFile(pid_file, '')
+    self.assertFalse(vm_snapshot.IsRunning(pid_file))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,25 +8,29 @@
 
 This module generates update payloads in parallel using the devserver. After
 running this module, test payloads are generated and left in the devserver
-cache. In addition, this module produces a serialized dictionary stored
-with the target image that contains a mapping from the update payload name
-to the path it is stored in the devserver cache.  This dictionary can then be
-used by other testing scripts i.e. au_test_harness, to locate and use these
-payloads for testing in virtual machines.
+cache. In addition, this module records every payload in a manifest stored
+with the target image (see crostestutils.lib.payload_manifest) that maps the
+update payload id to the path it is stored in the devserver cache.  This
+manifest can then be used by other testing scripts i.e. au_test_harness, to
+locate and use these payloads for testing in virtual machines.
 
 FOR USE OUTSIDE CHROOT ONLY.
 """
 
 from __future__ import print_function
 
+import collections
+import contextlib
+import fcntl
 import functools
+import multiprocessing
 import optparse
 import os
-import pickle
 import re
 import shutil
 import sys
 import tempfile
+import time
 
 import constants
 sys.path.append(constants.CROSUTILS_LIB_DIR)
@@ -42,17 +46,81 @@ from chromite.lib import parallel
 from chromite.lib import path_util
 from chromite.lib import sudo
 from chromite.lib import timeout_util
-from crostestutils.au_test_harness import cros_au_test_harness
+from crostestutils.generate_test_payloads import generation_service
+from crostestutils.generate_test_payloads import payload_cache
 from crostestutils.generate_test_payloads import payload_generation_exception
+from crostestutils.generate_test_payloads import payload_scheduler
+from crostestutils.lib import admission_control
+from crostestutils.lib import content_hash
+from crostestutils.lib import disk_util
 from crostestutils.lib import image_extractor
+from crostestutils.lib import json_store
+from crostestutils.lib import payload_manifest
 from crostestutils.lib import public_key_manager
+from crostestutils.lib import task_graph
 from crostestutils.lib import test_helper
+from crostestutils.lib import timing_trace
+
+
+_MB = 1024.0 ** 2
+
+# Seconds between checks for payloads whose images became ready.
+_IMAGE_POLL_SECONDS = 1
+
+# Files the timing trace of a run is written to, next to the images.
+TRACE_FILE = 'payload_generation_trace.json'
+TRACE_SUMMARY_FILE = 'payload_generation_trace.txt'
 
 
 class InvalidDevserverOutput(Exception):
   """If we are unable to parse devserver output, this is raised."""
 
 
+@contextlib.contextmanager
+def _WriteLock(name, description):
+  """Holds the exclusive lock |name| shared by all runs on this host."""
+  osutils.SafeMakedirs(constants.LOCK_DIR)
+  lock_path = os.path.join(constants.LOCK_DIR, '%s.lock' % name)
+  with locking.FileLock(lock_path, description) as lock:
+    lock.write_lock()
+    yield
+
+
+def _GetImageDirectory(image):
+  """Returns the directory |image| is in, with symlinks resolved."""
+  return os.path.dirname(os.path.realpath(image))
+
+
+class _ImageDirectoryLock(object):
+  """A lock on a directory of images shared by all runs on this host.
+
+  Runs hold it exclusively while they prepare images in the directory, and
+  shared while they generate payloads from its images, so images are never
+  replaced under a run using them. The lock is an flock, which belongs to the
+  open lock file: processes forked while it is held share it rather than wait
+  for it, and any of them may convert it.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self._path = os.path.join(constants.LOCK_DIR, '%s.lock' %
+                              content_hash.HashString('images', directory))
+    self._file = None
+
+  def Acquire(self, shared):
+    """Takes the lock, or converts it if held, blocking until it is free."""
+    if not self._file:
+      osutils.SafeMakedirs(constants.LOCK_DIR)
+      self._file = open(self._path, 'a')
+    fcntl.flock(self._file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+  def Release(self):
+    """Releases the lock if held."""
+    if self._file:
+      self._file.close()
+      self._file = None
+
+
 class UpdatePayload(object):
   """Wrapper around an update payload.
 
@@ -148,38 +216,138 @@ class UpdatePayloadGenerator(object):
     self.basic_suite = options.basic_suite
     self.full_suite = options.full_suite
     self.payloads = set([])
+    self.payload_requests = 0
     self.full_payload = options.full_payload
     self.nplus1_archive_dir = options.nplus1_archive_dir
 
     self.jobs = options.jobs
+    self.persistent_workers = options.persistent_workers
     self.nplus1 = options.nplus1
 
     self.vm = _ShouldGenerateVM(options)
 
+    self.devserver_cache_dir = os.path.join(
+        constants.SOURCE_ROOT, constants.DEFAULT_CHROOT_DIR,
+        self.CHROOT_PATH_TO_DEVSERVER_CACHE)
+    self.cache = None
+    self.hash_memo_dir = None
+    if options.payload_cache_dir:
+      self.cache = payload_cache.PayloadCache(options.payload_cache_dir,
+                                              self.devserver_cache_dir)
+      self.hash_memo_dir = os.path.join(options.payload_cache_dir, 'hashes')
+
+    self.history = payload_scheduler.GenerationHistory(
+        constants.PAYLOAD_HISTORY_FILE)
+
+    # Timing of every stage of image preparation and payload generation.
+    self.trace = timing_trace.Trace()
+
+    # Tasks preparing the images payloads are generated from, the tasks by the
+    # path of the image they create, and the images they create them from.
+    self.image_graph = task_graph.TaskGraph()
+    self.image_tasks = {}
+    self.image_sources = {}
+    # Kind of every prepared image and the image it is directly created from.
+    self.image_inputs = {}
+
   def _AddUpdatePayload(self, target, base, key=None, archive=False,
                         archive_stateful=False, for_vm=False):
     """Adds a new required update payload.  If base is None, a full payload."""
+    self.payload_requests += 1
     self.payloads.add(UpdatePayload(target, base, key, archive,
                                     archive_stateful, for_vm))
 
-  def GenerateImagesForTesting(self):
+  def _PrepareImage(self, description, image, func, *args):
+    """Runs |func| to create |image| and returns the trace of doing so.
+
+    The directory of |image| must be locked exclusively, see GeneratePayloads.
+    """
+    trace = timing_trace.Trace()
+    existed = os.path.exists(image)
+    start_time = time.time()
+    with trace.Span(description, 'image', image=image):
+      func(*args)
+    if not existed:
+      self.history.RecordImage(description, time.time() - start_time)
+    return trace.events
+
+  def _AddImageTask(self, image, source, description, func, *args):
+    """Adds a task creating |image| from |source| by calling |func|(*|args|).
+
+    Images are only created once, however many payloads are generated from
+    them, e.g. when the base and target images are in the same directory and
+    share a VM image.
+    """
+    if image in self.image_tasks:
+      return
+
+    deps = [self.image_tasks[source]] if source in self.image_tasks else []
+    self.image_tasks[image] = description + ' ' + image
+    self.image_sources[image] = self.image_sources.get(source, source)
+    self.image_inputs[image] = (description, source)
+    self.image_graph.AddTask(
+        self.image_tasks[image],
+        functools.partial(self._PrepareImage, description, image, func, *args),
+        deps=deps)
+
+  def _CreateSignedImage(self):
+    """Creates the signed copy of the target image unless it is current.
+
+    The signed image is stamped with the content hashes of the target image
+    and the public key it was created from. It is created under a temporary
+    name and renamed into place, so it is never seen partially written.
+    """
+    key = content_hash.HashString(
+        'signed image',
+        content_hash.HashFile(self.target, memo_dir=self.hash_memo_dir),
+        content_hash.HashFile(self.public_key, memo_dir=self.hash_memo_dir))
+    stamp_path = self.target_signed + '.key'
+    stamp = json_store.ReadJson(stamp_path)
+    if (os.path.exists(self.target_signed) and stamp and
+        stamp.get('key') == key):
+      logging.info('Signed image %s is current.', self.target_signed)
+      return
+
+    logging.info('Creating a signed image for signed payload test.')
+    temp_path = self.target_signed + '.tmp'
+    osutils.SafeUnlink(temp_path)
+    try:
+      disk_util.CloneFile(self.target, temp_path)
+      public_key_manager.PublicKeyManager(temp_path,
+                                          self.public_key).AddKeyToImage()
+      os.rename(temp_path, self.target_signed)
+    except BaseException:
+      osutils.SafeUnlink(temp_path)
+      raise
+    json_store.WriteJsonAtomic(stamp_path, dict(key=key))
+
+  def PlanImagesForTesting(self):
+    """Plans the VM and signed images the payloads are generated from.
+
+    Sets the image paths to those of the prepared images and adds the tasks
+    preparing them to self.image_graph, without running them. Independent tasks
+    run in parallel once GeneratePayloads starts, and every payload is
+    generated as soon as its own images are ready.
+    """
     # All vm testing requires a VM'ized target.
     if self.vm:
-      self.target = test_helper.CreateVMImage(self.target, self.board)
+      vm_target = test_helper.GetVMImagePath(self.target)
+      self._AddImageTask(vm_target, self.target, 'vm image',
+                         test_helper.CreateVMImage, self.target, self.board)
+      self.target = vm_target
 
     if self.full_suite:
       if self.public_key:
         self.target_signed = self.target + '.signed'
-        if not os.path.exists(self.target_signed):
-          logging.info('Creating a signed image for signed payload test.')
-          shutil.copy(self.target, self.target_signed)
+        self._AddImageTask(self.target_signed, self.target, 'signed image',
+                           self._CreateSignedImage)
 
-        public_key_manager.PublicKeyManager(self.target_signed,
-                                            self.public_key).AddKeyToImage()
-
-      # The full suite may not have a VM image produced for the test image yet.
-      # Ensure this is created.
-      self.base = test_helper.CreateVMImage(self.base, self.board)
+      # The full suite may not have a VM image produced for the test image
+      # yet. Ensure this is created.
+      vm_base = test_helper.GetVMImagePath(self.base)
+      self._AddImageTask(vm_base, self.base, 'vm image',
+                         test_helper.CreateVMImage, self.base, self.board)
+      self.base = vm_base
 
   def GeneratePayloadRequirements(self):
     """Generate Payload Requirements for AUTestHarness and NPlus1 Testing."""
@@ -212,168 +380,553 @@ class UpdatePayloadGenerator(object):
       self._AddUpdatePayload(self.target_no_vm, None, archive=True,
                              archive_stateful=True)
 
+  def _GeneratePayload(self, payload, log_file, worker=None):
+    """Generates |payload| with the devserver, logging output to |log_file|.
 
-  def GeneratePayloads(self):
-    """Iterates through payload requirements and generates them.
+    Args:
+      payload: The UpdatePayload to generate.
+      log_file: File to write the devserver output to.
+      worker: If set, generation_service.GenerationWorker to run the devserver
+        in, in which case |log_file| must be inside the chroot.
+    """
+    # Base command.
+    command = ['start_devserver', '--pregenerate_update', '--exit']
+
+    in_chroot_key = in_chroot_base = None
+    in_chroot_target = path_util.ToChrootPath(payload.target)
+    if payload.base:
+      in_chroot_base = path_util.ToChrootPath(payload.base)
+
+    if payload.key:
+      in_chroot_key = path_util.ToChrootPath(payload.key)
+
+    command.append('--image=%s' % in_chroot_target)
+    if payload.base:
+      command.append('--src_image=%s' % in_chroot_base)
+    if payload.key:
+      command.append('--private_key=%s' % in_chroot_key)
+
+    if payload.base:
+      debug_message = 'delta payload from %s to %s' % (payload.base,
+                                                       payload.target)
+    else:
+      debug_message = 'full payload to %s' % payload.target
 
-    This is the main method of this class.  It iterates through payloads
-    it needs, generates them, and builds a Cache that can be used by the
-    test harness to reference these payloads.
+    if payload.for_vm:
+      debug_message += ' and not patching the kernel.'
+
+    if in_chroot_key:
+      debug_message = 'Generating a signed %s' % debug_message
+    else:
+      debug_message = 'Generating an unsigned %s' % debug_message
+
+    logging.info(debug_message)
+    try:
+      if worker:
+        worker.RunCommand(command, log_file)
+      else:
+        with timeout_util.Timeout(constants.MAX_TIMEOUT_SECONDS):
+          cros_build_lib.SudoRunCommand(command, log_stdout_to_file=log_file,
+                                        combine_stdout_stderr=True,
+                                        enter_chroot=True, print_cmd=False,
+                                        cwd=constants.SOURCE_ROOT)
+    except (timeout_util.TimeoutError, cros_build_lib.RunCommandError,
+            generation_service.WorkerDiedError):
+      # Print output first, then re-raise the exception.
+      if os.path.isfile(log_file):
+        logging.error(osutils.ReadFile(log_file))
+      raise
+
+  def _ParseDevserverLog(self, log_file):
+    """Returns the update path found in the log of a _GeneratePayload call.
+
+    Args:
+      log_file: Filename of the stored devserver log.
 
     Returns:
-      The cache as a Python dict.
+      The devserver update path of the form update/cache/<label>.
+
+    Raises:
+      payload_generation_exception.PayloadGenerationException: Raises this
+        exception if we failed to parse the devserver output to find the
+        location of the update path.
     """
+    # Looking for this line in the output.
+    key_line_re = re.compile(r'^PREGENERATED_UPDATE=([\w/./+]+)')
+    with open(log_file) as f:
+      for line in f:
+        match = key_line_re.search(line)
+        if match:
+          # Convert cache/label/update.gz -> update/cache/label.
+          path_to_update_gz = match.group(1).rstrip()
+          path_to_update_dir = path_to_update_gz.rpartition('/update.gz')[0]
+
+          # Check that we could actually parse the directory correctly.
+          if not path_to_update_dir:
+            raise payload_generation_exception.PayloadGenerationException(
+                'Payload generated but failed to parse cache directory.')
+
+          return '/'.join(['update', path_to_update_dir])
+
+      logging.error('Could not find PREGENERATED_UPDATE in log:')
+      f.seek(0)
+      for line in f:
+        logging.error('  log: %s', line)
+      # This is not a recoverable error.
+      raise InvalidDevserverOutput('Could not parse devserver log')
+
+  def _ArchivePayload(self, payload, update_path):
+    """Copies |payload| to the nplus1 archive directory if requested."""
+    if not payload.archive or not self.nplus1_archive_dir:
+      return
+
+    # Only need directory as we know the rest.
+    path_to_payload_dir = payload_cache.GetPayloadDirectory(
+        self.devserver_cache_dir, update_path)
+    payload_path = os.path.join(path_to_payload_dir, 'update.gz')
+    archive_path = os.path.join(self.nplus1_archive_dir,
+                                payload.GetNameForBin())
+    logging.info('Archiving %s to %s.', payload.GetNameForBin(), archive_path)
+    shutil.copyfile(payload_path, archive_path)
+    if payload.archive_stateful:
+      stateful_path = os.path.join(path_to_payload_dir, 'stateful.tgz')
+      archive_path = os.path.join(self.nplus1_archive_dir, 'stateful.tgz')
+      logging.info('Archiving stateful payload from %s to %s',
+                   payload.GetNameForBin(), archive_path)
+      shutil.copyfile(stateful_path, archive_path)
+
+  def _ProcessPayload(self, payload, cache_key=None, update_path=None,
+                      worker=None):
+    """Generates a single payload unless cached, then archives it.
+
+    Payloads are processed by parallel generation loops, so the log of a
+    payload is parsed and its archive copy started as soon as it is generated,
+    while other payloads are still being generated.
+
+    Only one run on this host generates a given payload at a time. Other runs
+    needing the same payload wait for it and then find it in the cache.
 
-    def GeneratePayload(payload, log_file):
-      """Returns the error code from generating an update with the devserver."""
-      # Base command.
-      command = ['start_devserver', '--pregenerate_update', '--exit']
+    Args:
+      payload: The UpdatePayload to process.
+      cache_key: Key of |payload| in the persistent payload cache, if enabled.
+      update_path: Update path of |payload| if it was found in the cache.
+      worker: Optional generation_service.GenerationWorker to generate with.
 
-      in_chroot_key = in_chroot_base = None
-      in_chroot_target = path_util.ToChrootPath(payload.target)
-      if payload.base:
-        in_chroot_base = path_util.ToChrootPath(payload.base)
+    Returns:
+      A payload_manifest.PayloadEntry describing the payload.
+    """
+    span_args = dict(payload=str(payload))
+    generation_seconds = None
+    if not update_path:
+      lock_name = cache_key or content_hash.HashString(str(payload))
+      start_time = time.time()
+      with _WriteLock(lock_name, 'generate payload %s' % payload):
+        self.trace.AddSpan('lock', 'payload', start_time, time.time(),
+                           **span_args)
+        if self.cache:
+          update_path = self.cache.Lookup(cache_key)
+          if update_path:
+            logging.info('Payload %s was generated by another run.', payload)
+
+        if not update_path:
+          # A persistent worker writes the log from inside the chroot.
+          log_dir = path_util.FromChrootPath('/tmp') if worker else None
+          fd, log_file = tempfile.mkstemp('GenerateVMUpdate', dir=log_dir)
+          os.close(fd)  # Just want filename so close file immediately.
+
+          start_time = time.time()
+          # Delta computation and signing both happen in this single devserver
+          # invocation.
+          with self.trace.Span('generate', 'payload', **span_args):
+            self._GeneratePayload(payload, log_file, worker=worker)
+          generation_seconds = time.time() - start_time
+          update_path = self._ParseDevserverLog(log_file)
+          if self.cache:
+            self.cache.Store(cache_key, payload, update_path)
+
+    with self.trace.Span('archive', 'payload', **span_args):
+      self._ArchivePayload(payload, update_path)
+
+    payload_path = os.path.join(
+        payload_cache.GetPayloadDirectory(self.devserver_cache_dir,
+                                          update_path),
+        'update.gz')
+    size = os.path.getsize(payload_path)
+    if generation_seconds is not None:
+      self.history.Record(payload, generation_seconds, size)
+
+    with self.trace.Span('hash', 'payload', **span_args):
+      sha256 = content_hash.HashFile(payload_path, memo_dir=self.hash_memo_dir,
+                                     algorithm='sha256')
+
+    return payload_manifest.PayloadEntry(
+        update_id=payload.UpdateId(),
+        update_path=update_path,
+        size=size,
+        sha256=sha256,
+        generated_at=os.path.getmtime(payload_path),
+        generation_seconds=generation_seconds)
+
+  def _GetImageTasks(self, payload):
+    """Returns the names of the image tasks |payload| is generated from."""
+    return [self.image_tasks[image] for image in (payload.target, payload.base)
+            if image in self.image_tasks]
+
+  def _TakeJob(self, payload_jobs, taken):
+    """Takes the first job not taken yet whose images are ready.
+
+    Blocks while no such job is ready, and fails if preparing an image failed.
 
-      if payload.key:
-        in_chroot_key = path_util.ToChrootPath(payload.key)
+    Args:
+      payload_jobs: See _GenerationLoop.
+      taken: See _GenerationLoop.
 
-      command.append('--image=%s' % in_chroot_target)
-      if payload.base:
-        command.append('--src_image=%s' % in_chroot_base)
-      if payload.key:
-        command.append('--private_key=%s' % in_chroot_key)
+    Returns:
+      The index of the job in |payload_jobs|, or None if all jobs are taken.
+    """
+    while True:
+      with taken.get_lock():
+        remaining = [i for i, job_taken in enumerate(taken) if not job_taken]
+        if not remaining:
+          return None
 
-      if payload.base:
-        debug_message = 'delta payload from %s to %s' % (payload.base,
-                                                         payload.target)
-      else:
-        debug_message = 'full payload to %s' % payload.target
+        for index in remaining:
+          payload = payload_jobs[index][0]
+          if self.image_graph.IsDone(self._GetImageTasks(payload)):
+            taken[index] = 1
+            return index
 
-      if payload.for_vm:
-        debug_message += ' and not patching the kernel.'
+      time.sleep(_IMAGE_POLL_SECONDS)
 
-      if in_chroot_key:
-        debug_message = 'Generating a signed %s' % debug_message
-      else:
-        debug_message = 'Generating an unsigned %s' % debug_message
+  def _GenerationLoop(self, payload_jobs, taken, dispatch_time):
+    """Processes payloads until there are none left.
 
-      logging.info(debug_message)
-      try:
-        with timeout_util.Timeout(constants.MAX_TIMEOUT_SECONDS):
-          cros_build_lib.SudoRunCommand(command, log_stdout_to_file=log_file,
-                                        combine_stdout_stderr=True,
-                                        enter_chroot=True, print_cmd=False,
-                                        cwd=constants.SOURCE_ROOT)
-      except (timeout_util.TimeoutError, cros_build_lib.RunCommandError):
-        # Print output first, then re-raise the exception.
-        if os.path.isfile(log_file):
-          logging.error(osutils.ReadFile(log_file))
-        raise
-
-    def ProcessOutput(log_files):
-      """Processes results from the log files of GeneratePayload invocations.
-
-      Args:
-        log_files: A list of filename strings with stored logs.
-
-      Returns:
-        An array of cache entries from the log files.
-
-      Raises:
-        payload_generation_exception.PayloadGenerationException: Raises this
-          exception if we failed to parse the devserver output to find the
-          location of the update path.
-      """
-      # Looking for this line in the output.
-      key_line_re = re.compile(r'^PREGENERATED_UPDATE=([\w/./+]+)')
-      return_array = []
-      for log_file in log_files:
-        with open(log_file) as f:
-          for line in f:
-            match = key_line_re.search(line)
-            if match:
-              # Convert cache/label/update.gz -> update/cache/label.
-              path_to_update_gz = match.group(1).rstrip()
-              path_to_update_dir = path_to_update_gz.rpartition(
-                  '/update.gz')[0]
-
-              # Check that we could actually parse the directory correctly.
-              if not path_to_update_dir:
-                raise payload_generation_exception.PayloadGenerationException(
-                    'Payload generated but failed to parse cache directory.')
-
-              return_array.append('/'.join(['update', path_to_update_dir]))
-              break
-          else:
-            logging.error('Could not find PREGENERATED_UPDATE in log:')
-            f.seek(0)
-            for line in f:
-              logging.error('  log: %s', line)
-            # This is not a recoverable error.
-            raise InvalidDevserverOutput('Could not parse devserver log')
-
-      return return_array
+    Up to --jobs loops run in parallel, alongside the tasks preparing images.
+    With --persistent_workers, every loop enters the chroot once and generates
+    all of its payloads in the same generation_service.GenerationWorker.
 
-    jobs = []
-    log_files = []
-    # Generate list of paylods and list of log files.
+    Args:
+      payload_jobs: List of (payload, cache_key, update_path) tuples, in the
+        order they should be processed. See _ProcessPayload.
+      taken: A multiprocessing.Array of booleans, shared by all loops, marking
+        the jobs in |payload_jobs| already taken by a loop.
+      dispatch_time: Time at which all jobs were queued.
+
+    Returns:
+      A tuple of a list of payload_manifest.PayloadEntry's for the processed
+      payloads and a list of trace events recorded by this loop.
+    """
+    # Loops run in their own process; only events recorded here are returned.
+    self.trace = timing_trace.Trace()
+    worker = None
+    entries = []
+    try:
+      while True:
+        index = self._TakeJob(payload_jobs, taken)
+        if index is None:
+          return entries, self.trace.events
+
+        payload, cache_key, update_path = payload_jobs[index]
+        self.trace.AddSpan('queue', 'payload', dispatch_time, time.time(),
+                           payload=str(payload))
+        # Payloads of images prepared by this run were not looked up yet. Do
+        # so before entering the chroot or waiting for admission, which cached
+        # payloads do not need.
+        if self.cache and not cache_key:
+          cache_key = self.cache.GetKey(payload)
+          update_path = self.cache.Lookup(cache_key)
+          if update_path:
+            logging.info('Using cached payload for %s from %s.', payload,
+                         update_path)
+        if self.persistent_workers and not worker and not update_path:
+          worker = generation_service.GenerationWorker()
+          with self.trace.Span('chroot entry', 'payload', payload=str(payload)):
+            worker.Start()
+
+        if update_path:
+          entries.append(self._ProcessPayload(payload, cache_key, update_path))
+          continue
+
+        # Wait until the host has the memory and loop devices to generate it.
+        with self.trace.Span('admission', 'payload', payload=str(payload)):
+          admission = admission_control.Admit(admission_control.PAYLOAD_JOB)
+        with admission:
+          entries.append(self._ProcessPayload(payload, cache_key, update_path,
+                                              worker=worker))
+    finally:
+      if worker:
+        worker.Stop()
+
+  def _LockImageDirectories(self):
+    """Locks the directories of all images payloads are generated from.
+
+    Directories images are prepared in are locked exclusively, the others
+    shared. Locks are taken in a fixed order so that runs locking the same
+    directories cannot deadlock.
+
+    Returns:
+      A dict mapping the locked directories to their _ImageDirectoryLock's.
+    """
+    prepared = set(_GetImageDirectory(image) for image in self.image_tasks)
+    directories = set(prepared)
     for payload in self.payloads:
-      fd, log_file = tempfile.mkstemp('GenerateVMUpdate')
-      os.close(fd)  # Just want filename so close file immediately.
+      directories.update(_GetImageDirectory(image)
+                         for image in (payload.target, payload.base) if image)
+
+    locks = {}
+    try:
+      for directory in sorted(directories):
+        locks[directory] = _ImageDirectoryLock(directory)
+        start_time = time.time()
+        locks[directory].Acquire(shared=directory not in prepared)
+        self.trace.AddSpan('lock images', 'image', start_time, time.time(),
+                           directory=directory)
+    except BaseException:
+      for lock in locks.values():
+        lock.Release()
+      raise
+    return locks
+
+  def _ShareImageDirectory(self, lock, tasks):
+    """Converts |lock| to shared once |tasks| are done.
+
+    Runs as a step alongside the image tasks, in a process sharing the lock.
+
+    Args:
+      lock: An _ImageDirectoryLock held exclusively.
+      tasks: Names of the tasks preparing the images in its directory.
+    """
+    self.image_graph.Wait(tasks)
+    lock.Acquire(shared=True)
+
+  def GeneratePayloads(self):
+    """Iterates through payload requirements and generates them.
 
-      jobs.append(functools.partial(GeneratePayload, payload, log_file))
-      log_files.append(log_file)
+    This is the main method of this class.  It iterates through payloads
+    it needs, generates them, and builds a Cache that can be used by the
+    test harness to reference these payloads. Payloads found in the persistent
+    payload cache are reused instead of being generated again. Images planned
+    by PlanImagesForTesting are prepared at the same time.
+
+    The directories of the images are locked until all payloads are generated,
+    exclusively only until the images in them are prepared. Other runs using
+    the same images generate their payloads at the same time, but never
+    prepare images while payloads are generated from them.
+
+    Returns:
+      A dict mapping update ids to payload_manifest.PayloadEntry's.
+    """
+    locks = self._LockImageDirectories()
+    try:
+      return self._GeneratePayloads(locks)
+    finally:
+      for lock in locks.values():
+        lock.Release()
+
+  def _GeneratePayloads(self, locks):
+    """Generates payloads with the image directories locked by |locks|.
+
+    See GeneratePayloads.
+
+    Returns:
+      A dict mapping update ids to payload_manifest.PayloadEntry's.
+    """
+    cache_keys = {}
+    cached_paths = {}
+    # Payloads already generated by a previous run do not need to be generated
+    # again. Payloads of images not prepared yet are looked up once they are.
+    if self.cache:
+      for payload in self.payloads:
+        if not self.image_graph.IsDone(self._GetImageTasks(payload)):
+          continue
+        cache_keys[payload] = self.cache.GetKey(payload)
+        update_path = self.cache.Lookup(cache_keys[payload])
+        if update_path:
+          logging.info('Using cached payload for %s from %s.', payload,
+                       update_path)
+          cached_paths[payload] = update_path
+
+    # Loops take jobs in order, so dispatch the most expensive payloads first
+    # to keep them off the end of the critical path.
+    payload_jobs = []
+    for payload in payload_scheduler.OrderLongestFirst(
+        self.payloads, self.history, cached=cached_paths,
+        sources=self.image_sources):
+      if payload not in cached_paths:
+        logging.info('Estimated %ds to generate %s.',
+                     self.history.EstimateSeconds(payload, self.image_sources),
+                     payload)
+      payload_jobs.append((payload, cache_keys.get(payload),
+                           cached_paths.get(payload)))
 
     # Run update generation code and wait for output.
     logging.info('Generating updates required for this test suite in parallel.')
+    image_steps = self.image_graph.GetSteps()
+    # Other runs may prepare images again once no run generates payloads from
+    # them, but may generate payloads from them as soon as they are prepared.
+    directory_tasks = collections.defaultdict(list)
+    for image, task in self.image_tasks.items():
+      directory_tasks[_GetImageDirectory(image)].append(task)
+    share_steps = [functools.partial(self._ShareImageDirectory,
+                                     locks[directory], tasks)
+                   for directory, tasks in sorted(directory_tasks.items())]
+    taken = multiprocessing.Array('b', len(payload_jobs))
+    loops = [functools.partial(self._GenerationLoop, payload_jobs, taken,
+                               time.time())
+             for _ in range(min(self.jobs, len(payload_jobs)))]
     try:
-      parallel.RunParallelSteps(jobs, max_parallel=self.jobs)
+      results = parallel.RunParallelSteps(image_steps + share_steps + loops,
+                                          return_values=True)
     except parallel.BackgroundFailure as ex:
       logging.error(ex)
       raise payload_generation_exception.PayloadGenerationException(
           'Failed to generate a required update.')
 
-    results = ProcessOutput(log_files)
+    for events in results[:len(image_steps)]:
+      self.trace.Extend(events)
+
+    cache = {}
+    for entries, events in results[len(image_steps) + len(share_steps):]:
+      self.trace.Extend(events)
+      for entry in entries:
+        cache[entry.update_id] = entry
+    return cache
+
+  def _EstimateImageReadyTime(self, image):
+    """Returns the estimated seconds until |image| is prepared.
 
-    # Build the dictionary from our id's and returned cache paths.
-    cache_dictionary = {}
-    for index, payload in enumerate(self.payloads):
-      # Path return is of the form update/cache/directory.
-      update_path = results[index]
-      cache_dictionary[payload.UpdateId()] = update_path
-      # Archive payload to payload directory.
+    Images that exist already are reused as they are.
+    """
+    if image not in self.image_inputs or os.path.exists(image):
+      return 0.0
+
+    description, source = self.image_inputs[image]
+    return (self._EstimateImageReadyTime(source) +
+            self.history.EstimateImageSeconds(description))
+
+  def _GetArchiveBytes(self, payload, update_path):
+    """Returns the size of the files archiving |payload| would copy.
+
+    Args:
+      payload: An UpdatePayload to be archived.
+      update_path: Devserver update path the payload was generated into.
+    """
+    payload_dir = payload_cache.GetPayloadDirectory(self.devserver_cache_dir,
+                                                    update_path)
+    names = ['update.gz']
+    if payload.archive_stateful:
+      names.append('stateful.tgz')
+    paths = [os.path.join(payload_dir, name) for name in names]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+  def PrintPlan(self):
+    """Prints what generating the required payloads would do, doing nothing.
+
+    Shows the images to prepare, the payloads in the order they would be
+    dispatched and which of them are in the payload cache, and the wall time
+    and disk space the run would take, estimated from the generation history
+    of this machine. Payloads are only looked up in the payload cache if their
+    inputs were hashed before, as hashing images takes minutes. Others, and
+    payloads of images that are not prepared yet, are shown as unknown and
+    assumed to be generated. Cached payloads are archived too, so their
+    archive size is that of the cached files.
+    """
+    image_bytes = 0
+    print('Images to prepare:')
+    for image in sorted(self.image_inputs):
+      if os.path.exists(image):
+        continue
+      source = self.image_sources[image]
+      if os.path.exists(source):
+        image_bytes += os.path.getsize(source)
+      print('  %7ds  %s %s' % (self._EstimateImageReadyTime(image),
+                               self.image_inputs[image][0], image))
+
+    # Maps cached payloads to their update paths.
+    cached = {}
+    unknown = set()
+    for payload in self.payloads:
+      if not all(os.path.exists(image)
+                 for image in (payload.target, payload.base) if image):
+        unknown.add(payload)
+      elif self.cache:
+        key = self.cache.GetKnownKey(payload)
+        if not key:
+          unknown.add(payload)
+          continue
+        update_path = self.cache.Lookup(key)
+        if update_path:
+          cached[payload] = update_path
+
+    print('%d payloads requested, %d unique. In dispatch order:' %
+          (self.payload_requests, len(self.payloads)))
+    print('  %8s  %9s  %-8s  %s' % ('seconds', 'MB', 'status', 'payload'))
+    jobs = []
+    cache_bytes = archive_bytes = 0
+    for payload in payload_scheduler.OrderLongestFirst(
+        self.payloads, self.history, cached=cached,
+        sources=self.image_sources):
+      seconds = output_bytes = 0
+      status = 'cached'
+      if payload not in cached:
+        seconds = self.history.EstimateSeconds(payload, self.image_sources)
+        output_bytes = self.history.EstimateOutputBytes(payload,
+                                                        self.image_sources)
+        status = 'unknown' if payload in unknown else 'generate'
+        cache_bytes += output_bytes
       if payload.archive and self.nplus1_archive_dir:
-        # Only need directory as we know the rest.
-        path_to_payload_dir = os.path.join(
-            constants.SOURCE_ROOT, 'chroot',
-            self.CHROOT_PATH_TO_DEVSERVER_CACHE, os.path.basename(update_path))
-        payload_path = os.path.join(path_to_payload_dir, 'update.gz')
-        archive_path = os.path.join(self.nplus1_archive_dir,
-                                    payload.GetNameForBin())
-        logging.info('Archiving %s to %s.', payload.GetNameForBin(),
-                     archive_path)
-        shutil.copyfile(payload_path, archive_path)
-        if payload.archive_stateful:
-          stateful_path = os.path.join(path_to_payload_dir, 'stateful.tgz')
-          archive_path = os.path.join(self.nplus1_archive_dir, 'stateful.tgz')
-          logging.info('Archiving stateful payload from %s to %s',
-                       payload.GetNameForBin(), archive_path)
-          shutil.copyfile(stateful_path, archive_path)
-
-    return cache_dictionary
+        if payload in cached:
+          archive_bytes += self._GetArchiveBytes(payload, cached[payload])
+        else:
+          archive_bytes += output_bytes
+
+      ready_time = max(self._EstimateImageReadyTime(image)
+                       for image in (payload.target, payload.base))
+      jobs.append((seconds, ready_time))
+      print('  %8d  %9.1f  %-8s  %s' % (seconds, output_bytes / _MB, status,
+                                        payload))
+
+    image_seconds = max([self._EstimateImageReadyTime(image)
+                         for image in self.image_inputs] + [0.0])
+    wall_time = max(image_seconds,
+                    payload_scheduler.SimulateWallTime(jobs, self.jobs))
+    print('Predicted wall time with %d jobs: %ds.' % (self.jobs, wall_time))
+    print('Predicted disk usage: %.1f MB in the devserver cache, %.1f MB '
+          'archived, %.1f MB of images.' % (
+              cache_bytes / _MB, archive_bytes / _MB, image_bytes / _MB))
 
   def DumpCacheToDisk(self, cache):
-    """Dumps the cache to the same folder as the images."""
+    """Records the payloads in the manifest in the same folder as the images.
+
+    The manifest is replaced as a whole, so payloads of earlier runs, possibly
+    built for other images at the same paths, are never used.
+
+    Args:
+      cache: A dict mapping update ids to payload_manifest.PayloadEntry's, as
+        returned by GeneratePayloads.
+    """
     if not self.basic_suite and not self.full_suite:
       logging.info('Not dumping payload cache to disk as payloads for the '
                    'test harness were not requested.')
     else:
-      path_to_dump = os.path.dirname(self.target)
-      cache_file = os.path.join(path_to_dump, cros_au_test_harness.CACHE_FILE)
+      manifest = payload_manifest.PayloadManifest.ForImage(self.target)
+      logging.info('Recording %d payloads in %s', len(cache), manifest.path)
+      manifest.ReplaceAll(cache.values())
 
-      logging.info('Dumping %s', cache_file)
-      with open(cache_file, 'w') as file_handle:
-        pickle.dump(cache, file_handle)
+  def DumpTraceToDisk(self):
+    """Dumps the timing trace of this run to the same folder as the images.
+
+    The trace is written in Chrome trace-event format to TRACE_FILE, and a
+    table of the time spent per payload and stage to TRACE_SUMMARY_FILE.
+    """
+    path_to_dump = os.path.dirname(self.target)
+    trace_file = os.path.join(path_to_dump, TRACE_FILE)
+    summary = self.trace.Summary(group_by='payload')
+    logging.info('Dumping %s. Seconds spent per stage:\n%s', trace_file,
+                 summary)
+    self.trace.Dump(trace_file)
+    osutils.WriteFile(os.path.join(path_to_dump, TRACE_SUMMARY_FILE),
+                      summary + '\n')
 
 
 def _ShouldGenerateVM(options):
@@ -466,27 +1019,60 @@ def main():
                     'target image.')
   parser.add_option('--target', help='Image we want to test updates to.')
 
+  # Options related to reusing payloads from previous runs.
+  parser.add_option('--payload_cache_dir', default=constants.PAYLOAD_CACHE_DIR,
+                    help='Directory of the persistent cache used to reuse '
+                    'payloads generated from identical inputs by previous '
+                    'runs. Default: %default.')
+  parser.add_option('--no_payload_cache', action='store_const', const=None,
+                    dest='payload_cache_dir',
+                    help='Always generate payloads, ignoring previous runs.')
+
   # Miscellaneous options.
   parser.add_option('--jobs', default=test_helper.CalculateDefaultJobs(),
                     type=int,
                     help='Number of payloads to generate in parallel.')
+  parser.add_option('--persistent_workers', default=False,
+                    action='store_true',
+                    help='Enter the chroot once per parallel job and generate '
+                    'all of its payloads in the same long-lived worker, '
+                    'instead of entering the chroot for every payload.')
+  parser.add_option('--plan', default=False, action='store_true',
+                    help='Print the payloads that would be generated, which '
+                    'of them are cached, and the predicted wall time and disk '
+                    'usage, without preparing images or generating anything.')
 
   options = parser.parse_args()[0]
   CheckOptions(parser, options)
+  if options.plan:
+    generator = UpdatePayloadGenerator(options)
+    generator.PlanImagesForTesting()
+    generator.GeneratePayloadRequirements()
+    generator.PrintPlan()
+    return
+
   if options.nplus1_archive_dir and not os.path.exists(
       options.nplus1_archive_dir):
     os.makedirs(options.nplus1_archive_dir)
 
-  # Don't allow this code to be run more than once at a time.
-  lock_path = os.path.join(os.path.dirname(__file__), '.lock_file')
-  with locking.FileLock(lock_path, 'generate payloads lock') as lock:
-    lock.write_lock()
-    with sudo.SudoKeepAlive():
-      generator = UpdatePayloadGenerator(options)
-      generator.GenerateImagesForTesting()
-      generator.GeneratePayloadRequirements()
+  # Only the first payload job of the run may start on a busy host.
+  admission_control.StartRun()
+  # Runs lock the image directories and payloads they work on, so runs on
+  # unrelated images proceed in parallel.
+  with sudo.SudoKeepAlive():
+    generator = UpdatePayloadGenerator(options)
+    generator.PlanImagesForTesting()
+    generator.GeneratePayloadRequirements()
+    try:
       cache = generator.GeneratePayloads()
       generator.DumpCacheToDisk(cache)
+    finally:
+      # The trace of a failed run shows where it spent its time before the
+      # failure, and must not hide the failure itself.
+      try:
+        generator.DumpTraceToDisk()
+      except EnvironmentError as e:
+        logging.warning('Failed to dump the timing trace: %s', e)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for cros_generate_test_payloads."""
+
+from __future__ import print_function
+
+import optparse
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.generate_test_payloads import cros_generate_test_payloads
+
+
+class FakeHistory(object):
+  """A generation history estimating 100s and 1 MB for every payload."""
+
+  def EstimateSeconds(self, _payload, _sources=None):
+    return 100.0
+
+  def EstimateOutputBytes(self, _payload, _sources=None):
+    return 1024 ** 2
+
+  def EstimateImageSeconds(self, _kind):
+    return 600.0
+
+
+class FakeCache(object):
+  """A payload cache knowing the keys of |known| payloads only."""
+
+  def __init__(self, known, cached):
+    """Initializes the cache.
+
+    Args:
+      known: Dict mapping str(payload) to the key of payloads whose inputs
+        were hashed before.
+      cached: Dict mapping keys to update paths of cached payloads.
+    """
+    self.known = known
+    self.cached = cached
+
+  def GetKey(self, payload):
+    raise AssertionError('Hashed the inputs of %s.' % payload)
+
+  def GetKnownKey(self, payload):
+    return self.known.get(str(payload))
+
+  def Lookup(self, key):
+    return self.cached.get(key)
+
+
+class PrintPlanTest(cros_test_lib.TempDirTestCase):
+  """Tests printing the plan of a run without preparing or hashing images."""
+
+  def setUp(self):
+    self.target = os.path.join(self.tempdir, 'target',
+                               'chromiumos_test_image.bin')
+    self.base = os.path.join(self.tempdir, 'base', 'chromiumos_test_image.bin')
+    osutils.WriteFile(self.target, 'target', makedirs=True)
+    osutils.WriteFile(self.base, 'base', makedirs=True)
+
+  def _CreateGenerator(self, cache):
+    """Returns a generator planning the basic suite without VM images."""
+    options = optparse.Values(dict(
+        target=self.target, base=self.base, public_key=None, private_key=None,
+        board='x86-generic', basic_suite=True, full_suite=False,
+        full_payload=True, nplus1=False, nplus1_archive_dir=None, jobs=2,
+        persistent_workers=False, vm=False, payload_cache_dir=None))
+    generator = cros_generate_test_payloads.UpdatePayloadGenerator(options)
+    generator.history = FakeHistory()
+    generator.cache = cache
+    generator.PlanImagesForTesting()
+    generator.GeneratePayloadRequirements()
+    return generator
+
+  def testPrintPlan(self):
+    """Tests that only payloads with known keys are looked up."""
+    noop = '%s->%s' % (self.target, self.target)
+    cache = FakeCache(known={noop: 'noop key'},
+                      cached={'noop key': 'update/cache/noop'})
+    generator = self._CreateGenerator(cache)
+    with cros_test_lib.OutputCapturer() as output:
+      generator.PrintPlan()
+    lines = output.GetStdout().splitlines()
+
+    self.assertIn('2 payloads requested, 2 unique. In dispatch order:', lines)
+    self.assertIn('         0        0.0  cached    %s' % noop, lines)
+    self.assertIn('       100        1.0  unknown   %s' % self.target, lines)
+    self.assertIn('Predicted wall time with 2 jobs: 100s.', lines)
+    self.assertIn('Predicted disk usage: 1.0 MB in the devserver cache, '
+                  '0.0 MB archived, 0.0 MB of images.', lines)
+
+  def testPrintPlanWithoutCache(self):
+    """Tests that without a payload cache, all payloads are generated."""
+    generator = self._CreateGenerator(None)
+    with cros_test_lib.OutputCapturer() as output:
+      generator.PrintPlan()
+    stdout = output.GetStdout()
+
+    self.assertNotIn('unknown', stdout)
+    self.assertIn('Predicted wall time with 2 jobs: 100s.', stdout)
+
+
+if __name__ == '__main__':
+  unittest.main()
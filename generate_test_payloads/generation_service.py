@@ -0,0 +1,132 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a persistent in-chroot worker for payload generation.
+
+Running every generation command with SudoRunCommand(enter_chroot=True) pays
+for sudo and chroot entry once per payload. A GenerationWorker enters the
+chroot once and runs any number of commands through a long-lived process
+(generation_service_worker.py), which matters for small N->N deltas.
+
+FOR USE OUTSIDE CHROOT ONLY.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+
+import constants
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_logging as logging
+from chromite.lib import path_util
+from chromite.lib import timeout_util
+from crostestutils.generate_test_payloads import generation_service_worker
+
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              'generation_service_worker.py')
+
+
+class WorkerDiedError(Exception):
+  """Raised when the in-chroot worker exits unexpectedly."""
+
+
+class GenerationWorker(object):
+  """A long-lived process inside the chroot running generation commands.
+
+  The worker must be started with Start, or is started by the first call to
+  RunCommand, and must be stopped with Stop. It is not thread safe; use one
+  worker per process.
+  """
+
+  def __init__(self):
+    self._proc = None
+
+  def _GetWorkerCommand(self):
+    """Returns the command starting the worker process."""
+    return ['cros_sdk', '--', 'sudo', '--', 'python2',
+            path_util.ToChrootPath(_WORKER_SCRIPT)]
+
+  def Start(self):
+    """Enters the chroot and waits until the worker process is ready."""
+    logging.info('Starting a persistent payload generation worker.')
+    # The worker runs in its own session, so that it can be killed along with
+    # cros_sdk and the commands it runs.
+    self._proc = subprocess.Popen(self._GetWorkerCommand(),
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, close_fds=True,
+                                  cwd=constants.SOURCE_ROOT,
+                                  preexec_fn=os.setsid)
+    self._ReadResult()
+
+  def _ReadResult(self):
+    """Returns the next result written by the worker."""
+    for line in iter(self._proc.stdout.readline, ''):
+      if line.startswith(generation_service_worker.RESULT_PREFIX):
+        return json.loads(line[len(generation_service_worker.RESULT_PREFIX):])
+
+    self._proc.wait()
+    self._proc = None
+    raise WorkerDiedError('Payload generation worker exited.')
+
+  def Stop(self):
+    """Stops the worker once it finishes its current command."""
+    if self._proc:
+      self._proc.stdin.close()
+      self._proc.wait()
+      self._proc = None
+
+  def _Kill(self):
+    """Kills a hung worker and the commands it runs, as root in the chroot.
+
+    The session of the worker holds cros_sdk, the worker inside the chroot and
+    the generators it started, whatever process group they are in.
+    """
+    session = str(self._proc.pid)
+    cros_build_lib.SudoRunCommand(['kill', '-KILL', '--', '-' + session],
+                                  error_code_ok=True, print_cmd=False)
+    cros_build_lib.SudoRunCommand(['pkill', '-KILL', '-s', session],
+                                  error_code_ok=True, print_cmd=False)
+    self._proc.wait()
+    self._proc = None
+
+  def RunCommand(self, cmd, log_file):
+    """Runs |cmd| as root inside the chroot.
+
+    Args:
+      cmd: The command to run, as a list of arguments valid in the chroot.
+      log_file: Path outside the chroot, but inside the chroot's /tmp, to write
+        the combined stdout and stderr of |cmd| to.
+
+    Raises:
+      cros_build_lib.RunCommandError if |cmd| fails.
+      timeout_util.TimeoutError if |cmd| takes longer than MAX_TIMEOUT_SECONDS.
+      WorkerDiedError if the worker exits before reporting a result.
+    """
+    if not self._proc:
+      self.Start()
+
+    request = dict(command=cmd, log_file=path_util.ToChrootPath(log_file))
+    try:
+      with timeout_util.Timeout(constants.MAX_TIMEOUT_SECONDS):
+        try:
+          self._proc.stdin.write(json.dumps(request) + '\n')
+          self._proc.stdin.flush()
+        except IOError as e:
+          # The worker exited since its last command.
+          self._proc.wait()
+          self._proc = None
+          raise WorkerDiedError('Payload generation worker exited: %s' % e)
+        result = self._ReadResult()
+    except timeout_util.TimeoutError:
+      self._Kill()
+      raise
+
+    if result['returncode']:
+      raise cros_build_lib.RunCommandError(
+          'Command failed in payload generation worker: %s' %
+          result.get('error', 'returncode %d' % result['returncode']),
+          cros_build_lib.CommandResult(cmd=cmd,
+                                       returncode=result['returncode']))
@@ -0,0 +1,122 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for generation_service, with the worker run outside the chroot."""
+
+from __future__ import print_function
+
+import os
+import signal
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.lib import timeout_util
+from crostestutils.generate_test_payloads import generation_service
+from crostestutils.generate_test_payloads import generation_service_worker
+
+
+class _LocalWorker(generation_service.GenerationWorker):
+  """A GenerationWorker running its worker process outside the chroot."""
+
+  def _GetWorkerCommand(self):
+    return [sys.executable, generation_service._WORKER_SCRIPT]
+
+
+def _IsRunning(pid):
+  """Returns whether |pid| is a process that is neither gone nor a zombie."""
+  try:
+    stat = osutils.ReadFile('/proc/%d/stat' % pid)
+  except IOError:
+    return False
+  return stat.rpartition(')')[2].split()[0] != 'Z'
+
+
+class GenerationWorkerTest(cros_test_lib.TempDirTestCase):
+  """Tests running commands through a worker."""
+
+  def setUp(self):
+    self.log_file = os.path.join(self.tempdir, 'log')
+    self.worker = _LocalWorker()
+    self.addCleanup(self.worker.Stop)
+    self._Patch(cros_build_lib, 'SudoRunCommand', cros_build_lib.RunCommand)
+    self._Patch(generation_service.constants, 'MAX_TIMEOUT_SECONDS', 2)
+
+  def _Patch(self, obj, name, value):
+    """Replaces |obj|.|name| with |value| for the duration of the test."""
+    self.addCleanup(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+  def testRunCommand(self):
+    """Tests that commands share a worker and log their combined output."""
+    self.worker.RunCommand(['sh', '-c', 'echo out; echo err >&2'],
+                           self.log_file)
+    self.assertEqual('out\nerr\n', osutils.ReadFile(self.log_file))
+    pid = self.worker._proc.pid
+    self.worker.RunCommand(['true'], self.log_file)
+    self.assertEqual(pid, self.worker._proc.pid)
+
+  def testFailures(self):
+    """Tests that failed commands raise and leave the worker running."""
+    with self.assertRaises(cros_build_lib.RunCommandError) as cm:
+      self.worker.RunCommand(['sh', '-c', 'exit 3'], self.log_file)
+    self.assertEqual(3, cm.exception.result.returncode)
+
+    with self.assertRaises(cros_build_lib.RunCommandError) as cm:
+      self.worker.RunCommand([os.path.join(self.tempdir, 'missing')],
+                             self.log_file)
+    self.assertEqual(generation_service_worker.ERROR_RETURNCODE,
+                     cm.exception.result.returncode)
+    self.worker.RunCommand(['true'], self.log_file)
+
+  def testWorkerDied(self):
+    """Tests that a worker exiting before its result raises."""
+    self.assertRaises(generation_service.WorkerDiedError,
+                      self.worker.RunCommand, ['sh', '-c', 'kill -KILL $PPID'],
+                      self.log_file)
+    # The next command starts a new worker.
+    self.worker.RunCommand(['true'], self.log_file)
+
+  def testWorkerExitedBetweenCommands(self):
+    """Tests that a worker that exited while idle is replaced."""
+    self.worker.RunCommand(['true'], self.log_file)
+    os.kill(self.worker._proc.pid, signal.SIGKILL)
+    self.worker._proc.wait()
+    self.assertRaises(generation_service.WorkerDiedError,
+                      self.worker.RunCommand, ['true'], self.log_file)
+    self.assertIsNone(self.worker._proc)
+    self.worker.RunCommand(['true'], self.log_file)
+
+  def testTimeout(self):
+    """Tests that a hung command is killed with all its processes."""
+    pid_file = os.path.join(self.tempdir, 'pid')
+    self.assertRaises(timeout_util.TimeoutError, self.worker.RunCommand,
+                      ['sh', '-c', 'sleep 100 & echo $! > %s; wait' % pid_file],
+                      self.log_file)
+    self.assertIsNone(self.worker._proc)
+    self.assertFalse(_IsRunning(int(osutils.ReadFile(pid_file))))
+
+
+class WorkerRequestTest(unittest.TestCase):
+  """Tests the requests the worker cannot run."""
+
+  def testMalformedRequests(self):
+    """Tests that malformed requests get an error result."""
+    for line in ('not json\n', '{"command": ["true"]}\n', '[]\n'):
+      result = generation_service_worker._RunRequest(line)
+      self.assertEqual(generation_service_worker.ERROR_RETURNCODE,
+                       result['returncode'])
+      self.assertIn('error', result)
+
+
+if __name__ == '__main__':
+  unittest.main()
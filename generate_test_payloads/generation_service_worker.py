@@ -0,0 +1,61 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent payload generation worker.
+
+FOR USE INSIDE CHROOT ONLY, started by generation_service.GenerationWorker.
+
+Reads one JSON request per line on stdin and runs the requested command with
+its output written to the requested log file. Writes one result line per
+request on stdout, prefixed with RESULT_PREFIX so that the caller can skip
+anything else printed on the way out of the chroot. Exits at end of input.
+
+Once started: RESULT_PREFIX{"ready": true}
+Request: {"command": [...], "log_file": "/tmp/..."}
+Result: RESULT_PREFIX{"returncode": 0}
+
+A request that cannot be run, e.g. malformed or naming a missing command,
+gets a result with returncode 127 and an "error" describing why.
+"""
+
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+
+RESULT_PREFIX = 'GENERATION_SERVICE_RESULT='
+
+# Return code of requests that could not be run, as for a missing command.
+ERROR_RETURNCODE = 127
+
+
+def _WriteResult(result):
+  """Writes |result| for the caller outside the chroot."""
+  sys.stdout.write(RESULT_PREFIX + json.dumps(result) + '\n')
+  sys.stdout.flush()
+
+
+def _RunRequest(line):
+  """Runs the request in |line| and returns its result."""
+  try:
+    request = json.loads(line)
+    with open(request['log_file'], 'w') as log:
+      returncode = subprocess.call(request['command'], stdout=log,
+                                   stderr=subprocess.STDOUT, close_fds=True)
+  except (ValueError, KeyError, TypeError, EnvironmentError) as e:
+    return dict(returncode=ERROR_RETURNCODE, error=str(e))
+  return dict(returncode=returncode)
+
+
+def main():
+  _WriteResult(dict(ready=True))
+  for line in iter(sys.stdin.readline, ''):
+    _WriteResult(_RunRequest(line))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a persistent, content-addressed cache of update payloads.
+
+Payloads are keyed by the content hashes of everything that determines their
+bytes: the target image, the base image (if any), the signing key (if any) and
+whether the payload is meant for a VM. A cache entry maps such a key to the
+devserver cache directory holding the payload generated by a previous run.
+Entries whose payload no longer exists in the devserver cache are ignored.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+
+from chromite.lib import cros_logging as logging
+from crostestutils.lib import content_hash
+from crostestutils.lib import json_store
+
+
+def GetPayloadDirectory(devserver_cache_dir, update_path):
+  """Returns the directory outside the chroot holding a generated payload.
+
+  Args:
+    devserver_cache_dir: Path outside the chroot of the devserver cache
+      directory payloads are generated into.
+    update_path: Devserver update path of the form update/cache/<label>.
+  """
+  return os.path.join(devserver_cache_dir, os.path.basename(update_path))
+
+
+class PayloadCache(object):
+  """A cache mapping payload inputs to previously generated payloads."""
+
+  def __init__(self, cache_dir, devserver_cache_dir):
+    """Initializes the cache.
+
+    Args:
+      cache_dir: Directory (outside the chroot) storing the cache state.
+      devserver_cache_dir: Path outside the chroot of the devserver cache
+        directory payloads are generated into.
+    """
+    self.cache_dir = cache_dir
+    self.devserver_cache_dir = devserver_cache_dir
+    self._entries_dir = os.path.join(cache_dir, 'entries')
+    self._hashes_dir = os.path.join(cache_dir, 'hashes')
+
+  def _HashInput(self, path, hash_func):
+    """Returns a content hash for an optional input file, or None."""
+    if not path:
+      return 'none'
+    return hash_func(path, memo_dir=self._hashes_dir)
+
+  def _GetKey(self, payload, hash_func):
+    """Returns the cache key for |payload|, hashing inputs with |hash_func|.
+
+    Returns None if |hash_func| returns None for any input.
+    """
+    hashes = [self._HashInput(path, hash_func)
+              for path in (payload.target, payload.base, payload.key)]
+    if None in hashes:
+      return None
+    return content_hash.HashString(
+        'target=%s' % hashes[0],
+        'base=%s' % hashes[1],
+        'key=%s' % hashes[2],
+        'for_vm=%s' % bool(payload.for_vm))
+
+  def GetKey(self, payload):
+    """Returns the cache key for |payload|.
+
+    Args:
+      payload: A cros_generate_test_payloads.UpdatePayload. All of its input
+        files must exist.
+    """
+    return self._GetKey(payload, content_hash.HashFile)
+
+  def GetKnownKey(self, payload):
+    """Returns the cache key for |payload| if it is known, or None.
+
+    Unlike GetKey, this never reads the inputs of |payload|, so it returns None
+    unless all of them were hashed since they last changed.
+
+    Args:
+      payload: A cros_generate_test_payloads.UpdatePayload. All of its input
+        files must exist.
+    """
+    return self._GetKey(payload, content_hash.GetMemoizedHash)
+
+  def Lookup(self, key):
+    """Returns the update path stored for |key|, or None on a miss."""
+    entry = json_store.ReadJson(os.path.join(self._entries_dir, key + '.json'))
+    if not entry:
+      return None
+
+    update_path = entry['update_path']
+    payload_dir = GetPayloadDirectory(self.devserver_cache_dir, update_path)
+    if not os.path.isfile(os.path.join(payload_dir, 'update.gz')):
+      logging.info('Cached payload %s no longer exists in %s.', key,
+                   payload_dir)
+      return None
+
+    return update_path
+
+  def Store(self, key, payload, update_path):
+    """Records that |payload| with |key| was generated into |update_path|."""
+    json_store.WriteJsonAtomic(
+        os.path.join(self._entries_dir, key + '.json'),
+        dict(update_path=update_path, payload=str(payload),
+             created=time.time()))
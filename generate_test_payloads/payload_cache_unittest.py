@@ -0,0 +1,94 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for payload_cache."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.generate_test_payloads import cros_generate_test_payloads
+from crostestutils.generate_test_payloads import payload_cache
+
+
+UpdatePayload = cros_generate_test_payloads.UpdatePayload
+
+
+class PayloadCacheTest(cros_test_lib.TempDirTestCase):
+  """Test suite for PayloadCache."""
+
+  UPDATE_PATH = 'update/cache/label'
+
+  def setUp(self):
+    self.devserver_cache = os.path.join(self.tempdir, 'devserver_cache')
+    self.cache = payload_cache.PayloadCache(
+        os.path.join(self.tempdir, 'payload_cache'), self.devserver_cache)
+
+    self.target = os.path.join(self.tempdir, 'target.bin')
+    self.base = os.path.join(self.tempdir, 'base.bin')
+    osutils.WriteFile(self.target, 'target')
+    osutils.WriteFile(self.base, 'base')
+
+  def _CreatePayload(self, update_path):
+    """Creates the devserver cache directory for |update_path|."""
+    payload_dir = payload_cache.GetPayloadDirectory(self.devserver_cache,
+                                                    update_path)
+    osutils.Touch(os.path.join(payload_dir, 'update.gz'), makedirs=True)
+
+  def testKeyDependsOnContent(self):
+    """Tests that keys change with the content of inputs, not their paths."""
+    payload = UpdatePayload(self.target, self.base)
+    key = self.cache.GetKey(payload)
+
+    copy = os.path.join(self.tempdir, 'copy.bin')
+    osutils.WriteFile(copy, 'target')
+    self.assertEqual(key, self.cache.GetKey(UpdatePayload(copy, self.base)))
+
+    self.assertNotEqual(key, self.cache.GetKey(
+        UpdatePayload(self.target, None)))
+    self.assertNotEqual(key, self.cache.GetKey(
+        UpdatePayload(self.target, self.base, for_vm=True)))
+
+    osutils.WriteFile(self.target, 'new target')
+    self.assertNotEqual(key, self.cache.GetKey(payload))
+
+  def testKnownKey(self):
+    """Tests that keys are only known once all inputs were hashed."""
+    payload = UpdatePayload(self.target, self.base)
+    self.assertIsNone(self.cache.GetKnownKey(payload))
+    key = self.cache.GetKey(payload)
+    self.assertEqual(key, self.cache.GetKnownKey(payload))
+
+    # Changed inputs are not read again.
+    osutils.WriteFile(self.base, 'new base')
+    self.assertIsNone(self.cache.GetKnownKey(payload))
+    self.assertIsNone(self.cache.GetKnownKey(UpdatePayload(self.base, None)))
+
+  def testLookupAfterStore(self):
+    """Tests that a stored payload is found as long as it exists."""
+    payload = UpdatePayload(self.target, self.base)
+    key = self.cache.GetKey(payload)
+    self.assertIsNone(self.cache.Lookup(key))
+
+    self._CreatePayload(self.UPDATE_PATH)
+    self.cache.Store(key, payload, self.UPDATE_PATH)
+    self.assertEqual(self.UPDATE_PATH, self.cache.Lookup(key))
+
+    # Payloads evicted from the devserver cache are misses.
+    osutils.RmDir(self.devserver_cache)
+    self.assertIsNone(self.cache.Lookup(key))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,227 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing cost estimation and ordering of payload generation.
+
+Payloads are generated with a fixed number of parallel jobs. To keep the most
+expensive payload off the end of the critical path, payloads are dispatched
+longest first. The cost of a payload is estimated from the size of its input
+images and a generation rate for its kind (full or delta, signed or not, for
+VM or not) learned from previous runs.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+
+from crostestutils.lib import json_store
+
+_GB = 1024.0 ** 3
+
+# Rates used until a kind of payload has been generated on this machine.
+_DEFAULT_SECONDS_PER_GB = {
+    'full': 120.0,
+    'delta': 300.0,
+    # A delta from an image to itself has no data to diff, but the devserver
+    # still has to read and hash both images.
+    'noop_delta': 30.0,
+}
+_DEFAULT_OUTPUT_RATIO = {
+    'full': 0.4,
+    'delta': 0.1,
+    'noop_delta': 0.01,
+}
+
+# Seconds taken to prepare an image of each kind until one has been prepared
+# on this machine.
+_DEFAULT_IMAGE_SECONDS = {
+    'vm image': 600.0,
+    'signed image': 120.0,
+}
+
+# Signing requires hashing the payload again and writing the signature.
+_SIGNING_FACTOR = 1.2
+
+# Weight of the newest sample in the moving averages kept by the history.
+_SMOOTHING = 0.3
+
+
+def GetPayloadKind(payload):
+  """Returns a string classifying |payload| by how expensive it is to make."""
+  if not payload.base:
+    kind = 'full'
+  elif os.path.realpath(payload.base) == os.path.realpath(payload.target):
+    kind = 'noop_delta'
+  else:
+    kind = 'delta'
+
+  if payload.key:
+    kind += '+signed'
+  if payload.for_vm:
+    kind += '+for_vm'
+  return kind
+
+
+def GetInputBytes(payload, sources=None):
+  """Returns the number of bytes of images read to generate |payload|.
+
+  Args:
+    payload: The UpdatePayload to generate.
+    sources: Optional dict mapping images that are not created yet to the
+      images they are created from, whose sizes are used instead.
+  """
+  sources = sources or {}
+  input_bytes = 0
+  for image in (payload.target, payload.base):
+    if image and not os.path.exists(image):
+      image = sources.get(image)
+    if image and os.path.exists(image):
+      input_bytes += os.path.getsize(image)
+  return input_bytes
+
+
+class GenerationHistory(object):
+  """Generation rates per kind of payload recorded by previous runs.
+
+  The history is a JSON file mapping payload kinds to moving averages of the
+  seconds it took to generate a GB of input and the ratio of output to input
+  bytes, and kinds of images to the seconds it took to prepare one. Concurrent
+  runs update it under a lock.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    data = json_store.ReadJson(path, default={})
+    self._kinds = data.get('kinds', {})
+    self._images = data.get('images', {})
+
+  def Record(self, payload, seconds, output_bytes):
+    """Records that generating |payload| took |seconds|.
+
+    Args:
+      payload: The UpdatePayload that was generated.
+      seconds: Wall time the generation took.
+      output_bytes: Size of the generated payload.
+    """
+    kind = GetPayloadKind(payload)
+    input_gb = GetInputBytes(payload) / _GB
+    if not input_gb:
+      return
+
+    def _Update(data):
+      stats = data.setdefault('kinds', {}).get(kind)
+      sample = dict(seconds_per_gb=seconds / input_gb,
+                    output_ratio=output_bytes / (input_gb * _GB))
+      if stats:
+        for name, value in sample.iteritems():
+          stats[name] = _SMOOTHING * value + (1 - _SMOOTHING) * stats[name]
+        stats['samples'] += 1
+      else:
+        stats = dict(sample, samples=1)
+      stats['updated'] = time.time()
+      data['kinds'][kind] = stats
+      return data
+
+    self._kinds = json_store.UpdateJson(self.path, _Update,
+                                        default={})['kinds']
+
+  def RecordImage(self, kind, seconds):
+    """Records that preparing an image of |kind| took |seconds|."""
+    def _Update(data):
+      stats = data.setdefault('images', {}).get(kind)
+      if stats:
+        stats['seconds'] = (_SMOOTHING * seconds +
+                            (1 - _SMOOTHING) * stats['seconds'])
+        stats['samples'] += 1
+      else:
+        stats = dict(seconds=seconds, samples=1)
+      stats['updated'] = time.time()
+      data['images'][kind] = stats
+      return data
+
+    self._images = json_store.UpdateJson(self.path, _Update,
+                                         default={})['images']
+
+  def EstimateImageSeconds(self, kind):
+    """Returns the estimated wall time needed to prepare an image of |kind|."""
+    stats = self._images.get(kind)
+    if stats:
+      return stats['seconds']
+    return _DEFAULT_IMAGE_SECONDS.get(kind, 0.0)
+
+  def _GetStat(self, payload, name, defaults):
+    """Returns the recorded or default statistic |name| for |payload|."""
+    kind = GetPayloadKind(payload)
+    stats = self._kinds.get(kind)
+    if stats:
+      return stats[name]
+
+    value = defaults[kind.split('+')[0]]
+    if payload.key and name == 'seconds_per_gb':
+      value *= _SIGNING_FACTOR
+    return value
+
+  def EstimateSeconds(self, payload, sources=None):
+    """Returns the estimated wall time needed to generate |payload|.
+
+    See GetInputBytes for |sources|.
+    """
+    return (GetInputBytes(payload, sources) / _GB *
+            self._GetStat(payload, 'seconds_per_gb', _DEFAULT_SECONDS_PER_GB))
+
+  def EstimateOutputBytes(self, payload, sources=None):
+    """Returns the estimated size of the generated |payload|.
+
+    See GetInputBytes for |sources|.
+    """
+    return int(GetInputBytes(payload, sources) *
+               self._GetStat(payload, 'output_ratio', _DEFAULT_OUTPUT_RATIO))
+
+
+def OrderLongestFirst(payloads, history, cached=(), sources=None):
+  """Returns |payloads| sorted by decreasing estimated generation cost.
+
+  Args:
+    payloads: Iterable of UpdatePayload's.
+    history: A GenerationHistory used to estimate costs.
+    cached: Payloads that will not be generated; they are dispatched last.
+    sources: See GetInputBytes.
+  """
+  def _Cost(payload):
+    if payload in cached:
+      return 0
+    return history.EstimateSeconds(payload, sources)
+
+  # Sort by name first so equal costs are dispatched in a stable order.
+  return sorted(sorted(payloads, key=str), key=_Cost, reverse=True)
+
+
+def SimulateWallTime(jobs, parallel_jobs):
+  """Returns the predicted wall time of generating payloads.
+
+  Simulates the generation loops of cros_generate_test_payloads: every loop
+  takes the first job in dispatch order whose images are ready.
+
+  Args:
+    jobs: List of (seconds, ready_time) tuples in dispatch order, where
+      |seconds| is the time needed to process the job and |ready_time| the time
+      at which the images it needs are ready.
+    parallel_jobs: Number of loops running in parallel.
+  """
+  loops = [0.0] * max(1, min(parallel_jobs, len(jobs)))
+  remaining = list(jobs)
+  while remaining:
+    loop = loops.index(min(loops))
+    now = loops[loop]
+    ready = [job for job in remaining if job[1] <= now]
+    if not ready:
+      # Idle until the images of some job are ready.
+      loops[loop] = min(ready_time for _, ready_time in remaining)
+      continue
+
+    remaining.remove(ready[0])
+    loops[loop] = now + ready[0][0]
+
+  return max(loops)
@@ -0,0 +1,97 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for payload_scheduler."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.generate_test_payloads import cros_generate_test_payloads
+from crostestutils.generate_test_payloads import payload_scheduler
+
+
+UpdatePayload = cros_generate_test_payloads.UpdatePayload
+
+
+class PayloadSchedulerTest(cros_test_lib.TempDirTestCase):
+  """Test suite for payload cost estimation and ordering."""
+
+  def setUp(self):
+    self.target = os.path.join(self.tempdir, 'target.bin')
+    self.base = os.path.join(self.tempdir, 'base.bin')
+    osutils.WriteFile(self.target, 'x' * 4096)
+    osutils.WriteFile(self.base, 'x' * 2048)
+    self.history = payload_scheduler.GenerationHistory(
+        os.path.join(self.tempdir, 'history.json'))
+
+  def testGetPayloadKind(self):
+    """Tests that payloads are classified by cost."""
+    self.assertEqual('full', payload_scheduler.GetPayloadKind(
+        UpdatePayload(self.target, None)))
+    self.assertEqual('delta+for_vm', payload_scheduler.GetPayloadKind(
+        UpdatePayload(self.target, self.base, for_vm=True)))
+    self.assertEqual('noop_delta+signed', payload_scheduler.GetPayloadKind(
+        UpdatePayload(self.target, self.target, key='key.pem')))
+
+  def testDefaultOrder(self):
+    """Tests that without history, real deltas go first and cached last."""
+    full = UpdatePayload(self.target, None)
+    delta = UpdatePayload(self.target, self.base)
+    noop = UpdatePayload(self.target, self.target)
+    cached = UpdatePayload(self.target, self.base, for_vm=True)
+    self.assertEqual(
+        [delta, full, noop, cached],
+        payload_scheduler.OrderLongestFirst([noop, cached, full, delta],
+                                            self.history, cached=[cached]))
+
+  def testRecordedHistory(self):
+    """Tests that recorded rates override defaults and are persisted."""
+    full = UpdatePayload(self.target, None)
+    delta = UpdatePayload(self.target, self.base)
+    self.history.Record(full, 1000.0, 1024)
+    self.assertAlmostEqual(1000.0, self.history.EstimateSeconds(full))
+    self.assertEqual(1024, self.history.EstimateOutputBytes(full))
+
+    reloaded = payload_scheduler.GenerationHistory(self.history.path)
+    self.assertEqual([full, delta],
+                     payload_scheduler.OrderLongestFirst([delta, full],
+                                                         reloaded))
+
+  def testSourcesOfPendingImages(self):
+    """Tests that images not created yet are sized by their sources."""
+    vm_target = os.path.join(self.tempdir, 'vm.bin')
+    payload = UpdatePayload(vm_target, self.base)
+    self.assertEqual(2048, payload_scheduler.GetInputBytes(payload))
+    self.assertEqual(6144, payload_scheduler.GetInputBytes(
+        payload, sources={vm_target: self.target}))
+
+  def testRecordImage(self):
+    """Tests that image preparation times are recorded per kind."""
+    self.assertEqual(600.0, self.history.EstimateImageSeconds('vm image'))
+    self.history.RecordImage('vm image', 100.0)
+    reloaded = payload_scheduler.GenerationHistory(self.history.path)
+    self.assertEqual(100.0, reloaded.EstimateImageSeconds('vm image'))
+
+  def testSimulateWallTime(self):
+    """Tests that loops take ready jobs first and idle for images."""
+    # The first job waits for its images while the others run.
+    jobs = [(10.0, 20.0), (5.0, 0.0), (20.0, 0.0)]
+    self.assertEqual(35.0, payload_scheduler.SimulateWallTime(jobs, 1))
+    self.assertEqual(30.0, payload_scheduler.SimulateWallTime(jobs, 2))
+    self.assertEqual(0.0, payload_scheduler.SimulateWallTime([], 4))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,377 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing the admission control of VMs and payload jobs on a host.
+
+Several builders share a host, and the memory and loop devices they use come
+and go during a run. Rather than fixing the number of jobs from a snapshot at
+startup, every VM and payload job is admitted only once the host has the
+resources it needs at that moment:
+  - memory, from MemAvailable in /proc/meminfo, less the memory running VMs
+    have yet to touch and a headroom for other processes,
+  - free loop devices, i.e. not bound to a file, beyond a few kept for other
+    processes,
+  - VMs running on /dev/kvm, at most one per two CPUs.
+
+A job only shows up in these measurements once it has started, so admitted
+jobs reserve their resources for a grace period. Admissions and reservations
+are shared by all processes on the host through a lock directory; a job is
+admitted by holding an flock on its reservation, so it is released when its
+holder exits however it exits. The very first job of a run is admitted
+without checking the host, so every run makes progress on a busy host. Every
+later job of the run is checked, even once all the earlier ones are released;
+but a run holding no admission waits for a bounded time only, so it still
+makes progress on a host that never has enough memory.
+
+A run is the process calling StartRun and its children, which inherit the
+token naming the run through the environment. The run lasts as long as a
+process of it holds the flock on its run lock.
+"""
+
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+import uuid
+
+import constants
+from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from crostestutils.lib import json_store
+
+_GIB = 1024 ** 3
+_MIB = 1024 ** 2
+
+# Resources a job needs.
+JobRequirements = collections.namedtuple(
+    'JobRequirements', ['name', 'memory_bytes', 'loop_devices', 'vms'])
+# A VM of start_kvm or vm_snapshot, with 2GB of memory, plus qemu itself.
+VM_JOB = JobRequirements('VM', 2 * _GIB + 512 * _MIB, 0, 1)
+# A payload generation job, which mounts the two images of a payload.
+PAYLOAD_JOB = JobRequirements('payload job', 2 * _GIB, 2, 0)
+
+# Memory and loop devices left to other processes, e.g. archiving the build.
+_MEMORY_HEADROOM_BYTES = 4 * _GIB
+_RESERVED_LOOP_DEVICES = 6
+
+# Seconds after which an admitted job is seen by the measurements of the host.
+_GRACE_SECONDS = 120
+# Seconds between checks of the host while waiting for resources.
+_POLL_SECONDS = 5
+# Environment variable naming the run the jobs of a process belong to.
+RUN_ENV_VAR = 'CROS_TEST_ADMISSION_RUN'
+
+# Seconds after which a job of a run holding no admission is admitted without
+# the resources it needs.
+_MAX_IDLE_WAIT_SECONDS = 600
+
+_QEMU_BINARY_RE = re.compile(r'^(qemu-system-.*|qemu-kvm|kvm)$')
+_QEMU_MEMORY_RE = re.compile(r'^(?:size=)?(\d+)([MGT]?)', re.IGNORECASE)
+_MEMORY_UNITS = {'': _MIB, 'M': _MIB, 'G': _GIB, 'T': 1024 * _GIB}
+
+_reservation_counter = itertools.count()
+# Run locks held by this process, by path.
+_run_locks = {}
+
+
+class HostResources(object):
+  """Resources of the host measured at one point in time.
+
+  Attributes:
+    available_memory_bytes: Memory available to new processes.
+    free_loop_devices: Number of loop devices not bound to a file.
+    vm_count: Number of VMs running on this host.
+    vm_untouched_memory_bytes: Memory of the running VMs that is not resident
+      yet, which they may still use.
+    cpu_count: Number of CPUs.
+  """
+
+  def __init__(self, available_memory_bytes, free_loop_devices, vm_count,
+               vm_untouched_memory_bytes, cpu_count):
+    self.available_memory_bytes = available_memory_bytes
+    self.free_loop_devices = free_loop_devices
+    self.vm_count = vm_count
+    self.vm_untouched_memory_bytes = vm_untouched_memory_bytes
+    self.cpu_count = cpu_count
+
+
+def GetAvailableMemoryBytes(meminfo='/proc/meminfo'):
+  """Returns the memory available to new processes, from |meminfo|."""
+  fields = {}
+  for line in osutils.ReadFile(meminfo).splitlines():
+    name, _, value = line.partition(':')
+    if value.split():
+      fields[name] = int(value.split()[0]) * 1024
+  if 'MemAvailable' in fields:
+    return fields['MemAvailable']
+  # Kernels before 3.14 do not estimate it.
+  return fields['MemFree'] + fields['Buffers'] + fields['Cached']
+
+
+def GetFreeLoopDevices():
+  """Returns the number of loop devices not bound to a file."""
+  free = 0
+  for device in glob.glob('/dev/loop[0-9]*'):
+    name = os.path.basename(device)
+    if not os.path.exists(os.path.join('/sys/block', name, 'loop')):
+      free += 1
+  return free
+
+
+def ParseQemuMemory(cmdline):
+  """Returns the memory in bytes of the VM run by the qemu |cmdline|."""
+  for flag, value in zip(cmdline, cmdline[1:]):
+    if flag == '-m':
+      match = _QEMU_MEMORY_RE.match(value)
+      if match:
+        return int(match.group(1)) * _MEMORY_UNITS[match.group(2).upper()]
+  # Default memory of qemu.
+  return 128 * _MIB
+
+
+def _GetRunningVMs():
+  """Returns a list of (memory, resident memory) of the VMs running here."""
+  page_size = os.sysconf('SC_PAGE_SIZE')
+  vms = []
+  for proc_dir in glob.glob('/proc/[0-9]*'):
+    try:
+      cmdline = osutils.ReadFile(os.path.join(proc_dir, 'cmdline'))
+      cmdline = cmdline.rstrip('\0').split('\0')
+      if not _QEMU_BINARY_RE.match(os.path.basename(cmdline[0])):
+        continue
+      resident = int(osutils.ReadFile(
+          os.path.join(proc_dir, 'statm')).split()[1]) * page_size
+    except (IOError, OSError, IndexError, ValueError):
+      # The process exited meanwhile.
+      continue
+    vms.append((ParseQemuMemory(cmdline), resident))
+  return vms
+
+
+def GetHostResources():
+  """Returns the HostResources of this host now."""
+  vms = _GetRunningVMs()
+  return HostResources(
+      available_memory_bytes=GetAvailableMemoryBytes(),
+      free_loop_devices=GetFreeLoopDevices(),
+      vm_count=len(vms),
+      vm_untouched_memory_bytes=sum(max(0, memory - resident)
+                                    for memory, resident in vms),
+      cpu_count=multiprocessing.cpu_count())
+
+
+def GetMaxVMs(cpu_count):
+  """Returns how many VMs may run on |cpu_count| CPUs.
+
+  Half the CPUs are left to background processes.
+  """
+  return max(1, cpu_count // 2)
+
+
+def _CheckResources(job, resources, reservations):
+  """Returns why |job| cannot start now, or None if it can.
+
+  Args:
+    job: JobRequirements of the job.
+    resources: HostResources of the host.
+    reservations: Requirements of the jobs admitted within the grace period.
+  """
+  memory = (job.memory_bytes + _MEMORY_HEADROOM_BYTES +
+            resources.vm_untouched_memory_bytes +
+            sum(r['memory_bytes'] for r in reservations))
+  if memory > resources.available_memory_bytes:
+    return 'needs %d MiB of memory, %d MiB available' % (
+        memory / _MIB, resources.available_memory_bytes / _MIB)
+
+  loop_devices = (job.loop_devices + _RESERVED_LOOP_DEVICES +
+                  sum(r['loop_devices'] for r in reservations))
+  if job.loop_devices and loop_devices > resources.free_loop_devices:
+    return 'needs %d loop devices, %d free' % (loop_devices,
+                                               resources.free_loop_devices)
+
+  vms = job.vms + resources.vm_count + sum(r['vms'] for r in reservations)
+  if job.vms and vms > GetMaxVMs(resources.cpu_count):
+    return 'would run %d VMs on %d CPUs' % (vms, resources.cpu_count)
+  return None
+
+
+class Admission(object):
+  """The admission of a job, held until released.
+
+  Can be used as a context manager releasing the admission on exit.
+  """
+
+  def __init__(self, job, lock_file):
+    self.job = job
+    self._lock_file = lock_file
+
+  def Release(self):
+    """Releases the admission. Does nothing if it was released already."""
+    if self._lock_file:
+      osutils.SafeUnlink(self._lock_file.name)
+      self._lock_file.close()
+      self._lock_file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Release()
+
+
+def _ReadAdmissions(lock_dir):
+  """Returns the reservations of the jobs admitted on this host.
+
+  Removes the reservations of jobs whose holder exited.
+  """
+  admissions = []
+  for path in glob.glob(os.path.join(lock_dir, '*.json')):
+    try:
+      with open(path) as f:
+        try:
+          fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+          if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+          admissions.append(json.load(f))
+          continue
+    except (IOError, ValueError):
+      # Released meanwhile, or not written yet.
+      continue
+    # Nobody holds the admission any more.
+    osutils.SafeUnlink(path)
+  return admissions
+
+
+def _OpenHeld(path, mode):
+  """Opens |path| with a file descriptor not inherited by commands run."""
+  f = open(path, mode)
+  fcntl.fcntl(f, fcntl.F_SETFD,
+              fcntl.fcntl(f, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+  return f
+
+
+def _GetRunLock(lock_dir, run):
+  """Returns the path of the lock held by the processes of |run|."""
+  return os.path.join(lock_dir, 'run-%s.lock' % run)
+
+
+def _IsRunning(run_lock):
+  """Returns whether a process holds the flock on |run_lock|."""
+  try:
+    with open(run_lock) as f:
+      fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+  except IOError as e:
+    if e.errno in (errno.EAGAIN, errno.EACCES):
+      return True
+    if e.errno != errno.ENOENT:
+      raise
+  return False
+
+
+def _JoinRun(lock_dir):
+  """Returns the run of this process, holding its run lock if nobody does.
+
+  Must be called with the admission lock held.
+  """
+  run = os.environ.get(RUN_ENV_VAR)
+  if not run:
+    run = uuid.uuid4().hex
+    os.environ[RUN_ENV_VAR] = run
+  run_lock = _GetRunLock(lock_dir, run)
+  if run_lock not in _run_locks and not _IsRunning(run_lock):
+    lock_file = _OpenHeld(run_lock, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    _run_locks[run_lock] = lock_file
+  return run
+
+
+def StartRun(lock_dir=constants.ADMISSION_DIR):
+  """Makes the jobs of this process and its children one run.
+
+  Joins the run of the parent process instead if it started one.
+
+  Args:
+    lock_dir: Directory of the admissions shared by processes on this host.
+  """
+  osutils.SafeMakedirs(lock_dir)
+  with json_store.FileLock(os.path.join(lock_dir, 'admission')):
+    _JoinRun(lock_dir)
+
+
+def _RemoveStaleRuns(lock_dir):
+  """Removes the run locks and markers of the runs that are over."""
+  for path in glob.glob(os.path.join(lock_dir, 'run-*')):
+    stem = os.path.splitext(path)[0]
+    if not _IsRunning(stem + '.lock'):
+      osutils.SafeUnlink(stem + '.lock')
+      osutils.SafeUnlink(stem + '.admitted')
+
+
+def Admit(job, lock_dir=constants.ADMISSION_DIR,
+          get_resources=GetHostResources):
+  """Waits until the host has the resources to start |job| and admits it.
+
+  Args:
+    job: JobRequirements of the job, e.g. VM_JOB.
+    lock_dir: Directory of the admissions shared by processes on this host.
+    get_resources: Function returning the HostResources of the host.
+
+  Returns:
+    An Admission, to release once the job is done.
+  """
+  osutils.SafeMakedirs(lock_dir)
+  waiting_since = None
+  while True:
+    # Admissions are decided one at a time, so that two jobs never count on
+    # the same resources.
+    with json_store.FileLock(os.path.join(lock_dir, 'admission')):
+      now = time.time()
+      admissions = _ReadAdmissions(lock_dir)
+      run = _JoinRun(lock_dir)
+      _RemoveStaleRuns(lock_dir)
+      # Marks that the run had a job admitted.
+      run_file = os.path.join(lock_dir, 'run-%s.admitted' % run)
+      reason = None
+      if os.path.exists(run_file):
+        reservations = [admission for admission in admissions
+                        if now - admission['time'] < _GRACE_SECONDS]
+        reason = _CheckResources(job, get_resources(), reservations)
+
+      if (reason is not None and waiting_since is not None and
+          now - waiting_since >= _MAX_IDLE_WAIT_SECONDS and
+          not any(admission.get('run') == run
+                  for admission in admissions)):
+        # Nothing of this run will be released to make room for the job.
+        logging.warning('Starting a %s after waiting %d seconds although it '
+                        '%s.', job.name, now - waiting_since, reason)
+        reason = None
+
+      if reason is None:
+        osutils.Touch(run_file)
+        path = os.path.join(lock_dir, '%d-%d.json' % (
+            os.getpid(), next(_reservation_counter)))
+        # Commands run by the holder must not keep the admission after it
+        # exits.
+        lock_file = _OpenHeld(path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        json.dump(dict(job._asdict(), run=run, time=now), lock_file)
+        lock_file.flush()
+        if waiting_since is not None:
+          logging.info('Admitted %s after waiting %d seconds.', job.name,
+                       now - waiting_since)
+        return Admission(job, lock_file)
+
+    if waiting_since is None:
+      waiting_since = now
+      logging.info('Waiting to start a %s: it %s.', job.name, reason)
+    time.sleep(_POLL_SECONDS)
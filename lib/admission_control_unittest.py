@@ -0,0 +1,182 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for admission_control."""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.lib import admission_control
+
+_GIB = 1024 ** 3
+
+
+class HostTest(cros_test_lib.TempDirTestCase):
+  """Tests measuring the resources of the host."""
+
+  def testAvailableMemory(self):
+    """Tests that MemAvailable is preferred to free and cached memory."""
+    meminfo = os.path.join(self.tempdir, 'meminfo')
+    osutils.WriteFile(meminfo, 'MemTotal: 100 kB\nMemFree: 10 kB\n'
+                      'MemAvailable: 50 kB\nBuffers: 1 kB\nCached: 20 kB\n')
+    self.assertEqual(50 * 1024,
+                     admission_control.GetAvailableMemoryBytes(meminfo))
+
+    osutils.WriteFile(meminfo, 'MemTotal: 100 kB\nMemFree: 10 kB\n'
+                      'Buffers: 1 kB\nCached: 20 kB\n')
+    self.assertEqual(31 * 1024,
+                     admission_control.GetAvailableMemoryBytes(meminfo))
+
+  def testParseQemuMemory(self):
+    """Tests the formats of the memory of qemu."""
+    self.assertEqual(2 * _GIB, admission_control.ParseQemuMemory(
+        ['qemu-system-x86_64', '-enable-kvm', '-m', '2G']))
+    self.assertEqual(2 * _GIB, admission_control.ParseQemuMemory(
+        ['kvm', '-m', '2048']))
+    self.assertEqual(128 * 1024 ** 2, admission_control.ParseQemuMemory(
+        ['kvm', '-smp', '4']))
+
+
+class AdmitTest(cros_test_lib.TempDirTestCase):
+  """Tests admitting jobs."""
+
+  def setUp(self):
+    self.resources = admission_control.HostResources(
+        available_memory_bytes=10 * _GIB, free_loop_devices=10, vm_count=0,
+        vm_untouched_memory_bytes=0, cpu_count=8)
+    # Fail instead of waiting for resources.
+    def _Sleep(_):
+      raise AssertionError('Job was not admitted.')
+    original = admission_control.time.sleep
+    admission_control.time.sleep = _Sleep
+    self.addCleanup(setattr, admission_control.time, 'sleep', original)
+    # Every test is a run of its own.
+    self.addCleanup(os.environ.pop, admission_control.RUN_ENV_VAR, None)
+    os.environ.pop(admission_control.RUN_ENV_VAR, None)
+    self._Patch(admission_control, '_run_locks', {})
+
+  def _Patch(self, obj, name, value):
+    """Replaces |obj|.|name| with |value| for the duration of the test."""
+    self.addCleanup(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+  def _Admit(self, job):
+    return admission_control.Admit(job, lock_dir=self.tempdir,
+                                   get_resources=lambda: self.resources)
+
+  def testFirstJobAlwaysAdmitted(self):
+    """Tests that only the first job of a run skips the checks."""
+    self.resources.available_memory_bytes = 0
+    with self._Admit(admission_control.VM_JOB):
+      self.assertRaises(AssertionError, self._Admit,
+                        admission_control.VM_JOB)
+    # Later jobs are checked even once the earlier ones are released.
+    self.assertRaises(AssertionError, self._Admit, admission_control.VM_JOB)
+
+  def testRunsOfOneProcessGroup(self):
+    """Tests that runs started from one process group are told apart."""
+    admission_control.StartRun(lock_dir=self.tempdir)
+    self._Admit(admission_control.VM_JOB).Release()
+    self.resources.available_memory_bytes = 0
+    pid = os.fork()
+    if not pid:
+      # A run started later from the same shell.
+      try:
+        os.environ.pop(admission_control.RUN_ENV_VAR)
+        admission_control._run_locks = {}
+        admission_control.StartRun(lock_dir=self.tempdir)
+        self._Admit(admission_control.VM_JOB)
+      except BaseException:
+        os._exit(1)
+      os._exit(0)
+    self.assertEqual(0, os.waitpid(pid, 0)[1])
+    self.assertRaises(AssertionError, self._Admit, admission_control.VM_JOB)
+    # The run of the child is over.
+    self.assertEqual(
+        ['run-%s.admitted' % os.environ[admission_control.RUN_ENV_VAR],
+         'run-%s.lock' % os.environ[admission_control.RUN_ENV_VAR]],
+        sorted(name for name in os.listdir(self.tempdir)
+               if name.startswith('run-')))
+
+  def testChildrenJoinRun(self):
+    """Tests that children of a run do not start runs of their own."""
+    admission_control.StartRun(lock_dir=self.tempdir)
+    self._Admit(admission_control.VM_JOB).Release()
+    self.resources.available_memory_bytes = 0
+    pid = os.fork()
+    if not pid:
+      try:
+        self._Admit(admission_control.VM_JOB)
+      except AssertionError:
+        os._exit(0)
+      os._exit(1)
+    self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+  def testIdleRunAdmitted(self):
+    """Tests that a run holding no admission waits for a bounded time only."""
+    clock = [1000.0]
+    def _Sleep(seconds):
+      clock[0] += seconds
+    self._Patch(admission_control.time, 'time', lambda: clock[0])
+    self._Patch(admission_control.time, 'sleep', _Sleep)
+
+    self._Admit(admission_control.VM_JOB).Release()
+    self.resources.available_memory_bytes = 0
+    self._Admit(admission_control.VM_JOB).Release()
+    self.assertGreaterEqual(clock[0] - 1000.0,
+                            admission_control._MAX_IDLE_WAIT_SECONDS)
+
+  def testReservations(self):
+    """Tests that jobs admitted recently count until released."""
+    with self._Admit(admission_control.VM_JOB):
+      with self._Admit(admission_control.VM_JOB):
+        # A third 2.5GB VM and the 4GB of headroom do not fit in 10GB.
+        self.assertRaises(AssertionError, self._Admit,
+                          admission_control.VM_JOB)
+      self._Admit(admission_control.VM_JOB).Release()
+
+  def testLoopDevices(self):
+    """Tests that payload jobs leave loop devices to other processes."""
+    with self._Admit(admission_control.PAYLOAD_JOB):
+      self.resources.free_loop_devices = 9
+      self.assertRaises(AssertionError, self._Admit,
+                        admission_control.PAYLOAD_JOB)
+      self.resources.free_loop_devices = 10
+      self._Admit(admission_control.PAYLOAD_JOB).Release()
+
+  def testVMCount(self):
+    """Tests that VMs of other processes count against the CPUs."""
+    with self._Admit(admission_control.VM_JOB):
+      self.resources.available_memory_bytes = 100 * _GIB
+      self.resources.vm_count = 3
+      self.assertRaises(AssertionError, self._Admit,
+                        admission_control.VM_JOB)
+
+  def testStaleAdmissions(self):
+    """Tests that admissions of exited processes are ignored."""
+    pid = os.fork()
+    if not pid:
+      self._Admit(admission_control.VM_JOB)
+      os._exit(0)
+    os.waitpid(pid, 0)
+    # Only fits if the reservation of the child is gone.
+    self.resources.available_memory_bytes = 7 * _GIB
+    self._Admit(admission_control.VM_JOB).Release()
+    self.assertEqual([], [name for name in os.listdir(self.tempdir)
+                          if name.endswith('.json')])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -30,3 +30,44 @@ GCS_BUCKET = 'chromeos-test-gce-tarballs'
 TRUSTED_BOARDS = [
     'lakitu'
 ]
+
+# Persistent state shared by all runs on this checkout (outside the chroot).
+CACHE_ROOT = os.path.join(SOURCE_ROOT, '.cache', 'crostestutils')
+PAYLOAD_CACHE_DIR = os.path.join(CACHE_ROOT, 'payloads')
+PAYLOAD_HISTORY_FILE = os.path.join(CACHE_ROOT, 'payload_history.json')
+LOCK_DIR = os.path.join(CACHE_ROOT, 'locks')
+VM_IMAGE_CACHE_DIR = os.path.join(CACHE_ROOT, 'vm_images')
+# Disk space cached VM images may use before the least recently used ones are
+# evicted.
+VM_IMAGE_CACHE_BUDGET_BYTES = 40 * 1024 ** 3
+VM_SNAPSHOT_DIR = os.path.join(CACHE_ROOT, 'vm_snapshots')
+
+# Disk space the results of a harness run may use before the oldest archived
+# disk and memory images of failed tests are removed.
+FAILURE_ARTIFACTS_BUDGET_BYTES = 20 * 1024 ** 3
+
+# Ports leased by test processes (see crostestutils.lib.port_allocator), as
+# [start, end) ranges, and the directory of their locks shared by all
+# checkouts on this host.
+SSH_PORT_RANGE = (9222, 9422)
+PROXY_PORT_RANGE = (8081, 8181)
+DEVSERVER_PORT_RANGE = (8181, 8281)
+PORT_LOCK_DIR = '/tmp/crostestutils_ports'
+# Directory of the locks of devices leased from a pool of remotes (see
+# crostestutils.lib.resource_lease).
+DEVICE_LOCK_DIR = '/tmp/crostestutils_devices'
+# Directory of the VMs and payload jobs admitted on this host (see
+# crostestutils.lib.admission_control), shared by all checkouts.
+ADMISSION_DIR = '/tmp/crostestutils_admission'
+
+# Durations of AU tests recorded by previous runs on this host, read by
+# cros_au_test_harness (see test_history) to run the longest tests first. It is
+# not used to balance shards, unless a copy is given as --shard_history_file.
+AU_TEST_HISTORY_FILE = os.path.join(CACHE_ROOT, 'au_test_history.json')
+
+# State, locks and logs of the devserver shared by harness runs, inside the
+# chroot's /tmp as the devserver writes its logs there, and the seconds it
+# keeps running without users.
+SHARED_DEVSERVER_DIR = os.path.join(SOURCE_ROOT, DEFAULT_CHROOT_DIR, 'tmp',
+                                    'crostestutils_devserver')
+SHARED_DEVSERVER_IDLE_TIMEOUT = 30 * 60
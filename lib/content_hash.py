@@ -0,0 +1,80 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing helpers to compute content hashes of large files.
+
+Images are several GB, so hashes are memoized on disk keyed by the file's
+identity (device, inode, size and mtime). A file that has not been touched
+since it was last hashed is not read again.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+
+from crostestutils.lib import json_store
+
+_READ_SIZE = 4 * 1024 * 1024
+
+
+def _StatKey(path):
+  """Returns a list identifying the current on-disk version of |path|."""
+  st = os.stat(path)
+  return [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+
+
+def HashString(*parts):
+  """Returns the hex sha1 of the given strings joined by newlines."""
+  return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+
+def _GetMemoPath(real_path, memo_dir, algorithm):
+  """Returns the path of the memoized hash of |real_path| in |memo_dir|."""
+  return os.path.join(memo_dir, '%s.json' % HashString(algorithm, real_path))
+
+
+def GetMemoizedHash(path, memo_dir, algorithm='sha1'):
+  """Returns the memoized digest of |path|, or None, without reading |path|.
+
+  Args:
+    path: The file to look up.
+    memo_dir: Directory HashFile remembered hashes in.
+    algorithm: Name of the hashlib algorithm used.
+  """
+  real_path = os.path.realpath(path)
+  memo = json_store.ReadJson(_GetMemoPath(real_path, memo_dir, algorithm))
+  if memo and memo.get('stat') == _StatKey(real_path):
+    return memo['digest']
+  return None
+
+
+def HashFile(path, memo_dir=None, algorithm='sha1'):
+  """Returns the hex digest of the content of |path|.
+
+  Args:
+    path: The file to hash.
+    memo_dir: If set, directory used to remember hashes of files that have not
+      changed since they were last hashed.
+    algorithm: Name of the hashlib algorithm to use.
+  """
+  real_path = os.path.realpath(path)
+  if memo_dir:
+    digest = GetMemoizedHash(real_path, memo_dir, algorithm=algorithm)
+    if digest:
+      return digest
+
+  stat_key = _StatKey(real_path)
+  hasher = hashlib.new(algorithm)
+  with open(real_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(_READ_SIZE), ''):
+      hasher.update(chunk)
+  digest = hasher.hexdigest()
+
+  # Only remember the hash if the file did not change while we read it.
+  if memo_dir and stat_key == _StatKey(real_path):
+    json_store.WriteJsonAtomic(_GetMemoPath(real_path, memo_dir, algorithm),
+                               dict(path=real_path, stat=stat_key,
+                                    digest=digest))
+  return digest
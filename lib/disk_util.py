@@ -0,0 +1,85 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing helpers to clone large disk images cheaply.
+
+Images are several GB and mostly empty. Where the filesystem supports it, a
+clone shares the blocks of its source (reflink) and costs nothing until one of
+them is written. Otherwise, clones are copied sparsely so holes stay holes.
+Either way clones are raw images, like their source, so any script can use
+them. Disks only used by qemu started with an explicit format can instead be
+qcow2 overlays recording their writes on top of a shared base image.
+"""
+
+from __future__ import print_function
+
+import os
+
+from chromite.lib import cros_build_lib
+from chromite.lib import osutils
+
+# Methods CloneFile may use, cheapest first.
+REFLINK = 'reflink'
+COPY = 'copy'
+
+
+def _Copy(src, dst, *args):
+  """Copies |src| to |dst| with cp |args|; returns whether it succeeded."""
+  result = cros_build_lib.RunCommand(['cp'] + list(args) + [src, dst],
+                                     error_code_ok=True, print_cmd=False,
+                                     capture_output=True)
+  if result.returncode:
+    # cp leaves an empty |dst| behind when it cannot reflink.
+    if os.path.exists(dst):
+      os.remove(dst)
+    return False
+  return True
+
+
+def CloneFile(src, dst):
+  """Creates |dst| as a copy of |src| as cheaply as possible.
+
+  Writes to either file are never seen by the other.
+
+  Args:
+    src: Path of the file to clone.
+    dst: Path of the clone, which must not exist.
+
+  Returns:
+    The method used: REFLINK or COPY.
+  """
+  if _Copy(src, dst, '--reflink=always'):
+    return REFLINK
+
+  if not _Copy(src, dst, '--sparse=always'):
+    raise OSError('Failed to copy %s to %s.' % (src, dst))
+  return COPY
+
+
+def CreateOverlay(base, path):
+  """Creates |path| as a qcow2 overlay on |base|; returns whether it worked.
+
+  The overlay records all writes made to it and reads everything else from
+  |base|, a raw disk image.
+  """
+  if not osutils.Which('qemu-img'):
+    return False
+
+  result = cros_build_lib.RunCommand(
+      ['qemu-img', 'create', '-f', 'qcow2',
+       '-o', 'backing_file=%s,backing_fmt=raw' % os.path.abspath(base), path],
+      error_code_ok=True, print_cmd=False, capture_output=True)
+  return result.returncode == 0
+
+
+def GetDiskUsage(path):
+  """Returns the number of bytes allocated to |path| and the files under it."""
+  if not os.path.isdir(path):
+    return os.lstat(path).st_blocks * 512
+
+  usage = 0
+  for dirpath, _, filenames in os.walk(path):
+    for filename in filenames:
+      usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+  return usage
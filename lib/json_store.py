@@ -0,0 +1,93 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing helpers for small JSON state files shared by processes.
+
+Writers never modify a file in place. Data is written to a temporary file in
+the same directory and renamed over the destination, so readers always see
+either the old or the new content. Read-modify-write cycles are serialized
+with an flock on a sibling '.lock' file.
+"""
+
+from __future__ import print_function
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import tempfile
+
+
+def ReadJson(path, default=None):
+  """Returns the decoded content of |path|, or |default| if unreadable."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+  except ValueError:
+    # A partially written file can only come from a crashed non-atomic writer.
+    pass
+  return default
+
+
+def WriteJsonAtomic(path, data):
+  """Atomically replaces |path| with the JSON encoding of |data|."""
+  directory = os.path.dirname(path) or '.'
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  fd, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                   dir=directory)
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+  except BaseException:
+    os.unlink(temp_path)
+    raise
+
+
+@contextlib.contextmanager
+def FileLock(path, shared=False):
+  """Context manager holding an flock on |path| + '.lock'."""
+  lock_path = path + '.lock'
+  directory = os.path.dirname(lock_path)
+  if directory and not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  with open(lock_path, 'a') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def UpdateJson(path, update_func, default=None):
+  """Applies |update_func| to the content of |path| under an exclusive lock.
+
+  Args:
+    path: The JSON file to update.
+    update_func: Callable taking the current decoded content (or |default|)
+      and returning the new content to store.
+    default: Content passed to |update_func| if |path| does not exist yet.
+
+  Returns:
+    The new content that was written.
+  """
+  with FileLock(path):
+    data = update_func(ReadJson(path, default))
+    WriteJsonAtomic(path, data)
+    return data
@@ -0,0 +1,118 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing the manifest of payloads generated for the test harness.
+
+cros_generate_test_payloads records every payload it generates in a manifest
+stored next to the target image, and cros_au_test_harness reads it to find the
+devserver path of the payload it needs for an update.
+
+The manifest is an sqlite database indexed by update id. Every run replaces
+all of its entries with ReplaceAll in one atomic transaction, so any number of
+harness processes may read it while it is being updated and never see entries
+of different runs mixed. The schema
+version is stored in the database so that older readers refuse newer formats
+instead of misreading them.
+"""
+
+from __future__ import print_function
+
+import collections
+import contextlib
+import os
+import sqlite3
+
+# File name of the manifest in the directory of the target image.
+MANIFEST_FILE = 'update_manifest.db'
+
+# Version of the schema below. Bump when making incompatible changes.
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+  update_id TEXT PRIMARY KEY,
+  update_path TEXT NOT NULL,
+  size INTEGER,
+  sha256 TEXT,
+  generated_at REAL,
+  generation_seconds REAL
+)
+"""
+
+# Seconds to wait for another process holding a write lock.
+_LOCK_TIMEOUT = 60
+
+PayloadEntry = collections.namedtuple(
+    'PayloadEntry', ['update_id', 'update_path', 'size', 'sha256',
+                     'generated_at', 'generation_seconds'])
+
+
+class ManifestVersionError(Exception):
+  """Raised when a manifest was written with an unsupported schema."""
+
+
+class PayloadManifest(object):
+  """An indexed, versioned manifest of generated payloads.
+
+  A PayloadManifest can also be used wherever a dict mapping update ids to
+  update paths is expected for reading (see get).
+  """
+
+  def __init__(self, path):
+    """Opens the manifest at |path|, creating it if it does not exist."""
+    self.path = path
+    with self._Connect() as conn:
+      version = conn.execute('PRAGMA user_version').fetchone()[0]
+      if version > SCHEMA_VERSION:
+        raise ManifestVersionError(
+            '%s has schema version %d; only %d is supported.' % (
+                path, version, SCHEMA_VERSION))
+      if version < SCHEMA_VERSION:
+        conn.execute(_SCHEMA)
+        conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+  @classmethod
+  def ForImage(cls, image_path):
+    """Returns the manifest stored next to |image_path|."""
+    return cls(os.path.join(os.path.dirname(image_path), MANIFEST_FILE))
+
+  @contextlib.contextmanager
+  def _Connect(self):
+    """Yields a connection committing on success and rolling back on error.
+
+    A new connection is used for every operation, so a manifest can be shared
+    with processes forked after it was opened.
+    """
+    conn = sqlite3.connect(self.path, timeout=_LOCK_TIMEOUT)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  def ReplaceAll(self, entries):
+    """Replaces the whole manifest with PayloadEntry's in one transaction.
+
+    Readers see either the previous entries or |entries|, never a mix.
+    """
+    with self._Connect() as conn:
+      conn.execute('DELETE FROM payloads')
+      conn.executemany('INSERT INTO payloads VALUES (?, ?, ?, ?, ?, ?)',
+                       [tuple(entry) for entry in entries])
+
+  def Get(self, update_id):
+    """Returns the PayloadEntry for |update_id|, or None if there is none."""
+    with self._Connect() as conn:
+      row = conn.execute('SELECT * FROM payloads WHERE update_id = ?',
+                         (update_id,)).fetchone()
+    return PayloadEntry(*row) if row else None
+
+  def get(self, update_id, default=None):
+    """Returns the update path for |update_id|, like dict.get."""
+    entry = self.Get(update_id)
+    return entry.update_path if entry else default
+
+  def __len__(self):
+    with self._Connect() as conn:
+      return conn.execute('SELECT COUNT(*) FROM payloads').fetchone()[0]
@@ -0,0 +1,74 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for payload_manifest."""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.lib import payload_manifest
+
+
+def _MakeEntry(update_id, update_path):
+  """Returns a PayloadEntry with dummy metadata."""
+  return payload_manifest.PayloadEntry(
+      update_id=update_id, update_path=update_path, size=1024,
+      sha256='0' * 64, generated_at=1.5, generation_seconds=2.5)
+
+
+class PayloadManifestTest(cros_test_lib.TempDirTestCase):
+  """Test suite for PayloadManifest."""
+
+  def setUp(self):
+    self.image = os.path.join(self.tempdir, 'chromiumos_test_image.bin')
+    self.manifest = payload_manifest.PayloadManifest.ForImage(self.image)
+
+  def testEmpty(self):
+    """Tests that a new manifest is empty."""
+    self.assertEqual(0, len(self.manifest))
+    self.assertIsNone(self.manifest.Get('id'))
+    self.assertEqual('default', self.manifest.get('id', 'default'))
+
+  def testReplaceAllAndGet(self):
+    """Tests that entries are visible to other readers once written."""
+    entry = _MakeEntry('id1', 'update/cache/one')
+    self.manifest.ReplaceAll([entry, _MakeEntry('id2', 'update/cache/two')])
+
+    reader = payload_manifest.PayloadManifest(self.manifest.path)
+    self.assertEqual(2, len(reader))
+    self.assertEqual(entry, reader.Get('id1'))
+    self.assertEqual('update/cache/two', reader.get('id2'))
+
+  def testReplaceAll(self):
+    """Tests that entries of earlier runs are dropped by ReplaceAll."""
+    self.manifest.ReplaceAll([_MakeEntry('old', 'update/cache/old'),
+                              _MakeEntry('id', 'update/cache/id')])
+    self.manifest.ReplaceAll([_MakeEntry('id', 'update/cache/new')])
+    self.assertEqual(1, len(self.manifest))
+    self.assertIsNone(self.manifest.Get('old'))
+    self.assertEqual('update/cache/new', self.manifest.get('id'))
+
+  def testNewerSchemaRejected(self):
+    """Tests that manifests written by a newer schema are not misread."""
+    conn = sqlite3.connect(self.manifest.path)
+    conn.execute('PRAGMA user_version = %d' %
+                 (payload_manifest.SCHEMA_VERSION + 1))
+    conn.close()
+    self.assertRaises(payload_manifest.ManifestVersionError,
+                      payload_manifest.PayloadManifest, self.manifest.path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing an allocator of ports shared by processes on a host.
+
+Ports, e.g. to forward ssh into a VM or to run a proxy, are leased like any
+other resource (see resource_lease), and only once nothing else is bound to
+them.
+"""
+
+from __future__ import print_function
+
+import socket
+
+import constants
+from chromite.lib import osutils
+from crostestutils.lib import resource_lease
+
+
+class NoFreePortError(Exception):
+  """Raised when all ports in a range are leased or in use."""
+
+
+class PortLease(resource_lease.ResourceLease):
+  """A leased port.
+
+  Attributes:
+    port: The leased port.
+  """
+
+  def __init__(self, port, lock_file):
+    super(PortLease, self).__init__(str(port), lock_file)
+    self.port = port
+
+
+def _IsPortFree(port):
+  """Returns whether a server could listen on |port| on all interfaces."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    return True
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+
+
+def LeasePort(port_range, lock_dir=constants.PORT_LOCK_DIR):
+  """Leases the first free port in |port_range|.
+
+  Args:
+    port_range: Tuple of the first port and the port after the last to try,
+      e.g. constants.SSH_PORT_RANGE.
+    lock_dir: Directory of the lock files of leased ports.
+
+  Returns:
+    A PortLease.
+
+  Raises:
+    NoFreePortError if all ports in |port_range| are leased or in use.
+  """
+  osutils.SafeMakedirs(lock_dir)
+  start, end = port_range
+  for port in xrange(start, end):
+    lock_file = resource_lease.TryLock(lock_dir, str(port))
+    if not lock_file:
+      continue
+
+    if _IsPortFree(port):
+      return PortLease(port, lock_file)
+    lock_file.close()
+
+  raise NoFreePortError('No free port in [%d, %d).' % (start, end))
@@ -0,0 +1,60 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for port_allocator."""
+
+from __future__ import print_function
+
+import socket
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.lib import port_allocator
+
+
+class LeasePortTest(cros_test_lib.TempDirTestCase):
+  """Tests leasing ports."""
+
+  def setUp(self):
+    # Find a range of ports nothing listens on.
+    sock = socket.socket()
+    sock.bind(('', 0))
+    start = sock.getsockname()[1]
+    sock.close()
+    self.port_range = (start, start + 2)
+
+  def _Lease(self):
+    """Returns a lease on a port in the test range."""
+    return port_allocator.LeasePort(self.port_range, lock_dir=self.tempdir)
+
+  def testLeasesAreExclusive(self):
+    """Tests that leased ports are not leased again until released."""
+    first = self._Lease()
+    with self._Lease() as second:
+      self.assertNotEqual(first.port, second.port)
+      self.assertRaises(port_allocator.NoFreePortError, self._Lease)
+
+    with self._Lease() as third:
+      self.assertEqual(second.port, third.port)
+
+  def testPortsInUseAreSkipped(self):
+    """Tests that ports something else is bound to are not leased."""
+    sock = socket.socket()
+    sock.bind(('', self.port_range[0]))
+    try:
+      with self._Lease() as lease:
+        self.assertEqual(self.port_range[0] + 1, lease.port)
+    finally:
+      sock.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing leases of resources shared by processes on a host.
+
+Tests running concurrently on one host, including tests of different
+cros_au_test_harness runs, each need their own resources, e.g. a device to
+update. A resource is leased by holding an flock on a lock file named after
+it, so a lease is released when its holder exits however it exits.
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import os
+import time
+
+from chromite.lib import osutils
+
+# Seconds between attempts to lease a resource when waiting for one.
+_POLL_SECONDS = 1
+
+
+class NoFreeResourceError(Exception):
+  """Raised when all resources of a pool are leased."""
+
+
+class ResourceLease(object):
+  """A resource leased by this process until released.
+
+  Can be used as a context manager releasing the lease on exit.
+
+  Attributes:
+    name: Name of the leased resource.
+  """
+
+  def __init__(self, name, lock_file):
+    self.name = name
+    self._lock_file = lock_file
+
+  def Release(self):
+    """Releases the resource. Does nothing if it was released already."""
+    if self._lock_file:
+      fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+      self._lock_file.close()
+      self._lock_file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Release()
+
+
+def TryLock(lock_dir, name):
+  """Tries to lock resource |name| without waiting.
+
+  Args:
+    lock_dir: Directory of the lock files of leased resources.
+    name: Name of the resource.
+
+  Returns:
+    The open lock file holding the lock, or None if the resource is leased.
+  """
+  lock_file = open(os.path.join(lock_dir, '%s.lock' % name.replace('/', '_')),
+                   'a')
+  # Commands run by the holder must not keep the lease after it exits.
+  fcntl.fcntl(lock_file, fcntl.F_SETFD,
+              fcntl.fcntl(lock_file, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+  try:
+    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError as e:
+    lock_file.close()
+    if e.errno in (errno.EAGAIN, errno.EACCES):
+      return None
+    raise
+  return lock_file
+
+
+def LeaseResource(names, lock_dir, timeout=0):
+  """Leases the first resource of a pool that is not leased.
+
+  Args:
+    names: Names of the resources of the pool, e.g. device addresses.
+    lock_dir: Directory of the lock files of leased resources.
+    timeout: Seconds to wait for a resource to be released when all are
+      leased.
+
+  Returns:
+    A ResourceLease.
+
+  Raises:
+    NoFreeResourceError if all resources stayed leased for |timeout| seconds.
+  """
+  osutils.SafeMakedirs(lock_dir)
+  deadline = time.time() + timeout
+  while True:
+    for name in names:
+      lock_file = TryLock(lock_dir, name)
+      if lock_file:
+        return ResourceLease(name, lock_file)
+
+    if time.time() >= deadline:
+      raise NoFreeResourceError('All of %s are leased.' % ', '.join(names))
+    time.sleep(_POLL_SECONDS)
@@ -0,0 +1,40 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for resource_lease."""
+
+from __future__ import print_function
+
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.lib import resource_lease
+
+
+class LeaseResourceTest(cros_test_lib.TempDirTestCase):
+  """Tests leasing resources from a pool."""
+
+  def testLeasesAreExclusive(self):
+    """Tests that every resource is leased once until released."""
+    pool = ['dut1', 'dut2:22']
+    first = resource_lease.LeaseResource(pool, self.tempdir)
+    second = resource_lease.LeaseResource(pool, self.tempdir)
+    self.assertEqual(pool, [first.name, second.name])
+    self.assertRaises(resource_lease.NoFreeResourceError,
+                      resource_lease.LeaseResource, pool, self.tempdir)
+
+    first.Release()
+    with resource_lease.LeaseResource(pool, self.tempdir) as third:
+      self.assertEqual('dut1', third.name)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a graph of tasks run in parallel processes.
+
+Every task runs in its own process as soon as the tasks it depends on are done.
+Other processes started alongside the tasks, e.g. by parallel.RunParallelSteps,
+can wait for any task with Wait and so start on their own work as soon as the
+tasks it needs are done, rather than when all tasks are done.
+
+All tasks must be added before the processes using the graph are forked.
+"""
+
+from __future__ import print_function
+
+import collections
+import functools
+import multiprocessing
+
+# Seconds between checks for failed tasks while waiting.
+_POLL_SECONDS = 1
+
+
+class TaskFailedError(Exception):
+  """Raised when waiting for tasks after one of the tasks failed."""
+
+
+class TaskGraph(object):
+  """A set of tasks with dependencies between them."""
+
+  def __init__(self):
+    self._tasks = collections.OrderedDict()
+    self._done = {}
+    self._failed = multiprocessing.Event()
+
+  def AddTask(self, name, func, deps=()):
+    """Adds a task.
+
+    Args:
+      name: Unique name of the task.
+      func: Function run by the task, without arguments.
+      deps: Names of tasks, already added, that must be done before this task.
+    """
+    assert name not in self._tasks, 'Task %s added twice.' % name
+    for dep in deps:
+      assert dep in self._tasks, 'Task %s depends on unknown %s.' % (name, dep)
+
+    self._tasks[name] = (func, tuple(deps))
+    self._done[name] = multiprocessing.Event()
+
+  def IsDone(self, names):
+    """Returns whether all tasks |names| are done.
+
+    Raises:
+      TaskFailedError if any task failed.
+    """
+    if self._failed.is_set():
+      raise TaskFailedError('A task this depends on failed.')
+    return all(self._done[name].is_set() for name in names)
+
+  def Wait(self, names):
+    """Blocks until all tasks |names| are done.
+
+    Raises:
+      TaskFailedError if any task failed.
+    """
+    while not self.IsDone(names):
+      for name in names:
+        self._done[name].wait(_POLL_SECONDS)
+
+  def _RunTask(self, name):
+    """Runs task |name| once its dependencies are done; returns its result."""
+    func, deps = self._tasks[name]
+    self.Wait(deps)
+    try:
+      result = func()
+    except BaseException:
+      self._failed.set()
+      raise
+
+    self._done[name].set()
+    return result
+
+  def GetSteps(self):
+    """Returns a list of functions running each task that is not done yet.
+
+    The functions must all be run in parallel, e.g. by parallel.RunParallelSteps
+    without max_parallel, as they block until their dependencies are done. Each
+    function returns the result of its task.
+    """
+    return [functools.partial(self._RunTask, name)
+            for name in self._tasks if not self._done[name].is_set()]
@@ -0,0 +1,61 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for task_graph."""
+
+from __future__ import print_function
+
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.lib import task_graph
+
+
+class TaskGraphTest(cros_test_lib.TestCase):
+  """Tests running a TaskGraph's steps in dependency order."""
+
+  def setUp(self):
+    self.ran = []
+    self.graph = task_graph.TaskGraph()
+    self.graph.AddTask('vm', lambda: self.ran.append('vm') or 'vm image')
+    self.graph.AddTask('signed', lambda: self.ran.append('signed'),
+                       deps=['vm'])
+
+  def testStepsRunInOrder(self):
+    """Tests that steps return their results and mark their tasks done."""
+    vm_step, signed_step = self.graph.GetSteps()
+    self.assertFalse(self.graph.IsDone(['vm']))
+    self.assertEqual(vm_step(), 'vm image')
+    self.assertTrue(self.graph.IsDone(['vm']))
+    self.assertFalse(self.graph.IsDone(['vm', 'signed']))
+    signed_step()
+    self.graph.Wait(['vm', 'signed'])
+    self.assertEqual(self.ran, ['vm', 'signed'])
+    self.assertEqual(self.graph.GetSteps(), [])
+
+  def testFailurePropagates(self):
+    """Tests that waiting for tasks fails once any task failed."""
+    def _Fail():
+      raise ValueError('failed')
+
+    self.graph.AddTask('base', _Fail)
+    base_step = self.graph.GetSteps()[2]
+    self.assertRaises(ValueError, base_step)
+    self.assertRaises(task_graph.TaskFailedError, self.graph.Wait, ['vm'])
+
+  def testUnknownDependency(self):
+    """Tests that tasks must be added after their dependencies."""
+    self.assertRaises(AssertionError, self.graph.AddTask, 'x', lambda: None,
+                      deps=['missing'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,47 +6,61 @@
 
 from __future__ import print_function
 
-import glob
 import multiprocessing
 import os
+import tempfile
 
 import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
 from chromite.lib import path_util
+from crostestutils.lib import admission_control
+from crostestutils.lib import json_store
+from crostestutils.lib import vm_image_cache
 
 
-def _GetTotalMemoryGB():
-  """Calculate total memory on this machine, in gigabytes."""
-  res = cros_build_lib.RunCommand(['free', '-g'], print_cmd=False,
-                                  capture_output=True)
-  assert res.returncode == 0
-  for line in res.output.splitlines():
-    if line.startswith('Mem:'):
-      return int(line.split()[1])
-  raise Exception('Could not calculate total memory')
+def CalculateDefaultJobs():
+  """Calculate how many jobs to run in parallel by default.
 
+  This only bounds the number of jobs by the CPUs, leaving half of them to
+  background processes. Each VM and payload job waits in
+  admission_control.Admit until the host has the memory and loop devices it
+  needs when it starts, so the number of jobs running adapts to what other
+  builders on the host use during the run.
+  """
+  return admission_control.GetMaxVMs(multiprocessing.cpu_count())
+
+
+def GetVMImagePath(image):
+  """Returns the path CreateVMImage creates the VM image of |image| at."""
+  return os.path.join(os.path.dirname(image), 'chromiumos_qemu_image.bin')
 
-def CalculateDefaultJobs():
-  """Calculate how many jobs to run in parallel by default."""
 
-  # 1. Since each job needs two loop devices, limit our number of jobs to the
-  #    number of loop devices divided by two. Reserve six loop devices for
-  #    other processes (e.g. archiving the build in the background.)
-  # 2. Reserve 10GB RAM for background processes. After that, each job needs
-  #    ~2GB RAM.
-  # 3. Reserve half the CPUs for background processes.
-  loop_count = (len(glob.glob('/dev/loop*')) - 6) / 2
-  cpu_count = multiprocessing.cpu_count() / 2
-  mem_count = int((_GetTotalMemoryGB() - 10) / 2)
-  return max(1, min(cpu_count, mem_count, loop_count))
+def _IsVMImageCurrent(vm_image_path, key, image):
+  """Returns whether |vm_image_path| was converted with cache key |key|.
+
+  The key a VM image was converted with is stamped next to it. VM images
+  without a stamp are assumed current if they are newer than |image|.
+  """
+  if not os.path.exists(vm_image_path):
+    return False
+
+  stamp = json_store.ReadJson(vm_image_path + '.key')
+  if stamp is None:
+    return os.path.getmtime(vm_image_path) >= os.path.getmtime(image)
+  return stamp.get('key') == key
 
 
 def CreateVMImage(image, board=None, full=True):
   """Returns the path of the image built to run in a VM.
 
   VM returned is a test image that can run full update testing on it.  This
-  method does not return a new image if one already existed before.
+  method does not return a new image if one was already converted from the
+  same image before, and reuses VM images converted from identical images in
+  other directories from the VM image cache. A VM image that is out of date is
+  replaced by renaming the new one over it, never modified or removed, so
+  processes that opened it keep reading the old one.
 
   Args:
     image: Path to the image.
@@ -54,20 +68,41 @@ def CreateVMImage(image, board=None, full=True):
            configured default board.
     full: If the vm image doesn't exist, create a "full" one which supports AU.
   """
-  vm_image_path = '%s/chromiumos_qemu_image.bin' % os.path.dirname(image)
-  if not os.path.exists(vm_image_path):
-    logging.info('Creating %s', vm_image_path)
-    cmd = ['./image_to_vm.sh',
-           '--from=%s' % path_util.ToChrootPath(os.path.dirname(image)),
-           '--test_image']
-    if full:
-      cmd.extend(['--disk_layout', '2gb-rootfs-updatable'])
-    if board:
-      cmd.extend(['--board', board])
-
-    cros_build_lib.RunCommand(cmd, enter_chroot=True, cwd=constants.SOURCE_ROOT)
-
-  assert os.path.exists(vm_image_path), 'Failed to create the VM image.'
+  vm_image_path = GetVMImagePath(image)
+  disk_layout = '2gb-rootfs-updatable' if full else None
+  cache = vm_image_cache.VMImageCache(constants.VM_IMAGE_CACHE_DIR,
+                                      constants.VM_IMAGE_CACHE_BUDGET_BYTES)
+  key = cache.GetKey(image, disk_layout, board)
+  if not _IsVMImageCurrent(vm_image_path, key, image):
+    if os.path.exists(vm_image_path):
+      logging.info('Replacing %s, which is out of date.', vm_image_path)
+
+    # The VM image is built in a private directory next to it, inside the
+    # chroot's view of the source tree.
+    temp_dir = tempfile.mkdtemp(prefix='.vm_image.',
+                                dir=os.path.dirname(vm_image_path))
+    try:
+      temp_path = os.path.join(temp_dir, os.path.basename(vm_image_path))
+      if not cache.Lookup(key, temp_path):
+        logging.info('Creating %s', vm_image_path)
+        cmd = ['./image_to_vm.sh',
+               '--from=%s' % path_util.ToChrootPath(os.path.dirname(image)),
+               '--to=%s' % path_util.ToChrootPath(temp_dir),
+               '--test_image']
+        if disk_layout:
+          cmd.extend(['--disk_layout', disk_layout])
+        if board:
+          cmd.extend(['--board', board])
+
+        cros_build_lib.RunCommand(cmd, enter_chroot=True,
+                                  cwd=constants.SOURCE_ROOT)
+        assert os.path.exists(temp_path), 'Failed to create the VM image.'
+        cache.Store(key, temp_path)
+      os.rename(temp_path, vm_image_path)
+    finally:
+      osutils.RmDir(temp_dir, ignore_missing=True, sudo=True)
+
+  json_store.WriteJsonAtomic(vm_image_path + '.key', dict(key=key))
   return vm_image_path
 
 
@@ -0,0 +1,89 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a recorder of timing spans in Chrome trace-event format.
+
+Spans are recorded as complete ('X') events and can be dumped as JSON that
+chrome://tracing and catapult's trace viewer load directly. Events recorded in
+other processes can be merged with Extend, as they are plain dicts.
+"""
+
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+
+class Trace(object):
+  """A list of timed spans.
+
+  Attributes:
+    events: List of trace events, as dicts in Chrome trace-event format.
+  """
+
+  def __init__(self):
+    self.events = []
+
+  def AddSpan(self, name, category, start, end, tid=0, **kwargs):
+    """Records a span that ran from |start| to |end|.
+
+    Args:
+      name: Name of the span, e.g. the stage it measures.
+      category: Category of the span, used to filter in the trace viewer.
+      start: Start time, in seconds since the epoch.
+      end: End time, in seconds since the epoch.
+      tid: Thread id to show the span on.
+      kwargs: Additional arguments recorded with the span.
+    """
+    self.events.append(dict(name=name, cat=category, ph='X',
+                            ts=int(start * 1e6), dur=int((end - start) * 1e6),
+                            pid=os.getpid(), tid=tid, args=kwargs))
+
+  @contextlib.contextmanager
+  def Span(self, name, category, tid=0, **kwargs):
+    """Context manager recording a span for the duration of its block."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.AddSpan(name, category, start, time.time(), tid=tid, **kwargs)
+
+  def Extend(self, events):
+    """Adds trace events recorded by another Trace, e.g. in a subprocess."""
+    self.events.extend(events)
+
+  def Dump(self, path):
+    """Writes the trace to |path| as Chrome trace-event JSON."""
+    with open(path, 'w') as f:
+      json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), f)
+
+  def Summary(self, group_by):
+    """Returns a text table of seconds spent per group and span name.
+
+    Args:
+      group_by: Name of the span argument to group rows by. Spans without it
+        are grouped by their own name.
+    """
+    names = []
+    rows = collections.OrderedDict()
+    for event in sorted(self.events, key=lambda e: e['ts']):
+      if event['name'] not in names:
+        names.append(event['name'])
+      group = event['args'].get(group_by, event['name'])
+      row = rows.setdefault(group, collections.defaultdict(float))
+      row[event['name']] += event['dur'] / 1e6
+
+    header = ['%10s' % name[:10] for name in names] + ['%10s' % 'total',
+                                                        group_by]
+    lines = [' '.join(header)]
+    for group, row in rows.iteritems():
+      cells = ['%10s' % ('%.1f' % row[name] if name in row else '-')
+               for name in names]
+      cells.append('%10.1f' % sum(row.values()))
+      cells.append(str(group))
+      lines.append(' '.join(cells))
+    return '\n'.join(lines)
@@ -0,0 +1,61 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for timing_trace."""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from crostestutils.lib import timing_trace
+
+
+class TraceTest(cros_test_lib.TempDirTestCase):
+  """Tests recording and dumping a Trace."""
+
+  def testDump(self):
+    """Tests that spans are dumped in trace-event format."""
+    trace = timing_trace.Trace()
+    trace.AddSpan('generate', 'payload', 10.0, 12.5, payload='a')
+    path = os.path.join(self.tempdir, 'trace.json')
+    trace.Dump(path)
+
+    with open(path) as f:
+      events = json.load(f)['traceEvents']
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0]['ph'], 'X')
+    self.assertEqual(events[0]['ts'], 10000000)
+    self.assertEqual(events[0]['dur'], 2500000)
+    self.assertEqual(events[0]['args'], dict(payload='a'))
+
+  def testSummary(self):
+    """Tests that merged spans are summed per group and name."""
+    trace = timing_trace.Trace()
+    with trace.Span('vm image', 'image'):
+      pass
+    other = timing_trace.Trace()
+    other.AddSpan('generate', 'payload', 1.0, 3.0, payload='a')
+    other.AddSpan('archive', 'payload', 3.0, 3.5, payload='a')
+    other.AddSpan('generate', 'payload', 1.0, 2.0, payload='b')
+    trace.Extend(other.events)
+
+    lines = trace.Summary(group_by='payload').splitlines()
+    self.assertEqual(lines[0].split(),
+                     ['generate', 'archive', 'vm', 'image', 'total', 'payload'])
+    self.assertEqual(lines[1].split(), ['2.0', '0.5', '-', '2.5', 'a'])
+    self.assertEqual(lines[2].split(), ['1.0', '-', '-', '1.0', 'b'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,156 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module containing a cache of VM images keyed by the images they come from.
+
+Converting an image to a VM image takes minutes. The cache keeps VM images by
+the content hash of their source image and the options they were converted
+with, so an identical image in any directory is converted only once. VM
+images are handed out as reflinks of entries, which cost neither time nor disk
+space, or as sparse copies on filesystems without reflinks. Either way they
+are private to their consumer, which may boot and modify them freely. The
+least recently used entries are evicted once the cache exceeds its budget.
+
+Sparse copies of multi-GB images take a while, so files are never copied under
+the lock on the whole cache. Entries being copied out are pinned with a shared
+lock of their own, and eviction skips pinned entries.
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import glob
+import os
+
+from chromite.lib import cros_logging as logging
+from chromite.lib import osutils
+from crostestutils.lib import content_hash
+from crostestutils.lib import disk_util
+from crostestutils.lib import json_store
+
+_ENTRY_SUFFIX = '.bin'
+
+
+class VMImageCache(object):
+  """A content-addressed, size-bounded cache of VM images."""
+
+  def __init__(self, cache_dir, budget_bytes):
+    """Initializes the cache.
+
+    Args:
+      cache_dir: Directory holding the cache, created if needed.
+      budget_bytes: Disk space the entries may use before the least recently
+        used ones are evicted.
+    """
+    self.cache_dir = cache_dir
+    self.budget_bytes = budget_bytes
+    self._hash_memo_dir = os.path.join(cache_dir, 'hashes')
+
+  def GetKey(self, image, disk_layout, board):
+    """Returns the cache key of the VM image converted from |image|.
+
+    Args:
+      image: Path to the image the VM image is converted from.
+      disk_layout: Disk layout the VM image is converted with, or None.
+      board: Board the image was built for, or None.
+    """
+    return content_hash.HashString(
+        'vm image', content_hash.HashFile(image, memo_dir=self._hash_memo_dir),
+        disk_layout or '', board or '')
+
+  def _GetEntryPath(self, key):
+    """Returns the path of the entry for |key|."""
+    return os.path.join(self.cache_dir, key + _ENTRY_SUFFIX)
+
+  def _Lock(self):
+    """Returns a context manager holding the lock on the cache."""
+    return json_store.FileLock(os.path.join(self.cache_dir, 'entries'))
+
+  def Lookup(self, key, vm_image_path):
+    """Creates |vm_image_path| from the entry for |key|, if there is one.
+
+    Args:
+      key: Key returned by GetKey.
+      vm_image_path: Path of the VM image to create. Must not exist.
+
+    Returns:
+      Whether the entry was found.
+    """
+    entry = self._GetEntryPath(key)
+    with self._Lock():
+      if not os.path.exists(entry):
+        return False
+
+      # The modification time of entries orders them for eviction.
+      os.utime(entry, None)
+      # Pinned under the cache lock, the entry cannot be evicted before it is
+      # copied out.
+      pin = open(entry + '.lock', 'a')
+      fcntl.flock(pin, fcntl.LOCK_SH)
+    try:
+      method = disk_util.CloneFile(entry, vm_image_path)
+    finally:
+      pin.close()
+    logging.info('Reused cached VM image %s (%s).', entry, method)
+    return True
+
+  def Store(self, key, vm_image_path):
+    """Adds |vm_image_path| to the cache as the entry for |key|.
+
+    Evicts the least recently used entries once the cache exceeds its budget.
+    """
+    entry = self._GetEntryPath(key)
+    if os.path.exists(entry):
+      return
+
+    # Runs storing the same entry concurrently each copy to their own file.
+    temp_path = '%s.%d.tmp' % (entry, os.getpid())
+    osutils.SafeUnlink(temp_path)
+    osutils.SafeMakedirs(self.cache_dir)
+    try:
+      disk_util.CloneFile(vm_image_path, temp_path)
+    except BaseException:
+      osutils.SafeUnlink(temp_path)
+      raise
+
+    with self._Lock():
+      if os.path.exists(entry):
+        os.remove(temp_path)
+        return
+
+      os.rename(temp_path, entry)
+      self._Evict(keep=entry)
+
+  def _Evict(self, keep):
+    """Removes least recently used entries, but |keep|, until within budget.
+
+    Must be called with the cache locked. Pinned entries are not removed.
+    """
+    entries = sorted(glob.glob(os.path.join(self.cache_dir,
+                                            '*' + _ENTRY_SUFFIX)),
+                     key=os.path.getmtime)
+    usage = sum(disk_util.GetDiskUsage(entry) for entry in entries)
+    for entry in entries:
+      if usage <= self.budget_bytes:
+        break
+      if entry == keep:
+        continue
+
+      size = disk_util.GetDiskUsage(entry)
+      with open(entry + '.lock', 'a') as lock_file:
+        try:
+          fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+          if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+          logging.info('Not evicting cached VM image %s, which is in use.',
+                       entry)
+          continue
+
+        logging.info('Evicting cached VM image %s.', entry)
+        usage -= size
+        os.remove(entry)
+        os.remove(entry + '.lock')
+
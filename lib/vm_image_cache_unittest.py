@@ -0,0 +1,93 @@
+#!/usr/bin/python2
+#
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for vm_image_cache."""
+
+from __future__ import print_function
+
+import fcntl
+import os
+import sys
+import time
+import unittest
+
+import constants
+sys.path.append(constants.CROS_PLATFORM_ROOT)
+sys.path.append(constants.SOURCE_ROOT)
+
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from crostestutils.lib import vm_image_cache
+
+
+class VMImageCacheTest(cros_test_lib.TempDirTestCase):
+  """Tests storing, reusing and evicting VM images."""
+
+  def setUp(self):
+    self.cache = vm_image_cache.VMImageCache(
+        os.path.join(self.tempdir, 'cache'), budget_bytes=64 * 1024)
+    self.image = os.path.join(self.tempdir, 'a', 'chromiumos_test_image.bin')
+    osutils.WriteFile(self.image, 'image', makedirs=True)
+
+  def _WriteVMImage(self, name, content):
+    """Writes a fake VM image and returns its path."""
+    path = os.path.join(self.tempdir, name, 'chromiumos_qemu_image.bin')
+    osutils.WriteFile(path, content, makedirs=True)
+    return path
+
+  def testKey(self):
+    """Tests that keys depend on content and conversion options."""
+    copy = os.path.join(self.tempdir, 'b', 'chromiumos_test_image.bin')
+    osutils.WriteFile(copy, 'image', makedirs=True)
+    key = self.cache.GetKey(self.image, '2gb-rootfs-updatable', 'x86-generic')
+    self.assertEqual(key, self.cache.GetKey(copy, '2gb-rootfs-updatable',
+                                            'x86-generic'))
+    self.assertNotEqual(key, self.cache.GetKey(self.image, None,
+                                               'x86-generic'))
+
+  def testStoreAndLookup(self):
+    """Tests that a stored VM image can be reused in another directory."""
+    key = self.cache.GetKey(self.image, None, None)
+    other = os.path.join(self.tempdir, 'b', 'chromiumos_qemu_image.bin')
+    osutils.SafeMakedirs(os.path.dirname(other))
+    self.assertFalse(self.cache.Lookup(key, other))
+
+    self.cache.Store(key, self._WriteVMImage('a', 'vm image'))
+    self.assertTrue(self.cache.Lookup(key, other))
+    self.assertEqual('vm image', osutils.ReadFile(other))
+
+    # VM images handed out are private to their consumer.
+    osutils.WriteFile(other, 'booted')
+    os.remove(other)
+    self.assertTrue(self.cache.Lookup(key, other))
+    self.assertEqual('vm image', osutils.ReadFile(other))
+
+  def testEviction(self):
+    """Tests that least recently used entries are evicted over budget."""
+    self.cache.Store('old', self._WriteVMImage('old', 'x' * 40 * 1024))
+    # Make sure entries are ordered by modification time.
+    os.utime(os.path.join(self.cache.cache_dir, 'old.bin'),
+             (time.time() - 60, time.time() - 60))
+    self.cache.Store('new', self._WriteVMImage('new', 'y' * 40 * 1024))
+    self.assertNotExists(os.path.join(self.cache.cache_dir, 'old.bin'))
+    self.assertExists(os.path.join(self.cache.cache_dir, 'new.bin'))
+
+  def testPinnedEntriesAreKept(self):
+    """Tests that entries being copied out are not evicted."""
+    self.cache.Store('old', self._WriteVMImage('old', 'x' * 40 * 1024))
+    old_entry = os.path.join(self.cache.cache_dir, 'old.bin')
+    os.utime(old_entry, (time.time() - 60, time.time() - 60))
+    with open(old_entry + '.lock', 'a') as pin:
+      fcntl.flock(pin, fcntl.LOCK_SH)
+      self.cache.Store('new', self._WriteVMImage('new', 'y' * 40 * 1024))
+    self.assertExists(old_entry)
+    self.assertExists(os.path.join(self.cache.cache_dir, 'new.bin'))
+    self.assertEqual([], [name for name in os.listdir(self.cache.cache_dir)
+                          if name.endswith('.tmp')])
+
+
+if __name__ == '__main__':
+  unittest.main()